@@ -0,0 +1,93 @@
+#!/bin/python
+
+"""
+Benchmark of the time service (clock.py) against the datetime code it
+replaced in gps_tcp_server.py and logwriter.py:
+    - the response to time requests (0x30),
+    - the conversion of GPS and WiFi/LBS datetimes to timestamps and local
+      time, as written to location_log.txt,
+    - the timestamps of log lines (the log writer already cached them per
+      second: they are only shared with the other threads now).
+Both versions are checked to give the same results before being timed.
+
+Usage:
+    python benchmarks/bench_clock.py --number 100000
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime
+
+from dateutil import tz
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import clock
+import codec
+
+
+# UTC datetime of a packet, as decoded by codec.py
+FIELDS = (23, 10, 17, 9, 30, 15)
+
+
+def old_time_reply(builder):
+    dt = datetime.utcnow()
+    content = codec.FULL_DATETIME_LAYOUT.pack(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+    return(builder.build(0x30, content))
+
+
+def old_device_datetime(fields):
+    # Timestamp and local time of answer_gps() and answer_wifi_lbs_position()
+    dt = ''.join([ format(x, '02d') for x in fields ])
+    dt = datetime.strptime(dt, '%y%m%d%H%M%S').replace(tzinfo=tz.tzutc())
+    text = datetime.strptime(dt.astimezone(tz.tzlocal()).strftime('%y%m%d%H%M%S'), '%y%m%d%H%M%S').strftime('%Y/%m/%d %H:%M:%S')
+    return(dt.timestamp(), text)
+
+
+def new_device_datetime(fields):
+    timestamp = clock.device_timestamp(fields)
+    return(timestamp, clock.local_text(timestamp))
+
+
+class OldLogTimestamp():
+    # Cache of the log writer, per second
+    def __init__(self):
+        self._second = None
+        self._timestamp = ''
+
+    def __call__(self, timestamp):
+        second = int(timestamp)
+        if (second != self._second):
+            self._second = second
+            self._timestamp = datetime.fromtimestamp(second).strftime('%Y/%m/%d %H:%M:%S')
+        return(self._timestamp)
+
+
+def run(number):
+    builder = codec.ResponseBuilder()
+    now = datetime.now().timestamp()
+    old_log_timestamp = OldLogTimestamp()
+    assert bytes(old_time_reply(builder)) == clock.time_reply()
+    assert old_device_datetime(FIELDS) == new_device_datetime(FIELDS)
+    assert old_log_timestamp(now) == clock.log_timestamp(now)
+
+    cases = [
+        ('time reply (0x30)', lambda: old_time_reply(builder), clock.time_reply),
+        ('device datetime', lambda: old_device_datetime(FIELDS), lambda: new_device_datetime(FIELDS)),
+        ('log timestamp', lambda: old_log_timestamp(now), lambda: clock.log_timestamp(now)),
+    ]
+    print('%-20s %12s %12s %8s' % ('Case', 'before (ns)', 'after (ns)', 'speedup'))
+    for name, old, new in cases:
+        old_time = min(timeit.repeat(old, number=number, repeat=3)) / number
+        new_time = min(timeit.repeat(new, number=number, repeat=3)) / number
+        print('%-20s %12.0f %12.0f %7.1fx' % (name, 1e9 * old_time, 1e9 * new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the time service with the datetime code it replaced.')
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+    run(args.number)
@@ -0,0 +1,122 @@
+#!/bin/python
+
+"""
+Benchmark of packet decoding throughput, in packets per second.
+
+Compares the binary codec (codec.decode_frame) with the former path, where
+each packet was converted into a list of 2-character hex strings that were
+then joined and parsed back into numbers by int(..., base=16).
+Packets are first checked to be framed (see framing.py) and decoded whole.
+
+Usage:
+    python benchmarks/bench_codec.py [--seconds 2]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import codec
+from framing import FrameDecoder
+
+
+# GPS positioning packet (0x10)
+GPS_PACKET = bytes.fromhex('78781610140a0b0c0d0ec5027ac8a80c4635300014d40d0a')
+# WiFi/LBS positioning packet (0x69) with 5 hotspots and 3 GSM cells
+WIFI_PACKET = bytes.fromhex(
+    '78780569200101120000'
+    'aabbccddeeff32a0b1c2d3e4f548112233445566509988776655443c0a0b0c0d0e0f41'
+    '0300d0010340cacd5a0300fc9b640400608964'
+    '0d0a')
+# Login packet (0x01)
+LOGIN_PACKET = bytes.fromhex('78780d010359339075016807420d0a')
+# Status packet (0x13) whose battery and software version (13%, 0x0a) read as stop bytes
+STATUS_PACKET = bytes.fromhex('787807130d0a1e00000d0a')
+
+
+def legacy_decode(packet):
+    """
+    Former decoding path of gps_tcp_server.py, kept here as a reference.
+    """
+
+    packet_list = [packet.hex()[i:i+2] for i in range(4, len(packet.hex())-4, 2)]
+    protocol = packet_list[1]
+    query = packet_list
+
+    if (protocol == '01'):
+        return(''.join(query[2:10])[1:], int(query[10], base=16))
+
+    elif (protocol == '10'):
+        gps_nb_sat = int(query[8][1], base=16)
+        gps_latitude = int(''.join(query[9:13]), base=16) / (30000 * 60)
+        gps_longitude = int(''.join(query[13:17]), base=16) / (30000 * 60)
+        gps_speed = int(query[17], base=16)
+        gps_flags = format(int(''.join(query[18:20]), base=16), '0>16b')
+        if (gps_flags[4] == '1'):
+            gps_longitude = -gps_longitude
+        if (gps_flags[5] == '0'):
+            gps_latitude = -gps_latitude
+        gps_heading = int(''.join(gps_flags[6:]), base = 2)
+        return(gps_nb_sat, gps_latitude, gps_longitude, gps_speed, gps_flags[3], gps_heading)
+
+    elif (protocol == '69'):
+        wifi = []
+        n_wifi = int(query[0])
+        for i in range(n_wifi):
+            wifi.append({'macAddress': ':'.join(query[(8 + (7 * i)):(8 + (7 * (i + 1)) - 2 + 1)]),
+                         'signalStrength': -int(query[(8 + (7 * (i + 1)) - 1)], base = 16)})
+        cells = []
+        n_gsm_cells = int(query[(8 + (7 * n_wifi))])
+        gsm_mcc = int(''.join(query[((8 + (7 * n_wifi)) + 1):((8 + (7 * n_wifi)) + 2 + 1)]), base=16)
+        gsm_mnc = int(query[((8 + (7 * n_wifi)) + 3)], base=16)
+        for i in range(n_gsm_cells):
+            cells.append({'locationAreaCode': int(''.join(query[(((8 + (7 * n_wifi)) + 4) + (5 * i)):(((8 + (7 * n_wifi)) + 4) + (5 * i) + 1 + 1)]), base=16),
+                          'cellId': int(''.join(query[(((8 + (7 * n_wifi)) + 4) + (5 * i) + 1 + 1):(((8 + (7 * n_wifi)) + 4) + (5 * i) + 2 + 1 + 1)]), base=16),
+                          'signalStrength': -int(query[(((8 + (7 * n_wifi)) + 4) + (5 * i) + 2 + 1 + 1)], base=16)})
+        return(wifi, gsm_mcc, gsm_mnc, cells)
+
+
+def measure(function, packet, seconds):
+    """
+    Calls function(packet) repeatedly for the given duration and returns
+    the number of packets decoded per second.
+    """
+    n = 0
+    batch = 1000
+    start = time.perf_counter()
+    deadline = start + seconds
+    while (True):
+        for i in range(batch):
+            function(packet)
+        n += batch
+        now = time.perf_counter()
+        if (now >= deadline):
+            return(n / (now - start))
+
+
+def check_framing():
+    # Packets are framed whole, whether received at once or byte by byte, and decoded
+    for packet in (LOGIN_PACKET, GPS_PACKET, WIFI_PACKET, STATUS_PACKET):
+        assert FrameDecoder().feed(packet + LOGIN_PACKET) == [packet, LOGIN_PACKET]
+        decoder = FrameDecoder()
+        assert [ frame for i in range(len(packet)) for frame in decoder.feed(packet[i:i + 1]) ] == [packet]
+    status = codec.decode_frame(STATUS_PACKET)
+    assert (status.battery, status.software_version, status.upload_interval) == (13, 0x0a, 30)
+
+
+def run(seconds):
+    check_framing()
+    print('%-8s %15s %15s %8s' % ('Packet', 'legacy (pkt/s)', 'codec (pkt/s)', 'speedup'))
+    for name, packet in (('login', LOGIN_PACKET), ('gps', GPS_PACKET), ('wifi', WIFI_PACKET)):
+        legacy = measure(legacy_decode, packet, seconds)
+        binary = measure(codec.decode_frame, packet, seconds)
+        print('%-8s %15.0f %15.0f %7.1fx' % (name, legacy, binary, binary / legacy))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure packet decoding throughput.')
+    parser.add_argument('--seconds', type=float, default=2, help='duration of each measurement')
+    args = parser.parse_args()
+    run(args.seconds)
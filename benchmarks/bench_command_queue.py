@@ -0,0 +1,143 @@
+#!/bin/python
+
+"""
+Benchmark of the commands queued for the devices (see command_queue.py)
+and of the writes to the devices in gps_tcp_server.py:
+    - cost of checking every packet of a device for due commands and
+      acknowledgements, with and without commands queued for it,
+    - cost of queueing, sending and acknowledging upload interval commands
+      for a fleet of devices,
+    - commands sent along with a response, in a single write,
+    - a device that stops reading: writes to its socket never block, and its
+      connection is closed once too much is left to write, where a blocking
+      sendall() would hang the thread of the connection.
+
+Usage:
+    python benchmarks/bench_command_queue.py --devices 10000
+"""
+
+import argparse
+import contextlib
+import os
+import socket
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_hot_paths import PACKETS, load_server
+from command_queue import CommandQueue
+import codec
+
+
+class CountingSocket():
+    """
+    Socket wrapper counting the calls to send().
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sends = 0
+        self.closed = False
+
+    def shutdown(self, how):
+        self.closed = True
+        self.sock.shutdown(how)
+
+    def send(self, data, flags=0):
+        self.sends += 1
+        return(self.sock.send(data, flags))
+
+
+def bench_queue(directory, devices):
+    queue = CommandQueue(os.path.join(directory, 'bench-commands.sqlite'), retry_interval=60)
+    status = codec.decode_frame(PACKETS['status'])
+    idle = 10 ** 14
+
+    start = time.perf_counter()
+    for i in range(100000):
+        queue.acknowledge(idle, status)
+        queue.due(idle)
+    print('Packet of a device without commands : %6.2f us (acknowledgements and due commands checked)' % (10 * (time.perf_counter() - start)))
+
+    imeis = [ 359339075000000 + i for i in range(devices) ]
+    start = time.perf_counter()
+    for imei in imeis:
+        queue.set_upload_interval(imei, 60)
+    enqueued = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(100000):
+        queue.acknowledge(imeis[i % devices], status)
+        queue.due(imeis[i % devices])
+    checked = (time.perf_counter() - start) / 100000
+    start = time.perf_counter()
+    for imei in imeis:
+        queue.take(imei)
+    taken = time.perf_counter() - start
+    ack = codec.decode_frame(codec.encode_response(0x98, (60).to_bytes(2, 'big')))
+    start = time.perf_counter()
+    for imei in imeis:
+        assert queue.acknowledge(imei, ack)
+    acked = time.perf_counter() - start
+    print('Packet of a device with commands    : %6.2f us' % (1e6 * checked))
+    print('Upload interval for %d devices: queued in %.0f us, sent in %.0f us, acknowledged in %.0f us per device' % (devices, 1e6 * enqueued / devices, 1e6 * taken / devices, 1e6 * acked / devices))
+    assert queue.stats()['devices'] == 0
+    queue.close()
+
+
+def bench_writes(server, session, limit):
+    # Commands sent with the response to a packet
+    device, peer = socket.socketpair()
+    client = session.client = CountingSocket(device)
+    server.command_queue.set_upload_interval(session.imei, 60)
+    server.command_queue.set_status_interval(session.imei, 5)
+    server.command_queue.locate(session.imei)
+    server.read_incoming_packet(session, PACKETS['time'])
+    received = peer.recv(4096)
+    frames = []
+    while (received):
+        length = received.index(b'\r\n', 4) + 2
+        frames.append(received[3])
+        received = received[length:]
+    print('Time packet with 3 queued commands  : %d frames (%s) in %d write' % (len(frames), ', '.join('0x%02x' % p for p in frames), client.sends))
+
+    # Device that stops reading: the responses pile up
+    response = server.make_content_response(session, 0x30, bytes(200))
+    slowest = 0
+    writes = 0
+    while (not client.closed):
+        start = time.perf_counter()
+        server.send_response(session, response)
+        slowest = max(slowest, time.perf_counter() - start)
+        writes += 1
+        if (writes > 10 * limit // len(response)):
+            break
+    print('Device not reading, non-blocking    : closed after %d responses, slowest write %.0f us' % (writes, 1e6 * slowest))
+
+    # Same with blocking writes, given up after a second
+    device, peer = socket.socketpair()
+    device.settimeout(1.0)
+    start = time.perf_counter()
+    writes = 0
+    try:
+        while (True):
+            device.sendall(bytes(response))
+            writes += 1
+    except socket.timeout:
+        pass
+    print('Device not reading, sendall()       : blocked after %d responses, for %.1f s (until a timeout)' % (writes, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the command queue and the writes to the devices.')
+    parser.add_argument('--devices', type=int, default=10000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_command_queue_')
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        server, session = load_server(directory)
+    bench_queue(directory, args.devices)
+    bench_writes(server, session, server.WRITE_BUFFER_LIMIT)
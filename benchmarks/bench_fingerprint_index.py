@@ -0,0 +1,86 @@
+#!/bin/python
+
+"""
+Benchmark of the WiFi fingerprint index (fingerprint_index.py).
+
+Stores N synthetic located scans (5 to 8 random hotspots each), then looks
+up perturbed copies of some of them, as a device that did not move would
+send: RSSI jitter, one hotspot missing and one new hotspot.
+Reports insertion rate, lookup latency, recall and memory use.
+
+Usage:
+    python benchmarks/bench_fingerprint_index.py --scans 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fingerprint_index import FingerprintIndex, rssi_weight
+
+
+def random_scan(rng):
+    return([ (rng.getrandbits(48).to_bytes(6, 'big'), rng.randint(-90, -40)) for i in range(rng.randint(5, 8)) ])
+
+
+def perturb(scan, rng):
+    scan = [ (bssid, rssi + rng.randint(-6, 6)) for bssid, rssi in scan ]
+    scan.pop(rng.randrange(len(scan)))
+    scan.append((rng.getrandbits(48).to_bytes(6, 'big'), rng.randint(-90, -70)))
+    return(scan)
+
+
+def weighted(scan):
+    return([ (bssid, rssi_weight(rssi)) for bssid, rssi in scan ])
+
+
+def run(n_scans, n_queries):
+    rng = random.Random(1)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    index = FingerprintIndex()
+
+    queries = []
+    start = time.perf_counter()
+    for i in range(n_scans):
+        scan = random_scan(rng)
+        index.add(weighted(scan), rng.uniform(-90, 90), rng.uniform(-180, 180), 20.0)
+        if (i % max(1, n_scans // n_queries) == 0):
+            queries.append(scan)
+    insert_time = time.perf_counter() - start
+    memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) * 1024
+
+    found = 0
+    latencies = []
+    for scan in queries:
+        query = weighted(perturb(scan, rng))
+        start = time.perf_counter()
+        match = index.lookup(query)
+        latencies.append(time.perf_counter() - start)
+        if (match is not None):
+            found += 1
+
+    misses = 0
+    for i in range(len(queries)):
+        if (index.lookup(weighted(random_scan(rng))) is not None):
+            misses += 1
+
+    latencies.sort()
+    print('Stored scans          :', len(index))
+    print('Insertion rate        : %.0f scans/s' % (n_scans / insert_time))
+    print('Memory (peak RSS)      : %.1f MB (%.0f bytes/scan)' % (memory / 1e6, memory / n_scans))
+    print('Lookup latency p50    : %.1f us' % (latencies[len(latencies) // 2] * 1e6))
+    print('Lookup latency p99    : %.1f us' % (latencies[int(len(latencies) * 0.99)] * 1e6))
+    print('Recall (moved 0 m)    : %.1f %%' % (100 * found / len(queries)))
+    print('False matches         : %.1f %%' % (100 * misses / len(queries)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure fingerprint index lookups.')
+    parser.add_argument('--scans', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+    run(args.scans, args.queries)
@@ -0,0 +1,154 @@
+#!/bin/python
+
+"""
+Benchmark of the cost of checking fixes against geofences (see
+geofence.py), with tens of thousands of fences:
+    - each device has its own polygon fences around its home (garden and
+      neighbours' yards, 12 vertices each),
+    - circle fences for all devices (parks, clinics) are spread over the area,
+    - fixes are taken at home, along the borders, and anywhere in the area,
+      as GPS fixes and as WiFi/LBS positions (with their accuracy).
+Fixes are checked through the grid index of GeofenceEngine, and by a scan
+of every fence of the device and of all devices, as reference; both must
+give the same states.
+
+Usage:
+    python benchmarks/bench_geofence.py --devices 5000 --fences-per-device 5 --shared-fences 5000
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from geofence import METERS_PER_DEGREE, Fence, GeofenceEngine
+
+# Area of the devices: about 50 km x 50 km
+AREA = (48.60, 2.10, 49.05, 2.80)
+
+
+def polygon(rng, latitude, longitude, size, vertices=12):
+    # Irregular polygon of about size meters across
+    scale = METERS_PER_DEGREE * math.cos(math.radians(latitude))
+    points = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        radius = size / 2 * rng.uniform(0.6, 1.0)
+        points.append((latitude + radius * math.sin(angle) / METERS_PER_DEGREE, longitude + radius * math.cos(angle) / scale))
+    return(points)
+
+
+def build(rng, devices, per_device, shared):
+    homes = {}
+    fences = []
+    for imei in range(1, devices + 1):
+        home = (rng.uniform(AREA[0], AREA[2]), rng.uniform(AREA[1], AREA[3]))
+        homes[imei] = home
+        for i in range(per_device):
+            # The garden, then the yards around it
+            north, east = ((0, 0) if i == 0 else (rng.uniform(-150, 150), rng.uniform(-150, 150)))
+            center = (home[0] + north / METERS_PER_DEGREE, home[1] + east / (METERS_PER_DEGREE * math.cos(math.radians(home[0]))))
+            fences.append(Fence('%d-%d' % (imei, i), 'yard %d' % i, imei, polygon=polygon(rng, center[0], center[1], rng.uniform(30, 80))))
+    for i in range(shared):
+        fences.append(Fence('shared-%d' % i, 'place %d' % i, 0, circle=(rng.uniform(AREA[0], AREA[2]), rng.uniform(AREA[1], AREA[3]), rng.uniform(20, 300))))
+    return(homes, fences)
+
+
+def fixes(rng, homes, n):
+    # (imei, latitude, longitude, accuracy): at home (half of them), elsewhere, GPS or WiFi/LBS
+    imeis = list(homes)
+    result = []
+    for i in range(n):
+        imei = rng.choice(imeis)
+        if (rng.random() < 0.5):
+            home = homes[imei]
+            latitude = home[0] + rng.gauss(0, 60) / METERS_PER_DEGREE
+            longitude = home[1] + rng.gauss(0, 60) / (METERS_PER_DEGREE * math.cos(math.radians(home[0])))
+        else:
+            latitude, longitude = rng.uniform(AREA[0], AREA[2]), rng.uniform(AREA[1], AREA[3])
+        accuracy = (0.0 if rng.random() < 0.7 else rng.uniform(20, 500))
+        result.append((imei, latitude, longitude, accuracy))
+    return(result)
+
+
+class ScanEngine(GeofenceEngine):
+    """
+    Reference: every fence of the device and of all devices is checked for every fix.
+    """
+
+    def load(self, fences):
+        super().load(fences)
+        self.by_imei = {}
+        for fence in fences:
+            self.by_imei.setdefault(fence.imei, []).append(fence)
+
+    def evaluate(self, imei, timestamp, latitude, longitude, accuracy=0.0, method='GPS'):
+        margin = (accuracy if accuracy > self.margin else self.margin)
+        state = self._states.get(imei)
+        inside = (set() if state is None else set(state[1]))
+        for fence in self.by_imei.get(imei, []) + self.by_imei.get(0, []):
+            distance = fence.distance(latitude, longitude)
+            if (distance <= -margin):
+                inside.add(fence.id)
+            elif (distance >= margin):
+                inside.discard(fence.id)
+        self._states[imei] = (timestamp, inside)
+        return([])
+
+
+def run(devices, per_device, shared, n_fixes, scan_fixes):
+    rng = random.Random(1)
+    homes, fences = build(rng, devices, per_device, shared)
+    stream = fixes(rng, homes, n_fixes)
+
+    start = time.perf_counter()
+    engine = GeofenceEngine()
+    engine.load(fences)
+    build_time = time.perf_counter() - start
+    tracemalloc.start()
+    engine.load(fences)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    index = engine.index
+    print('Fences: %d (%d per device for %d devices, %d shared)' % (len(fences), per_device, devices, shared))
+    print('Index: %d cells, built in %.0f ms, %.1f MB' % (len(index.cells), 1e3 * build_time, size / 1e6))
+
+    start = time.perf_counter()
+    for i, (imei, latitude, longitude, accuracy) in enumerate(stream):
+        engine.evaluate(imei, i, latitude, longitude, accuracy)
+    indexed = (time.perf_counter() - start) / len(stream)
+    candidates = sum(len(index.candidates(imei, latitude, longitude)) for imei, latitude, longitude, accuracy in stream[:10000]) / min(len(stream), 10000)
+    stats = engine.stats()
+    print('Grid index : %8.1f us/fix (%.2f fences checked per fix, %d events)' % (1e6 * indexed, candidates, stats['events']))
+
+    # The scan is much slower: on the first fixes only, the states are compared on these
+    reference = ScanEngine()
+    reference.load(fences)
+    check = GeofenceEngine()
+    check.load(fences)
+    start = time.perf_counter()
+    for i, (imei, latitude, longitude, accuracy) in enumerate(stream[:scan_fixes]):
+        reference.evaluate(imei, i, latitude, longitude, accuracy)
+    scanned = (time.perf_counter() - start) / scan_fixes
+    for i, (imei, latitude, longitude, accuracy) in enumerate(stream[:scan_fixes]):
+        check.evaluate(imei, i, latitude, longitude, accuracy)
+    assert all(reference.inside(imei) == check.inside(imei) for imei in homes)
+    print('Scan       : %8.1f us/fix (%d fences checked per fix), same states' % (1e6 * scanned, per_device + shared))
+    print('Speedup    : %.0fx' % (scanned / indexed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the cost of checking fixes against geofences.')
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--fences-per-device', type=int, default=5)
+    parser.add_argument('--shared-fences', type=int, default=5000)
+    parser.add_argument('--fixes', type=int, default=100000)
+    parser.add_argument('--scan-fixes', type=int, default=2000)
+    args = parser.parse_args()
+    run(args.devices, args.fences_per_device, args.shared_fences, args.fixes, args.scan_fixes)
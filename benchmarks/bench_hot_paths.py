@@ -0,0 +1,263 @@
+#!/bin/python
+
+"""
+Microbenchmarks of the packet decode and response encode hot paths of
+gps_tcp_server.py, with stored baselines and regression thresholds.
+
+Each benchmark runs one function of the server on a corpus of real packets
+(see identify_packet_standalone.py and bench_codec.py), offline:
+    - the client socket is a stand-in that accepts everything,
+    - geolocate() is stubbed and answers a fixed position right away,
+    - data files go to a temporary directory, and log lines are queued
+      but not written (the writer thread would add noise to the timings),
+    - the console log (see serverlog.py) is at its level from the environment
+      (INFO by default), and goes to /dev/null (but is still measured).
+
+Reported per operation:
+    - ns/op: best of several timed runs,
+    - blocks/op: memory blocks still allocated after the runs, per operation
+      (sys.getallocatedblocks(); should stay close to 0),
+    - peak B/op: peak of memory allocated during one operation (tracemalloc).
+
+Baselines are stored in benchmarks/baselines/hot_paths.json. Timings are
+stored relative to a fixed pure-Python calibration loop, so that baselines
+recorded on one machine remain meaningful on another one. A benchmark is
+reported as a regression when its relative time exceeds the baseline by
+more than --threshold, and the script then exits with status 1.
+
+Usage:
+    python benchmarks/bench_hot_paths.py              # compare with the baselines
+    python benchmarks/bench_hot_paths.py --save       # store new baselines
+    python benchmarks/bench_hot_paths.py --filter wifi
+"""
+
+from collections import deque
+import argparse
+import contextlib
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'hot_paths.json')
+
+
+# Corpus of real packets
+PACKETS = {
+    'login': bytes.fromhex('78780d010359339075016807420d0a'),
+    'setup': bytes.fromhex('787801570d0a'),
+    'gps': bytes.fromhex('78781610140a0b0c0d0ec5027ac8a80c4635300014d40d0a'),
+    'wifi': bytes.fromhex('78780569200101120000'
+                          'aabbccddeeff32a0b1c2d3e4f548112233445566509988776655443c0a0b0c0d0e0f41'
+                          '0300d0010340cacd5a0300fc9b640400608964'
+                          '0d0a'),
+    'status': bytes.fromhex('78780713500a1e00000d0a'),
+    'time': bytes.fromhex('787801300d0a'),
+    'interval': bytes.fromhex('787803980100780d0a'),
+}
+
+# Position answered by the stubbed geolocate()
+STUB_POSITION = {'location': {'lat': 48.85, 'lng': 2.35}, 'accuracy': 25.0}
+
+
+class StubSocket():
+    """
+    Stand-in for the client socket.
+    """
+
+    def send(self, data, flags=0):
+        return(len(data))
+
+
+class StubLogWriter():
+    """
+    Stand-in for the log writer of the server: lines are only queued.
+    """
+
+    def __init__(self):
+        self.lines = deque(maxlen=1000)
+
+    def write(self, filename, line):
+        self.lines.append((filename, time.time(), line))
+
+
+def load_server(directory):
+    """
+    Imports gps_tcp_server.py with its files in a temporary directory and
+    geolocate() stubbed, and returns the module and the session of a logged-in client.
+    """
+    os.environ.update({
+        'GMAPS_API_KEY': os.getenv('GMAPS_API_KEY', 'AIza-benchmark-key-not-used'),
+        'GEOCACHE_PATH': os.path.join(directory, 'geocache.sqlite'),
+        'FINGERPRINT_INDEX_PATH': os.path.join(directory, 'fingerprints.bin'),
+        'BSSID_LEARNER_PATH': os.path.join(directory, 'bssids.sqlite'),
+        'POSITION_STORE_PATH': os.path.join(directory, 'positions'),
+        'POSITION_SIMPLIFIED_PATH': os.path.join(directory, 'positions-simplified'),
+        'SESSION_REGISTRY_PATH': os.path.join(directory, 'sessions.sqlite'),
+        'COMMAND_QUEUE_PATH': os.path.join(directory, 'commands.sqlite'),
+        'GEOFENCES_PATH': os.path.join(directory, 'geofences.json'),
+        'OPENCELLID_PATH': os.path.join(directory, 'opencellid.sqlite'),
+    })
+    sys.path.insert(0, REPO_DIR)
+    import gps_tcp_server as server
+
+    server.log_writer.close()
+    server.log_writer = StubLogWriter()
+    server.geolocate = lambda positionDict, callback: callback(STUB_POSITION)
+
+    session = server.Session(StubSocket(), ('127.0.0.1', 50000), server.FrameDecoder(), server.codec.ResponseBuilder())
+    server.read_incoming_packet(session, PACKETS['login'])
+    return(server, session)
+
+
+def benchmarks(server, session):
+    """
+    Returns the benchmarks as a dictionary of name: function without arguments.
+    """
+    codec = server.codec
+    records = { name: codec.decode_frame(packet) for name, packet in PACKETS.items() }
+    response = server.make_content_response(session, 0x10, records['gps'].raw_datetime, forceLengthToValue=0)
+    response = bytes(response)
+
+    cases = {}
+    for name, packet in PACKETS.items():
+        cases['read_incoming_packet[%s]' % name] = (lambda packet=packet: server.read_incoming_packet(session, packet))
+    cases['decode_frame[gps]'] = lambda: codec.decode_frame(PACKETS['gps'])
+    cases['decode_frame[wifi]'] = lambda: codec.decode_frame(PACKETS['wifi'])
+    cases['answer_gps'] = lambda: server.answer_gps(session, records['gps'])
+    cases['answer_wifi_lbs'] = lambda: server.answer_wifi_lbs(session, records['wifi'])
+    cases['answer_time'] = lambda: server.answer_time(session, records['time'])
+    cases['get_hexified_datetime[truncated]'] = lambda: server.get_hexified_datetime(truncatedYear=True)
+    cases['get_hexified_datetime[full]'] = lambda: server.get_hexified_datetime(truncatedYear=False)
+    cases['make_content_response'] = lambda: server.make_content_response(session, 0x10, records['gps'].raw_datetime, forceLengthToValue=0)
+    cases['send_response'] = lambda: server.send_response(session, response)
+    return(cases)
+
+
+def calibration():
+    """
+    Fixed pure-Python workload, timed to make baselines portable.
+    """
+    d = {}
+    for i in range(200):
+        d[i % 17] = d.get(i % 17, 0) + i
+    return(d)
+
+
+def iterations(function, target):
+    """
+    Number of calls of a function that take about target seconds.
+    """
+    n = 1
+    while (True):
+        start = time.perf_counter()
+        for i in range(n):
+            function()
+        elapsed = time.perf_counter() - start
+        if (elapsed >= target / 10):
+            return(max(1, int(n * target / elapsed)))
+        n *= 10
+
+
+def time_ns(function, repeat=15, target=0.02):
+    """
+    Returns the best time of one call in ns, and the best ratio of that time
+    to the time of the calibration loop. Each run of the function follows a
+    run of the calibration loop, so that the ratio does not depend on the
+    speed of the machine at that moment.
+    """
+    n = iterations(function, target)
+    n_calibration = iterations(calibration, target)
+    best = None
+    best_ratio = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(n_calibration):
+            calibration()
+        reference = (time.perf_counter() - start) / n_calibration
+        start = time.perf_counter()
+        for i in range(n):
+            function()
+        elapsed = (time.perf_counter() - start) / n
+        best = elapsed if best is None else min(best, elapsed)
+        best_ratio = elapsed / reference if best_ratio is None else min(best_ratio, elapsed / reference)
+    return(best * 1e9, best_ratio)
+
+
+def memory(function, n=2000):
+    """
+    Returns the retained blocks per call and the peak bytes of one call.
+    """
+    gc.collect()
+    before = sys.getallocatedblocks()
+    for i in range(n):
+        function()
+    gc.collect()
+    blocks = (sys.getallocatedblocks() - before) / n
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    function()
+    peak = tracemalloc.get_traced_memory()[1] - start
+    tracemalloc.stop()
+    return(blocks, peak)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--save', action='store_true', help='store the results as the new baselines')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown relative to the baselines')
+    parser.add_argument('--blocks-threshold', type=float, default=0.5, help='allowed extra retained blocks per operation')
+    parser.add_argument('--filter', default='', help='only run the benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_hot_paths_')
+    devnull = open(os.devnull, 'w')
+    with contextlib.redirect_stdout(devnull):
+        server, session = load_server(directory)
+        cases = benchmarks(server, session)
+
+    baselines = {}
+    if (os.path.exists(BASELINES_PATH)):
+        with open(BASELINES_PATH) as f:
+            baselines = json.load(f)
+
+    results = {}
+    regressions = []
+    print('%-36s %10s %9s %10s %10s' % ('benchmark', 'ns/op', 'blocks/op', 'peak B/op', 'vs base'))
+    for name, function in cases.items():
+        if (args.filter not in name):
+            continue
+        with contextlib.redirect_stdout(devnull):
+            # Warm up (caches, first allocation of buffers)
+            for i in range(100):
+                function()
+            ns, relative = time_ns(function)
+            blocks, peak = memory(function)
+        results[name] = {'ns': round(ns, 1), 'relative': round(relative, 4), 'blocks': round(blocks, 3), 'peak_bytes': peak}
+
+        comparison = ''
+        baseline = baselines.get('benchmarks', {}).get(name)
+        if (baseline is not None):
+            ratio = relative / baseline['relative']
+            comparison = '%+.0f%%' % ((ratio - 1) * 100)
+            if (ratio > 1 + args.threshold or blocks > baseline['blocks'] + args.blocks_threshold):
+                comparison += ' REGRESSION'
+                regressions.append(name)
+        print('%-36s %10.0f %9.2f %10d %10s' % (name, ns, blocks, peak, comparison))
+
+    if (args.save):
+        os.makedirs(os.path.dirname(BASELINES_PATH), exist_ok=True)
+        saved = baselines.get('benchmarks', {})
+        saved.update(results)
+        with open(BASELINES_PATH, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'benchmarks': saved}, f, indent=2, sort_keys=True)
+        print('Baselines saved to', BASELINES_PATH)
+    elif (regressions):
+        print('Regressions:', ', '.join(regressions))
+        sys.exit(1)
@@ -0,0 +1,112 @@
+#!/bin/python
+
+"""
+Benchmark of the memory held by idle tracker connections.
+
+This script starts gps_tcp_server.py in a subprocess (in 'threads' or
+'asyncio' mode), opens N connections that each send a single login packet
+and then stay idle, like 2G devices between two positions.
+The resident memory (RSS) of the server is read from /proc before and after
+the connections are opened, which gives the memory cost per connection.
+
+Usage:
+    python benchmarks/bench_idle_connections.py --mode asyncio --connections 20000
+    python benchmarks/bench_idle_connections.py --mode threads --connections 5000
+"""
+
+import argparse
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Login packet of a real device (see identify_packet_standalone.py)
+LOGIN_PACKET = bytes.fromhex('78780d010359339075016807420d0a')
+
+
+def read_rss_kb(pid):
+    """
+    Returns the resident memory of a process, in kB.
+    """
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if (line.startswith('VmRSS:')):
+                return(int(line.split()[1]))
+    return(0)
+
+
+def wait_for_port(port, timeout=10):
+    """
+    Waits until the server accepts connections.
+    """
+    deadline = time.monotonic() + timeout
+    while (time.monotonic() < deadline):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Server did not start listening on port %d' % port)
+
+
+def raise_fd_limit(n):
+    """
+    Each connection needs a file descriptor, both here and in the server.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, max(soft, n + 1024))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def run(mode, n_connections, port):
+    raise_fd_limit(n_connections)
+    env = dict(os.environ, SERVER_MODE=mode, SERVER_PORT=str(port))
+    env.setdefault('GMAPS_API_KEY', 'AIza-benchmark-key-not-used')
+    server = subprocess.Popen([sys.executable, 'gps_tcp_server.py'], cwd=REPO_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    clients = []
+    try:
+        wait_for_port(port)
+        time.sleep(0.5)
+        rss_before = read_rss_kb(server.pid)
+
+        # Open all connections and log in, then read the acknowledgement
+        start = time.monotonic()
+        for i in range(n_connections):
+            client = socket.create_connection(('127.0.0.1', port))
+            client.sendall(LOGIN_PACKET)
+            clients.append(client)
+        for client in clients:
+            client.recv(64)
+        elapsed = time.monotonic() - start
+
+        time.sleep(1)
+        rss_after = read_rss_kb(server.pid)
+        per_connection = (rss_after - rss_before) * 1024 / n_connections
+
+        print('Mode                 :', mode)
+        print('Connections          :', n_connections)
+        print('Connect + login time : %.2f s' % elapsed)
+        print('Server RSS before    : %d kB' % rss_before)
+        print('Server RSS after     : %d kB' % rss_after)
+        print('Memory per connection: %.0f bytes' % per_connection)
+
+    finally:
+        for client in clients:
+            client.close()
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure server memory per idle connection.')
+    parser.add_argument('--mode', choices=['threads', 'asyncio'], default='asyncio')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=15023)
+    args = parser.parse_args()
+    run(args.mode, args.connections, args.port)
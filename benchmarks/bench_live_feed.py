@@ -0,0 +1,181 @@
+#!/bin/python
+
+"""
+Benchmark of the live feed (see live_feed.py): a fleet of devices publishes
+positions while hundreds of viewers follow them over SSE, some of them all
+devices, most of them a single device, and some of them too slow to keep
+up (they never read). It reports:
+    - the cost of publishing a position for the connections of the devices,
+      without and with the subscribers,
+    - the messages received by the viewers that read, and their latency,
+    - the messages coalesced and dropped for the slow viewers, whose queues
+      stay bounded,
+compared with a naive broadcast (as in resources/python_chat_server.py),
+which encodes the message for each viewer and writes it to every socket
+from the connection of the device: it costs the connection every write,
+and blocks it on the first viewer that does not read.
+
+Usage:
+    python benchmarks/bench_live_feed.py --subscribers 500 --devices 1000 --events 4000 --rate 200
+"""
+
+import argparse
+import math
+import os
+import random
+import selectors
+import socket
+import sys
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from live_feed import LiveFeed, encode_event, start_http_server
+from position_store import Position
+
+IMEI_BASE = 359339075000000
+
+
+def subscribe(port, query):
+    # Opens an SSE stream of the feed, and returns its socket once the headers are read
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(('GET /live%s HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n' % query).encode())
+    headers = b''
+    while (b'\r\n\r\n' not in headers):
+        headers += sock.recv(1)
+    return(sock)
+
+
+class Reader(threading.Thread):
+    """
+    Reads the streams of the viewers that keep up, and measures the latency
+    of the messages (from the timestamp of the position, set when it was
+    published).
+    """
+
+    def __init__(self, socks):
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        for sock in socks:
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, [b''])
+        self.messages = 0
+        self.latencies = []
+        self.running = True
+
+    def run(self):
+        while (self.running):
+            for key, mask in self.selector.select(0.1):
+                try:
+                    data = key.data[0] + key.fileobj.recv(65536)
+                except BlockingIOError:
+                    continue
+                *messages, key.data[0] = data.split(b'\n\n')
+                now = time.time()
+                for message in messages:
+                    i = message.find(b'"timestamp":')
+                    if (i < 0):
+                        continue
+                    self.messages += 1
+                    if (self.messages % 50 == 0):
+                        self.latencies.append(now - float(message[i + 12:message.index(b',', i)]))
+
+
+def positions(rng, devices, n):
+    result = []
+    for i in range(n):
+        imei = IMEI_BASE + rng.randrange(devices)
+        result.append(Position(0.0, imei, 'GPS', 1, 48.8 + rng.random() / 10, 2.3 + rng.random() / 10, math.nan, 10.0, 90.0))
+    return(result)
+
+
+def publish_all(feed, events, rate, burst=10):
+    # Publishes the positions at a rate (per second), as the connections of the devices would, in bursts (the first
+    # calls after a sleep are slower); returns the time per publish, elapsed (including waits for the GIL, held by
+    # the other threads) and on the CPU of the publishing thread
+    spent = 0.0
+    cpu = 0.0
+    start = time.perf_counter()
+    for i in range(0, len(events), burst):
+        t0 = time.perf_counter()
+        c0 = time.thread_time()
+        for position in events[i:i + burst]:
+            now = time.time()
+            feed.publish('position', position.imei, position._replace(timestamp=now), now)
+        cpu += time.thread_time() - c0
+        spent += time.perf_counter() - t0
+        delay = start + (i + burst) / rate - time.perf_counter()
+        if (delay > 0):
+            time.sleep(delay)
+    return(spent / len(events), cpu / len(events))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return(values[min(len(values) - 1, int(p / 100 * len(values)))] if values else math.nan)
+
+
+def run(n_subscribers, devices, n_events, slow_share, rate):
+    rng = random.Random(1)
+    events = positions(rng, devices, n_events)
+
+    # Live feed, without subscribers
+    feed = LiveFeed(max_queue=devices)
+    spent, cpu = publish_all(feed, events, rate)
+    print('Publish without subscribers: %.2f us/event (%.2f us on its CPU), at %d events/s' % (1e6 * spent, 1e6 * cpu, rate))
+
+    feed = LiveFeed(max_queue=devices)
+    server = start_http_server(feed, 0)
+    port = server.server_address[1]
+    fast, slow = [], []
+    for i in range(n_subscribers):
+        query = ('' if i % 5 == 0 else '?imei=%d' % (IMEI_BASE + rng.randrange(devices)))
+        (slow if i < n_subscribers * slow_share else fast).append(subscribe(port, query))
+    reader = Reader(fast)
+    reader.start()
+    time.sleep(0.5)
+
+    spent, cpu = publish_all(feed, events, rate)
+    time.sleep(1.0)
+    reader.running = False
+    stats = feed.stats()
+    print('Publish with %d subscribers (%d slow): %.2f us/event (%.2f us on its CPU), at %d events/s' % (n_subscribers, len(slow), 1e6 * spent, 1e6 * cpu, rate))
+    print('Viewers that read: %d messages, latency p50 = %.1f ms, p99 = %.1f ms' % (reader.messages, 1e3 * percentile(reader.latencies, 50), 1e3 * percentile(reader.latencies, 99)))
+    print('Messages queued: %d, coalesced: %d, dropped: %d (queues bounded to %d devices)' % (stats['sent'], stats['coalesced'], stats['dropped'], devices))
+    server.shutdown()
+
+    # Naive broadcast: encoded for each viewer, written to every socket by the connection of the device
+    pairs = [ socket.socketpair() for i in range(n_subscribers) ]
+    # (fewer events than the buffers of the sockets hold, as if the viewers read them)
+    sample = events[:100]
+    start = time.perf_counter()
+    for i, position in enumerate(sample):
+        for a, b in pairs:
+            a.sendall(encode_event('position', position.imei, 0.0, position, i))
+    print('Naive broadcast to %d viewers that read: %.0f us/event' % (n_subscribers, 1e6 * (time.perf_counter() - start) / len(sample)))
+
+    # ... and with one viewer that does not read
+    a, b = socket.socketpair()
+    a.settimeout(1.0)
+    start = time.perf_counter()
+    sent = 0
+    try:
+        while (True):
+            a.sendall(encode_event('position', events[0].imei, 0.0, events[0], sent))
+            sent += 1
+    except socket.timeout:
+        pass
+    print('Naive broadcast with a viewer that does not read: blocked after %d events, for %.1f s (until a timeout)' % (sent, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the live feed with many subscribers.')
+    parser.add_argument('--subscribers', type=int, default=500)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=4000)
+    parser.add_argument('--slow', type=float, default=0.2, help='share of the subscribers that never read')
+    parser.add_argument('--rate', type=float, default=200, help='positions published per second')
+    args = parser.parse_args()
+    run(args.subscribers, args.devices, args.events, args.slow, args.rate)
@@ -0,0 +1,101 @@
+#!/bin/python
+
+"""
+Benchmark of the cost of the console log (see serverlog.py) on the packet
+throughput of the server.
+
+A mix of real packets (GPS, WiFi/LBS, status, time) goes through the
+complete receive path of a connection in 'asyncio' mode (frame decoding,
+handling, response, log lines), offline as in bench_hot_paths.py. The
+packet rate is measured at each log level, with stdout sent:
+    - to /dev/null,
+    - to a pipe, line buffered (a terminal, or journald), read by another process.
+The time to write the queued events is included: the log is drained before
+the clock stops.
+
+Before the console log, the server printed about 10 lines per packet: at the
+same rate of packets, this was about the DEBUG level with synchronous writes.
+
+Usage:
+    python benchmarks/bench_logging.py --packets 5000
+"""
+
+from threading import get_ident
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_hot_paths import PACKETS, load_server
+
+
+# Packets sent by a device, in proportion
+MIX = ['gps', 'gps', 'gps', 'wifi', 'wifi', 'status', 'time']
+# Login of another device than the one of load_server()
+LOGIN_PACKET = bytes.fromhex('78780d010359339075016808420d0a')
+
+
+class StubTransport():
+    """
+    Stand-in for the transport of the connection.
+    """
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def measure(server, protocol, n_packets, level):
+    serverlog = server.serverlog
+    # Without rate limit: all the events of the level are written
+    serverlog.configure(level=level, rate=0)
+    packets = [ PACKETS[name] for name in MIX ]
+    start = time.perf_counter()
+    for i in range(n_packets):
+        protocol.data_received(packets[i % len(packets)])
+    # Write what is still queued
+    serverlog.stop()
+    sys.stdout.flush()
+    return(n_packets / (time.perf_counter() - start))
+
+
+def run(n_packets):
+    server, session = load_server(tempfile.mkdtemp())
+    protocol = server.TrackerProtocol()
+    protocol.transport = StubTransport()
+    protocol.thread = get_ident()
+    protocol.session = server.Session(protocol, ('127.0.0.1', 50001), server.FrameDecoder(), server.codec.ResponseBuilder())
+    protocol.data_received(LOGIN_PACKET)
+
+    stdout = sys.stdout
+    results = []
+    for output in ('/dev/null', 'pipe'):
+        for level in ('DEBUG', 'INFO', 'WARNING'):
+            if (output == 'pipe'):
+                reader = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+                sys.stdout = io.TextIOWrapper(reader.stdin, line_buffering=True)
+            else:
+                sys.stdout = open(os.devnull, 'w')
+            rate = max(measure(server, protocol, n_packets, level) for i in range(3))
+            sys.stdout.close()
+            sys.stdout = stdout
+            if (output == 'pipe'):
+                reader.wait()
+            results.append((output, level, rate))
+
+    print('%-10s %-8s %12s %12s' % ('Output', 'Level', 'packets/s', 'us/packet'))
+    for output, level, rate in results:
+        print('%-10s %-8s %12.0f %12.1f' % (output, level, rate, 1e6 / rate))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the cost of the console log on the packet throughput.')
+    parser.add_argument('--packets', type=int, default=5000)
+    args = parser.parse_args()
+    run(args.packets)
@@ -0,0 +1,99 @@
+#!/bin/python
+
+"""
+Benchmark of the offline cell tower database (opencellid.py).
+
+Writes a synthetic OpenCellID CSV file of N cells (or uses a real one),
+imports it, then looks up random known and unknown cells, and locates
+random scans of 1 to 7 cells as a 0x17/0x69 packet would carry.
+Reports import time, database size and lookup latency.
+
+Usage:
+    python benchmarks/bench_opencellid.py --cells 1000000
+    python benchmarks/bench_opencellid.py --csv cell_towers.csv.gz --mcc 208
+"""
+
+import argparse
+import gzip
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from opencellid import CellDatabase, import_csv
+
+
+def write_csv(path, n, rng):
+    # Same columns as the OpenCellID export, a few radio types and French-like carriers
+    cells = []
+    with gzip.open(path, 'wt', compresslevel=1) as f:
+        f.write('radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal\n')
+        for i in range(n):
+            cell = (rng.choice((208, 208, 208, 234, 262)), rng.choice((1, 10, 15, 20)), rng.randint(1, 65535), rng.randint(1, 65535))
+            radio = 'GSM' if (rng.random() < 0.8) else 'UMTS'
+            f.write('%s,%d,%d,%d,%d,0,%.6f,%.6f,%d,%d,1,1459692000,1596000000,0\n' % (radio, cell[0], cell[1], cell[2], cell[3],
+                rng.uniform(-5, 8), rng.uniform(42, 51), rng.randint(100, 5000), rng.randint(1, 200)))
+            if (radio == 'GSM' and len(cells) < 100000):
+                cells.append(cell)
+    return(cells)
+
+
+def percentiles(timings):
+    timings.sort()
+    return(timings[len(timings) // 2] * 1e6, timings[int(len(timings) * 0.99)] * 1e6)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cells', type=int, default=1000000, help='number of synthetic cells')
+    parser.add_argument('--csv', help='real OpenCellID CSV file to import instead')
+    parser.add_argument('--mcc', action='append', help='only import cells of this MCC (repeatable)')
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(5023)
+    directory = tempfile.mkdtemp(prefix='bench_opencellid_')
+    db_path = os.path.join(directory, 'opencellid.sqlite')
+    csv_path = args.csv
+    known = []
+    if (csv_path is None):
+        csv_path = os.path.join(directory, 'cell_towers.csv.gz')
+        start = time.monotonic()
+        known = write_csv(csv_path, args.cells, rng)
+        print('Generated %d cells in %.1f s (%.1f MB gzipped)' % (args.cells, time.monotonic() - start, os.path.getsize(csv_path) / 1e6))
+
+    start = time.monotonic()
+    count = import_csv(csv_path, db_path, mccs=args.mcc)
+    elapsed = time.monotonic() - start
+    size = os.path.getsize(db_path)
+    print('Import: %d cells in %.1f s (%.0f cells/s), database = %.1f MB (%.0f B/cell)' % (count, elapsed, count / elapsed, size / 1e6, size / max(count, 1)))
+
+    database = CellDatabase(db_path)
+    if (not known):
+        known = database._db.execute('SELECT mcc, mnc, lac, cid FROM cells ORDER BY random() LIMIT 100000').fetchall()
+
+    timings = []
+    for i in range(args.lookups):
+        cell = known[rng.randrange(len(known))]
+        start = time.perf_counter()
+        database.lookup(*cell)
+        timings.append(time.perf_counter() - start)
+    print('Lookup (known cell):   p50 = %.1f us, p99 = %.1f us' % percentiles(timings))
+
+    timings = []
+    for i in range(args.lookups):
+        start = time.perf_counter()
+        database.lookup(999, 99, rng.randint(1, 65535), rng.randint(1, 65535))
+        timings.append(time.perf_counter() - start)
+    print('Lookup (unknown cell): p50 = %.1f us, p99 = %.1f us' % percentiles(timings))
+
+    timings = []
+    for i in range(args.lookups // 10):
+        mcc, mnc = known[rng.randrange(len(known))][:2]
+        cells = [ {'locationAreaCode': c[2], 'cellId': c[3], 'signalStrength': rng.randint(-110, -50)} for c in rng.sample(known, rng.randint(1, 7)) ]
+        start = time.perf_counter()
+        database.locate(mcc, mnc, cells)
+        timings.append(time.perf_counter() - start)
+    print('Locate (1-7 cells):    p50 = %.1f us, p99 = %.1f us' % percentiles(timings))
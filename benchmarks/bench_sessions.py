@@ -0,0 +1,106 @@
+#!/bin/python
+
+"""
+Benchmark of the memory held by the sessions of the server.
+
+This script creates N sessions (see session.py) of devices that logged in
+and sent a position, and measures the memory they hold with tracemalloc,
+next to the dictionaries of strings the server used to keep for each
+connection (addresses and positions, keyed by socket). The sessions of
+devices that disconnected are measured too, without their buffers.
+Devices then reconnect R times each, through a SessionTable: the memory
+held by the table must not grow with the number of connections.
+
+Usage:
+    python benchmarks/bench_sessions.py --sessions 20000 --reconnections 5
+"""
+
+import argparse
+import math
+import os
+import sys
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from session import Session, SessionTable
+from framing import FrameDecoder
+import codec
+
+
+FIRST_IMEI = 359339075000000
+
+
+class StubSocket():
+    """
+    Stand-in for the client socket (not measured).
+    """
+    pass
+
+
+def measure(build, n):
+    """
+    Builds n objects and returns them with the memory they hold, in bytes.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [ build(i) for i in range(n) ]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return(objects, after - before)
+
+
+def dict_entry(i):
+    # What the server kept for a connection before sessions: two dictionaries of strings
+    client = StubSocket()
+    address = {'address': ('127.0.0.1', 40000 + i % 20000), 'decoder': FrameDecoder(), 'builder': codec.ResponseBuilder(),
+               'imei': str(FIRST_IMEI + i), 'software_version': '66'}
+    position = {'gps': {'method': 'GPS', 'valid': '1', 'latitude': '48.%06d' % i, 'longitude': '2.%06d' % i,
+                        'accuracy': '', 'speed': '0', 'heading': '212', 'satellites': '5'}}
+    return((client, address, position))
+
+
+def session_entry(i):
+    session = Session(StubSocket(), ('127.0.0.1', 40000 + i % 20000), FrameDecoder(), codec.ResponseBuilder())
+    session.imei = FIRST_IMEI + i
+    session.software_version = 66
+    session.set_fix(1700000000.0 + i, 'GPS', 1, 48.0 + i / 1e6, 2.0 + i / 1e6, math.nan, 0.0, 212.0, 5)
+    return(session)
+
+
+def detached_entry(i):
+    session = session_entry(i)
+    session.detach()
+    return(session)
+
+
+def run(n_sessions, n_reconnections):
+    print('Sessions             :', n_sessions)
+    for name, build in (('socket dictionaries', dict_entry), ('session', session_entry), ('detached session', detached_entry)):
+        objects, size = measure(build, n_sessions)
+        print('%-21s: %.0f bytes per device' % (name.capitalize(), size / n_sessions))
+        del objects
+
+    # Reconnections: each device opens a new session, the previous one is closed
+    table = SessionTable()
+    tracemalloc.start()
+    held = []
+    for round in range(n_reconnections + 1):
+        for i in range(n_sessions):
+            session = session_entry(i)
+            previous = table.login(session, session.imei)
+            if (previous is not None):
+                table.close(previous)
+        held.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+    print('Table sessions       :', len(table), 'after', (n_reconnections + 1) * n_sessions, 'connections')
+    print('Table memory         :', ', '.join('%.1f MB' % (size / 1e6) for size in held))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the memory held by sessions.')
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--reconnections', type=int, default=3)
+    args = parser.parse_args()
+    run(args.sessions, args.reconnections)
@@ -0,0 +1,98 @@
+#!/bin/python
+
+"""
+Benchmark of the timer wheel holding the idle timeouts of the connections.
+
+This script schedules N timers spread over the timeout of the connections,
+then runs the wheel tick by tick for that duration, while connections are
+rescheduled (as the reaper does when their deadline was pushed back) and
+some are cancelled (closed connections). The same workload is run on a
+heap (heapq, with cancelled timers left in place), for comparison.
+
+Usage:
+    python benchmarks/bench_timer_wheel.py --timers 50000 --timeout 1800
+"""
+
+import argparse
+import heapq
+import os
+import random
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from timer_wheel import TimerWheel
+
+
+def workload(n_timers, timeout):
+    # Initial deadlines, then at each tick: keys rescheduled and keys cancelled
+    random.seed(1)
+    deadlines = [ random.uniform(0, timeout) for i in range(n_timers) ]
+    ticks = []
+    for tick in range(timeout):
+        ticks.append(([ random.randrange(n_timers) for i in range(n_timers // timeout) ],
+                      [ random.randrange(n_timers) for i in range(n_timers // timeout // 10) ]))
+    return(deadlines, ticks)
+
+
+def run_wheel(deadlines, ticks, timeout):
+    wheel = TimerWheel(1.0)
+    start = time.perf_counter()
+    for key, deadline in enumerate(deadlines):
+        wheel.schedule(key, deadline)
+    scheduled = time.perf_counter()
+    expired = 0
+    for tick, (rescheduled, cancelled) in enumerate(ticks):
+        expired += len(wheel.advance(tick))
+        for key in rescheduled:
+            wheel.schedule(key, tick + timeout)
+        for key in cancelled:
+            wheel.cancel(key)
+    end = time.perf_counter()
+    return(scheduled - start, end - scheduled, expired)
+
+
+def run_heap(deadlines, ticks, timeout):
+    # Timers are (deadline, key) entries; a key's latest deadline is the valid one
+    heap = []
+    current = {}
+    start = time.perf_counter()
+    for key, deadline in enumerate(deadlines):
+        heapq.heappush(heap, (deadline, key))
+        current[key] = deadline
+    scheduled = time.perf_counter()
+    expired = 0
+    for tick, (rescheduled, cancelled) in enumerate(ticks):
+        while (heap and heap[0][0] <= tick):
+            deadline, key = heapq.heappop(heap)
+            if (current.get(key) == deadline):
+                del current[key]
+                expired += 1
+        for key in rescheduled:
+            heapq.heappush(heap, (tick + timeout, key))
+            current[key] = tick + timeout
+        for key in cancelled:
+            current.pop(key, None)
+    end = time.perf_counter()
+    return(scheduled - start, end - scheduled, expired)
+
+
+def run(n_timers, timeout):
+    deadlines, ticks = workload(n_timers, timeout)
+    operations = sum(len(rescheduled) + len(cancelled) for rescheduled, cancelled in ticks)
+    print('Timers               :', n_timers)
+    print('Ticks                :', timeout, '(%d reschedules or cancels)' % operations)
+    for name, function in (('Timer wheel', run_wheel), ('Heap', run_heap)):
+        schedule_time, run_time, expired = function(deadlines, ticks, timeout)
+        print('%-21s: %.2f us per schedule, %.1f us per tick, %d expired' % (name, 1e6 * schedule_time / n_timers,
+            1e6 * run_time / timeout, expired))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the cost of the timer wheel.')
+    parser.add_argument('--timers', type=int, default=50000)
+    parser.add_argument('--timeout', type=int, default=1800)
+    args = parser.parse_args()
+    run(args.timers, args.timeout)
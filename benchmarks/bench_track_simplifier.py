@@ -0,0 +1,157 @@
+#!/bin/python
+
+"""
+Benchmark of the simplified tier of the position store (see
+track_simplifier.py), on synthetic days of a tracker:
+    - at home and at work (GPS every 3 minutes, with jitter, and WiFi
+      positions with their accuracy), driving between them (GPS every
+      10 seconds), as in the sample logs,
+    - written to a TieredStore, against a plain PositionStore.
+It reports the records and bytes of each tier, the largest error of the
+simplified track (distance from each raw position to the simplified track at
+the same time, against its tolerance), the cost of ingest, and the time to
+read the track of the device over the days.
+Compaction of the raw tier is checked at the end.
+
+Usage:
+    python benchmarks/bench_track_simplifier.py --days 30 --tolerance 25
+"""
+
+import argparse
+import bisect
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from position_store import Position, PositionStore, RECORD
+from track_simplifier import METERS_PER_DEGREE, TieredStore
+
+IMEI = 359339075016807
+HOME = (23.111773, 114.404293)
+WORK = (23.152490, 114.452117)
+
+
+def offset(origin, north, east):
+    # Position at north and east meters from origin
+    return(origin[0] + north / METERS_PER_DEGREE, origin[1] + east / (METERS_PER_DEGREE * math.cos(math.radians(origin[0]))))
+
+
+def stay(positions, place, start, end, rng):
+    t = start
+    while (t < end):
+        if (rng.random() < 0.2):
+            accuracy = rng.uniform(30, 80)
+            latitude, longitude = offset(place, rng.gauss(0, accuracy / 2), rng.gauss(0, accuracy / 2))
+            positions.append(Position(t, IMEI, 'LBS-GSM-WIFI', 1, latitude, longitude, accuracy, math.nan, math.nan))
+        else:
+            latitude, longitude = offset(place, rng.gauss(0, 6), rng.gauss(0, 6))
+            positions.append(Position(t, IMEI, 'GPS', 1, latitude, longitude, 0.0, 0.0, rng.randrange(360)))
+        t += 180
+
+
+def drive(positions, origin, destination, start, duration, rng):
+    # Along a bent road: half way through, the route turns
+    corner = (origin[0], destination[1])
+    for i in range(int(duration // 10)):
+        f = i * 10 / duration
+        a, b, g = ((origin, corner, 2 * f) if f < 0.5 else (corner, destination, 2 * f - 1))
+        latitude = a[0] + (b[0] - a[0]) * g
+        longitude = a[1] + (b[1] - a[1]) * g
+        latitude, longitude = offset((latitude, longitude), rng.gauss(0, 4), rng.gauss(0, 4))
+        positions.append(Position(start + i * 10, IMEI, 'GPS', 1, latitude, longitude, 0.0, 50.0, 90.0))
+
+
+def synthetic_days(days, start, rng):
+    positions = []
+    for day in range(days):
+        t = start + day * 86400
+        stay(positions, HOME, t, t + 8 * 3600, rng)
+        drive(positions, HOME, WORK, t + 8 * 3600, 1800, rng)
+        stay(positions, WORK, t + 8.5 * 3600, t + 17.5 * 3600, rng)
+        drive(positions, WORK, HOME, t + 17.5 * 3600, 1800, rng)
+        stay(positions, HOME, t + 18 * 3600, t + 24 * 3600, rng)
+    return(positions)
+
+
+def max_error(raw, simplified, tolerance):
+    """
+    Largest distance from a raw position to the simplified track at its
+    time, relative to its tolerance (at most 1 if the bound holds).
+    """
+    times = [ p.timestamp for p in simplified ]
+    worst = (0.0, 0.0)
+    for p in raw:
+        i = bisect.bisect_left(times, p.timestamp)
+        if (i < len(times) and times[i] == p.timestamp):
+            continue
+        a, b = simplified[i - 1], simplified[i]
+        f = (p.timestamp - a.timestamp) / (b.timestamp - a.timestamp)
+        latitude = a.latitude + (b.latitude - a.latitude) * f
+        longitude = a.longitude + (b.longitude - a.longitude) * f
+        error = math.hypot((p.latitude - latitude) * METERS_PER_DEGREE, (p.longitude - longitude) * METERS_PER_DEGREE * math.cos(math.radians(latitude)))
+        worst = max(worst, (error / max(tolerance, p.accuracy), error))
+    return(worst)
+
+
+def run(days, tolerance, max_interval):
+    rng = random.Random(1)
+    # Days of the last month, so that they are within the raw retention
+    start = (int(time.time()) // 86400 - days) * 86400
+    positions = synthetic_days(days, start, rng)
+    directory = tempfile.mkdtemp()
+
+    plain = PositionStore(directory=os.path.join(directory, 'plain'))
+    t0 = time.perf_counter()
+    for p in positions:
+        plain.append(p.imei, p.timestamp, *p[2:])
+    plain_time = time.perf_counter() - t0
+    plain.close()
+
+    store = TieredStore(directory=os.path.join(directory, 'raw'), simplified_directory=os.path.join(directory, 'simplified'),
+        raw_retention=(days + 62) * 86400, tolerance=tolerance, max_interval=max_interval)
+    t0 = time.perf_counter()
+    for p in positions:
+        store.append(p.imei, p.timestamp, *p[2:])
+    store.flush()
+    tiered_time = time.perf_counter() - t0
+
+    raw = store.query(IMEI, -math.inf, math.inf, resolution='raw')
+    simplified = store.query(IMEI, -math.inf, math.inf, resolution='simplified')
+    assert len(raw) == len(positions)
+    relative, error = max_error(raw, simplified, tolerance)
+    assert relative <= 1.0 + 1e-6, relative
+
+    print('Positions over %d days: %d, simplified: %d (%.1f%%, %d per day)' % (days, len(raw), len(simplified), 100 * len(simplified) / len(raw), len(simplified) / days))
+    print('Storage: raw %d kB, simplified %d kB' % (len(raw) * RECORD.size // 1024, len(simplified) * RECORD.size // 1024))
+    print('Largest error: %.1f m (%.0f%% of its tolerance)' % (error, 100 * relative))
+    print('Ingest: %.1f us/position (plain store: %.1f us/position)' % (1e6 * tiered_time / len(positions), 1e6 * plain_time / len(positions)))
+    for resolution, tolerance_query in (('raw', 0), ('simplified', 0), ('simplified', 200)):
+        reader = TieredStore(directory=os.path.join(directory, 'raw'), simplified_directory=os.path.join(directory, 'simplified'), writable=False)
+        t0 = time.perf_counter()
+        track = reader.query(IMEI, -math.inf, math.inf, resolution=resolution, tolerance=tolerance_query)
+        elapsed = time.perf_counter() - t0
+        print('Track of %d days, %s%s: %d positions in %.1f ms' % (days, resolution, (' (tolerance %d m)' % tolerance_query if tolerance_query else ''), len(track), 1e3 * elapsed))
+
+    # Compaction, once the raw positions are past the retention
+    auto = store.query(IMEI, -math.inf, math.inf)
+    assert len(auto) == len(raw)
+    dropped = store.compact(now=time.time() + (days + 124) * 86400)
+    assert not store.raw.segments(IMEI)
+    assert [ p.timestamp for p in store.query(IMEI, -math.inf, math.inf) ] == [ p.timestamp for p in simplified ]
+    print('Compaction: %d months of raw positions dropped, the simplified track is left' % dropped)
+    store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the simplified tier of the position store.')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--tolerance', type=float, default=25)
+    parser.add_argument('--max-interval', type=float, default=3600)
+    args = parser.parse_args()
+    run(args.days, args.tolerance, args.max_interval)
@@ -0,0 +1,105 @@
+#!/bin/python
+
+"""
+Local stand-in for the Google Maps Geolocation API, for load tests.
+
+Answers POST /geolocation/v1/geolocate like the real API, after an
+injectable latency, with a position derived from the request (the same
+scan always gets the same position). A share of the requests can be
+answered with a 404 "notFound" error (scan that cannot be located, which
+the server caches), or with a 500 error (API failure, which the client
+retries and the circuit breaker of the server counts).
+GET /stats returns the number of requests received.
+
+Point the server to it with the GEOLOCATION_BASE_URL setting:
+    python benchmarks/fake_geolocation.py --port 8999 --latency 200 --errors 0.05
+    GEOLOCATION_BASE_URL=http://127.0.0.1:8999 python gps_tcp_server.py
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import argparse
+import hashlib
+import json
+import random
+import time
+
+
+class FakeGeolocationHandler(BaseHTTPRequestHandler):
+    """
+    Request handler; settings and counters are attributes of the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.requests += 1
+            draw = server.random.random()
+            delay = max(0, server.random.gauss(server.latency, server.jitter)) / 1000
+
+        time.sleep(delay)
+        if (draw < server.failure_rate):
+            status, answer = 500, {'error': {'errors': [{'reason': 'backendError'}], 'code': 500, 'message': 'Backend Error'}}
+        elif (draw < server.failure_rate + server.error_rate):
+            status, answer = 404, {'error': {'errors': [{'reason': 'notFound'}], 'code': 404, 'message': 'Not Found'}}
+        else:
+            digest = hashlib.sha1(body).digest()
+            status, answer = 200, {'location': {'lat': 48.8 + digest[0] / 2560, 'lng': 2.3 + digest[1] / 2560}, 'accuracy': 20.0 + digest[2]}
+        with server.lock:
+            server.answers[status] = server.answers.get(status, 0) + 1
+        self.send_json(status, answer)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.send_json(200, {'requests': self.server.requests, 'answers': self.server.answers})
+
+    def send_json(self, status, answer):
+        data = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port=0, latency=200, jitter=50, error_rate=0.0, failure_rate=0.0, seed=5023):
+    """
+    Starts the fake API in a background thread (latency and jitter in ms,
+    rates between 0 and 1) and returns its server; port 0 picks a free port.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeGeolocationHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.failure_rate = failure_rate
+    server.random = random.Random(seed)
+    server.lock = Lock()
+    server.requests = 0
+    server.answers = {}
+    Thread(target=server.serve_forever, daemon=True).start()
+    return(server)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Google Maps Geolocation API.')
+    parser.add_argument('--port', type=int, default=8999)
+    parser.add_argument('--latency', type=float, default=200, help='mean latency, in ms')
+    parser.add_argument('--jitter', type=float, default=50, help='standard deviation of the latency, in ms')
+    parser.add_argument('--errors', type=float, default=0.0, help='share of 404 (not found) answers')
+    parser.add_argument('--failures', type=float, default=0.0, help='share of 500 (backend error) answers')
+    args = parser.parse_args()
+
+    server = start(args.port, args.latency, args.jitter, args.errors, args.failures)
+    print('Fake geolocation API listening on port', server.server_address[1])
+    try:
+        while (True):
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(server.requests, 'requests:', server.answers)
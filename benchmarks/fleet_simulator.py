@@ -0,0 +1,418 @@
+#!/bin/python
+
+"""
+Load generator simulating a fleet of trackers connected to gps_tcp_server.py.
+
+N devices connect over TCP (from a single asyncio event loop), log in with
+their own IMEI and then either:
+    - send synthetic traffic: GPS positions (0x10), WiFi/LBS scans (0x69),
+      status (0x13) and time requests (0x30), each at a configurable
+      interval with some jitter. Scans are drawn from a few places per
+      device, as real devices come back to the same places,
+    - or replay the IN packets of a server_log.txt, device by device, with
+      the original gaps between packets divided by --speedup.
+Replies are decoded and checked against the packets they answer (protocol
+and echoed datetime, position for 0x69 scans), and their latency measured.
+
+Unless --target is given, the server is started in a subprocess, with its
+data files in a temporary directory and with the geolocation API replaced
+by the local stand-in of fake_geolocation.py (latency and errors can be
+injected). The report gives the throughput, p50/p99 reply latencies by
+packet type, reply errors and the RSS of the server (of all its processes
+with --workers).
+
+Usage:
+    python benchmarks/fleet_simulator.py --connections 2000 --duration 60 --mode asyncio
+    python benchmarks/fleet_simulator.py --connections 2000 --duration 60 --workers 4
+    python benchmarks/fleet_simulator.py --connections 500 --replay logs/server_log.txt --speedup 100
+    python benchmarks/fleet_simulator.py --target 127.0.0.1:5023 --server-pid 1234
+"""
+
+from collections import deque
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import codec
+import fake_geolocation
+from bench_idle_connections import raise_fd_limit, read_rss_kb, wait_for_port
+
+
+# Protocols answered by the server (0x13 status and 0x14 hibernation are not)
+ANSWERED = {0x01, 0x10, 0x11, 0x17, 0x30, 0x57, 0x69, 0x98}
+
+STATUS_PACKET = bytes.fromhex('78780713500a1e00000d0a')
+TIME_PACKET = bytes.fromhex('787801300d0a')
+
+
+def login_packet(imei):
+    """
+    Login packet of a device: IMEI as 16 BCD digits, then software version.
+    """
+    return(bytes.fromhex('78780d01%016d420d0a' % imei))
+
+
+def gps_packet(now, latitude, longitude, speed, heading):
+    """
+    GPS positioning packet (0x10), with a binary datetime at UTC.
+    """
+    t = time.gmtime(now)
+    flags = 0x1000 | (0x0400 if latitude >= 0 else 0) | (0x0800 if longitude < 0 else 0) | (int(heading) & 0x03FF)
+    content = codec.GPS_LAYOUT.pack(t.tm_year % 100, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, 0xC5,
+        int(abs(latitude) * codec.COORDINATE_DIVISOR), int(abs(longitude) * codec.COORDINATE_DIVISOR), int(speed), flags)
+    return(codec.encode_response(0x10, content))
+
+
+def wifi_lbs_packet(now, hotspots, mcc, mnc, cells):
+    """
+    WiFi/LBS packet (0x69): the length byte is the number of hotspots and
+    the datetime is BCD-encoded at UTC.
+    """
+    t = time.gmtime(now)
+    content = bytes.fromhex('%02d%02d%02d%02d%02d%02d' % (t.tm_year % 100, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec))
+    content += b''.join([ codec.WIFI_LAYOUT.pack(bssid, -rssi) for bssid, rssi in hotspots ])
+    content += codec.CARRIER_LAYOUT.pack(len(cells), mcc, mnc)
+    content += b''.join([ codec.CELL_LAYOUT.pack(lac, cell_id, -rssi) for lac, cell_id, rssi in cells ])
+    return(codec.encode_response(0x69, content, length=len(hotspots)))
+
+
+def split_replies(buffer):
+    """
+    Cuts the replies of the server out of a buffer: returns the complete
+    frames and the remaining bytes. FrameDecoder cannot be used here: the
+    server sends GPS and WiFi/LBS replies with a length byte of 0.
+    Those carry a 6-byte datetime, or for the second reply to 0x69 scans an
+    ASCII position that starts with its sign and ends with the stop bytes.
+    """
+    frames = []
+    start = buffer.find(codec.START)
+    while (start >= 0 and len(buffer) - start >= 4):
+        protocol = buffer[start + 3]
+        if (protocol == 0x69 and buffer[start + 4:start + 5] in (b'+', b'-')):
+            end = buffer.find(codec.STOP, start + 4)
+            end = (-1 if end < 0 else end + 2)
+        elif (protocol in (0x10, 0x11, 0x17, 0x69)):
+            end = start + 4 + 6 + 2
+        else:
+            end = start + 3 + buffer[start + 2] + 2
+        if (end < 0 or end > len(buffer)):
+            break
+        frames.append(buffer[start:end])
+        start = buffer.find(codec.START, end)
+    return(frames, (buffer[start:] if start >= 0 else b''))
+
+
+def read_replay_log(path):
+    """
+    Returns the IN packets of a server_log.txt, by IMEI, as lists of
+    (time in seconds, packet bytes).
+    """
+    devices = {}
+    for line in open(path):
+        fields = line.rstrip('\n').split('\t')
+        if (len(fields) < 5 or fields[3] != 'IN'):
+            continue
+        try:
+            timestamp = time.mktime(time.strptime(fields[0], '%Y/%m/%d %H:%M:%S'))
+            packet = bytes.fromhex(fields[4])
+        except ValueError:
+            continue
+        devices.setdefault(fields[2], []).append((timestamp, packet))
+    return([ packets for imei, packets in sorted(devices.items()) if packets ])
+
+
+class Statistics():
+    """
+    Counters and reply latencies of the whole fleet.
+    """
+
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.disconnected = 0
+        self.sent = {}
+        self.replies = 0
+        self.mismatches = 0
+        self.unexpected = 0
+        self.positions = 0
+        self.latencies = {}
+
+    def record(self, kind, latency):
+        self.latencies.setdefault(kind, []).append(latency)
+
+
+class Device():
+    """
+    A simulated tracker: sends packets and matches the replies of the server
+    with them (oldest pending packet of the same protocol first).
+    """
+
+    def __init__(self, number, args, statistics, rng):
+        self.imei = 860000000000000 + number
+        self.args = args
+        self.statistics = statistics
+        self.rng = rng
+        # Pending packets by protocol: (sent at, expected content or None, kind)
+        self.pending = {}
+        # 0x69 scans waiting for their position
+        self.pending_positions = deque()
+        self.writer = None
+
+        # Synthetic devices move around a few places, each with its hotspots and cells
+        self.latitude = 48.8 + rng.random() * 0.2
+        self.longitude = 2.2 + rng.random() * 0.3
+        self.places = []
+        for i in range(args.places):
+            hotspots = [ (rng.getrandbits(48).to_bytes(6, 'big'), rng.randint(-90, -45)) for j in range(rng.randint(3, 8)) ]
+            cells = [ (rng.randint(1, 65535), rng.randint(1, 65535), rng.randint(-110, -60)) for j in range(rng.randint(1, 4)) ]
+            self.places.append((hotspots, cells))
+
+    async def run(self, host, port, deadline, replay):
+        try:
+            reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.statistics.failed += 1
+            return
+        self.statistics.connected += 1
+        reading = asyncio.ensure_future(self.read(reader))
+        try:
+            self.send(login_packet(self.imei), 'login')
+            if (replay is not None):
+                await self.replay(replay, deadline)
+            else:
+                self.send(TIME_PACKET, 'time')
+                await self.simulate(deadline)
+            # Let the last replies come
+            await asyncio.sleep(self.args.grace)
+        except (ConnectionError, OSError):
+            self.statistics.disconnected += 1
+        finally:
+            reading.cancel()
+            self.writer.close()
+
+    def send(self, packet, kind, expected=None):
+        protocol = packet[3]
+        self.statistics.sent[kind] = self.statistics.sent.get(kind, 0) + 1
+        now = time.monotonic()
+        if (protocol in ANSWERED):
+            self.pending.setdefault(protocol, deque()).append((now, expected, kind))
+        if (protocol == 0x69):
+            self.pending_positions.append(now)
+        self.writer.write(packet)
+
+    async def simulate(self, deadline):
+        args = self.args
+        rng = self.rng
+        # First packet of each kind at a random time of its interval, so that devices do not send in sync
+        schedule = { kind: time.monotonic() + rng.random() * interval for kind, interval in
+                     (('gps', args.gps_interval), ('wifi', args.wifi_interval), ('status', args.status_interval)) if interval > 0 }
+        intervals = {'gps': args.gps_interval, 'wifi': args.wifi_interval, 'status': args.status_interval}
+        while (schedule):
+            kind, at = min(schedule.items(), key=lambda item: item[1])
+            if (at >= deadline):
+                return
+            await asyncio.sleep(max(0, at - time.monotonic()))
+            now = time.time()
+
+            if (kind == 'gps'):
+                self.latitude += rng.gauss(0, 0.0005)
+                self.longitude += rng.gauss(0, 0.0005)
+                packet = gps_packet(now, self.latitude, self.longitude, rng.randint(0, 30), rng.randint(0, 359))
+                self.send(packet, kind, bytes(packet[4:10]))
+            elif (kind == 'wifi'):
+                hotspots, cells = rng.choice(self.places)
+                # RSSI jitter, and a hotspot sometimes missing
+                scan = [ (bssid, max(-120, min(-1, rssi + rng.randint(-5, 5)))) for bssid, rssi in hotspots ]
+                if (len(scan) > 3 and rng.random() < 0.3):
+                    scan.pop(rng.randrange(len(scan)))
+                packet = wifi_lbs_packet(now, scan, 208, 1, cells)
+                self.send(packet, kind, bytes(packet[4:10]))
+            else:
+                self.send(STATUS_PACKET, kind)
+            await self.writer.drain()
+            schedule[kind] = at + intervals[kind] * (1 + rng.uniform(-args.jitter, args.jitter))
+
+    async def replay(self, packets, deadline):
+        # The login of the log was replaced by that of this device
+        packets = [ (t, p) for t, p in packets if len(p) > 3 and p[3] != 0x01 ]
+        if (not packets):
+            return
+        while (True):
+            previous = packets[0][0]
+            for timestamp, packet in packets:
+                await asyncio.sleep(max(0, timestamp - previous) / self.args.speedup)
+                previous = timestamp
+                if (time.monotonic() >= deadline):
+                    return
+                self.send(packet, 'replay-0x%02x' % packet[3], (bytes(packet[4:10]) if packet[3] in (0x10, 0x11, 0x17, 0x69) else None))
+                await self.writer.drain()
+
+    async def read(self, reader):
+        buffer = b''
+        while (True):
+            data = await reader.read(4096)
+            if (not data):
+                return
+            now = time.monotonic()
+            frames, buffer = split_replies(buffer + data)
+            for frame in frames:
+                self.statistics.replies += 1
+                self.match(frame, now)
+
+    def match(self, frame, now):
+        statistics = self.statistics
+        protocol = frame[3]
+        content = bytes(frame[4:-2])
+        if (protocol == 0x69 and b',' in content):
+            # Second reply to a scan: its position
+            try:
+                latitude, longitude = [ float(x) for x in content.split(b',') ]
+            except ValueError:
+                statistics.mismatches += 1
+                return
+            if (not self.pending_positions or not (-90 <= latitude <= 90 and -180 <= longitude <= 180)):
+                statistics.unexpected += 1
+                return
+            statistics.positions += 1
+            statistics.record('wifi-position', now - self.pending_positions.popleft())
+            return
+
+        pending = self.pending.get(protocol)
+        if (not pending):
+            statistics.unexpected += 1
+            return
+        sent_at, expected, kind = pending.popleft()
+        if (expected is not None and content != expected):
+            statistics.mismatches += 1
+        elif (protocol == 0x30 and len(content) != 7):
+            statistics.mismatches += 1
+        statistics.record(kind, now - sent_at)
+
+
+def read_tree_rss_kb(pid):
+    """
+    Returns the resident memory of a process and of its children, in kB.
+    """
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            children = [ int(child) for child in f.read().split() ]
+    except OSError:
+        children = []
+    return(read_rss_kb(pid) + sum([ read_tree_rss_kb(child) for child in children ]))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return(values[min(len(values) - 1, int(len(values) * p))])
+
+
+async def run_fleet(args, host, port, server_pid):
+    statistics = Statistics()
+    replay = read_replay_log(args.replay) if (args.replay) else None
+    if (replay is not None and not replay):
+        raise SystemExit('No IN packet found in %s' % args.replay)
+
+    rng = random.Random(args.seed)
+    start = time.monotonic()
+    deadline = start + args.ramp + args.duration
+    devices = []
+    tasks = []
+    for i in range(args.connections):
+        device = Device(i, args, statistics, random.Random(rng.getrandbits(64)))
+        devices.append(device)
+        tasks.append(asyncio.ensure_future(device.run(host, port, deadline, (None if replay is None else replay[i % len(replay)]))))
+        # Connections are opened over the ramp-up time
+        await asyncio.sleep(args.ramp / args.connections)
+
+    # Sample the memory of the server while the fleet runs
+    rss = []
+    while (not all([ t.done() for t in tasks ])):
+        if (server_pid):
+            rss.append(read_tree_rss_kb(server_pid))
+        await asyncio.sleep(1)
+    elapsed = time.monotonic() - start
+    missing = sum([ len(q) for d in devices for q in d.pending.values() ])
+    return(statistics, elapsed, rss, missing)
+
+
+def report(args, statistics, elapsed, rss, missing, fake):
+    print('Devices             : %d connected, %d failed, %d disconnected' % (statistics.connected, statistics.failed, statistics.disconnected))
+    print('Duration            : %.1f s (%.1f s ramp-up)' % (elapsed, args.ramp))
+    sent = sum(statistics.sent.values())
+    print('Packets sent        : %d (%s)' % (sent, ', '.join([ '%s %d' % item for item in sorted(statistics.sent.items()) ])))
+    print('Replies             : %d (%.0f/s), %d positions' % (statistics.replies, statistics.replies / elapsed, statistics.positions))
+    print('Reply errors        : %d mismatched, %d unexpected, %d missing' % (statistics.mismatches, statistics.unexpected, missing))
+    for kind, latencies in sorted(statistics.latencies.items()):
+        print('Latency %-12s: p50 = %7.1f ms, p99 = %7.1f ms (%d replies)' % (kind, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, len(latencies)))
+    if (rss):
+        print('Server RSS          : %d kB at start, %d kB peak, %d kB at end' % (rss[0], max(rss), rss[-1]))
+    if (fake is not None):
+        print('Geolocation API     : %d requests (%s)' % (fake.requests, ', '.join([ 'HTTP %d: %d' % item for item in sorted(fake.answers.items()) ])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=60, help='seconds of traffic after the ramp-up')
+    parser.add_argument('--ramp', type=float, default=10, help='seconds over which connections are opened')
+    parser.add_argument('--grace', type=float, default=5, help='seconds to wait for the last replies')
+    parser.add_argument('--gps-interval', type=float, default=30)
+    parser.add_argument('--wifi-interval', type=float, default=60)
+    parser.add_argument('--status-interval', type=float, default=300)
+    parser.add_argument('--jitter', type=float, default=0.2, help='relative jitter of the intervals')
+    parser.add_argument('--places', type=int, default=3, help='places (WiFi scans) per synthetic device')
+    parser.add_argument('--replay', help='server_log.txt whose IN packets are replayed')
+    parser.add_argument('--speedup', type=float, default=60, help='replay speed-up of the logged gaps')
+    parser.add_argument('--target', help='host:port of a running server (default: start one)')
+    parser.add_argument('--server-pid', type=int, help='PID of the running server, for its RSS')
+    parser.add_argument('--mode', choices=['threads', 'asyncio'], default='asyncio')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the server (SERVER_WORKERS)')
+    parser.add_argument('--port', type=int, default=15024)
+    parser.add_argument('--geo-latency', type=float, default=200, help='latency of the fake geolocation API, in ms')
+    parser.add_argument('--geo-jitter', type=float, default=50)
+    parser.add_argument('--geo-errors', type=float, default=0.0, help='share of 404 answers of the fake API')
+    parser.add_argument('--geo-failures', type=float, default=0.0, help='share of 500 answers of the fake API')
+    parser.add_argument('--seed', type=int, default=5023)
+    args = parser.parse_args()
+    raise_fd_limit(args.connections)
+
+    server = None
+    fake = None
+    if (args.target):
+        host, port = args.target.rsplit(':', 1)
+        port = int(port)
+        server_pid = args.server_pid
+    else:
+        host, port = '127.0.0.1', args.port
+        fake = fake_geolocation.start(0, args.geo_latency, args.geo_jitter, args.geo_errors, args.geo_failures, args.seed)
+        data = tempfile.mkdtemp(prefix='fleet_simulator_')
+        env = dict(os.environ, SERVER_MODE=args.mode, SERVER_PORT=str(port), SERVER_WORKERS=str(args.workers),
+            GEOLOCATION_BASE_URL='http://127.0.0.1:%d' % fake.server_address[1],
+            GEOCACHE_PATH=os.path.join(data, 'geocache.sqlite'),
+            FINGERPRINT_INDEX_PATH=os.path.join(data, 'fingerprints.bin'),
+            BSSID_LEARNER_PATH=os.path.join(data, 'bssids.sqlite'),
+            POSITION_STORE_PATH=os.path.join(data, 'positions'),
+            POSITION_SIMPLIFIED_PATH=os.path.join(data, 'positions-simplified'),
+            SESSION_REGISTRY_PATH=os.path.join(data, 'sessions.sqlite'),
+            COMMAND_QUEUE_PATH=os.path.join(data, 'commands.sqlite'),
+            OPENCELLID_PATH=os.path.join(data, 'opencellid.sqlite'))
+        env.setdefault('GMAPS_API_KEY', 'AIza-benchmark-key-not-used')
+        server = subprocess.Popen([sys.executable, 'gps_tcp_server.py'], cwd=REPO_DIR, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_pid = server.pid
+        wait_for_port(port)
+
+    try:
+        statistics, elapsed, rss, missing = asyncio.run(run_fleet(args, host, port, server_pid))
+        report(args, statistics, elapsed, rss, missing, fake)
+    finally:
+        if (server is not None):
+            server.terminate()
+            server.wait()
@@ -0,0 +1,184 @@
+"""
+Location of WiFi access points, learned from the GPS fixes of the devices.
+
+Trackers alternate between GPS fixes (0x10/0x11 packets) and WiFi scans
+(0x17/0x69 packets) at the same places: a scan sent shortly before or after
+a valid GPS fix, by the same device, was made at about the position of that
+fix. Each such pair is one observation of the position of every access
+point of the scan.
+
+For each BSSID, a running mean and variance of its observed positions is
+kept (Welford's algorithm), in a SQLite file. Once enough access points of
+a new scan are known with a small enough spread, the scan is located from
+them, without querying the Google Maps Geolocation API.
+"""
+
+from collections import deque
+from threading import Lock
+import math
+import os
+import sqlite3
+
+
+# Meters per degree of latitude (and of longitude at the equator)
+METERS_PER_DEGREE = 111320
+
+# An access point observed this many standard deviations away from its
+# estimate, once it has enough samples, was moved: its estimate is restarted
+RELOCATION_SIGMAS = 5
+
+
+class BssidLearner():
+    """
+    Links WiFi scans with the GPS fixes of the same device, learns the
+    position of access points from them and locates scans.
+
+        - window: maximum time between a scan and a fix to link them, in seconds,
+        - max_drift: maximum distance the device may have travelled between the
+          scan and the fix (speed of the fix * time between them), in meters,
+        - min_samples: observations needed before an access point is used,
+        - max_spread: access points whose positions spread more than that
+          (standard deviation, in meters) are not used,
+        - min_known: usable access points needed to locate a scan.
+    """
+
+    def __init__(self, path=None, window=120, max_drift=100, min_samples=2, max_spread=150, min_known=2, pending_scans=4):
+        self.window = window
+        self.max_drift = max_drift
+        self.min_samples = min_samples
+        self.max_spread = max_spread
+        self.min_known = min_known
+        self.pending_scans = pending_scans
+        # Last valid fix (timestamp, latitude, longitude, speed) and scans waiting for a fix, by IMEI
+        self._fixes = {}
+        self._scans = {}
+        self._lock = Lock()
+        self.observations = 0
+
+        directory = os.path.dirname(path) if path else ''
+        if (directory):
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False, timeout=10)
+        if (path):
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        # BSSIDs are stored as 48-bit integers, which makes them the rowid of the table
+        self._db.execute('''CREATE TABLE IF NOT EXISTS bssids (
+            bssid INTEGER PRIMARY KEY, n INTEGER NOT NULL, lat REAL NOT NULL, lon REAL NOT NULL,
+            m2_lat REAL NOT NULL, m2_lon REAL NOT NULL)''')
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return(self._db.execute('SELECT COUNT(*) FROM bssids').fetchone()[0])
+
+    def observe_fix(self, imei, timestamp, latitude, longitude, speed):
+        """
+        Records a valid GPS fix of a device (speed in km/h), and learns from
+        the scans of that device that were waiting for it.
+        """
+        with self._lock:
+            fix = (timestamp, latitude, longitude, speed)
+            self._fixes[imei] = fix
+            scans = self._scans.pop(imei, None)
+            if (scans):
+                learned = False
+                for scan_timestamp, hotspots in scans:
+                    learned = self._link(fix, scan_timestamp, hotspots) or learned
+                if (learned):
+                    self._db.commit()
+
+    def observe_scan(self, imei, timestamp, hotspots):
+        """
+        Records a WiFi scan of a device, given as a list of (BSSID bytes, RSSI):
+        it is learned from right away if the last fix of the device is close
+        enough in time, or kept until the next fix otherwise.
+        """
+        if (not hotspots):
+            return
+        with self._lock:
+            fix = self._fixes.get(imei)
+            if (fix is not None and self._link(fix, timestamp, hotspots)):
+                self._db.commit()
+                return
+            scans = self._scans.get(imei)
+            if (scans is None):
+                scans = self._scans[imei] = deque(maxlen=self.pending_scans)
+            scans.append((timestamp, hotspots))
+
+    def locate(self, hotspots):
+        """
+        Locates a scan given as a list of (BSSID bytes, RSSI), from the access
+        points that were learned. Each one is weighted by its received amplitude
+        (10^(dBm/20)) and by the inverse of its variance.
+        Returns a dictionary like the Google Maps Geolocation API does, or None
+        if not enough access points of the scan are known.
+        """
+        with self._lock:
+            known = []
+            for bssid, rssi in hotspots:
+                row = self._db.execute('SELECT n, lat, lon, m2_lat, m2_lon FROM bssids WHERE bssid = ?', (int.from_bytes(bssid, 'big'),)).fetchone()
+                if (row is None or row[0] < self.min_samples):
+                    continue
+                spread = self._spread(*row)
+                if (spread <= self.max_spread):
+                    known.append((row[1], row[2], spread, 10 ** (rssi / 20) / (spread + 10) ** 2))
+        if (len(known) < self.min_known):
+            return(None)
+
+        total = sum([ ap[3] for ap in known ])
+        latitude = sum([ ap[0] * ap[3] for ap in known ]) / total
+        longitude = sum([ ap[1] * ap[3] for ap in known ]) / total
+        accuracy = sum([ (self._distance(latitude, longitude, ap[0], ap[1]) + ap[2]) * ap[3] for ap in known ]) / total
+        return({'location': {'lat': latitude, 'lng': longitude}, 'accuracy': accuracy, 'hotspots': len(known)})
+
+    def _link(self, fix, timestamp, hotspots):
+        # Must be called with the lock held. Returns True if the scan was learned from.
+        elapsed = abs(timestamp - fix[0])
+        if (elapsed > self.window or fix[3] / 3.6 * elapsed > self.max_drift):
+            return(False)
+        for bssid, rssi in hotspots:
+            self._learn(int.from_bytes(bssid, 'big'), fix[1], fix[2])
+        self.observations += 1
+        return(True)
+
+    def _learn(self, bssid, latitude, longitude):
+        # Welford's update of the mean and sum of squared deviations
+        row = self._db.execute('SELECT n, lat, lon, m2_lat, m2_lon FROM bssids WHERE bssid = ?', (bssid,)).fetchone()
+        if (row is not None and row[0] >= self.min_samples):
+            spread = max(self._spread(*row), 50)
+            if (self._distance(row[1], row[2], latitude, longitude) > RELOCATION_SIGMAS * spread):
+                row = None
+        if (row is None):
+            n, lat, lon, m2_lat, m2_lon = 1, latitude, longitude, 0.0, 0.0
+        else:
+            n, lat, lon, m2_lat, m2_lon = row
+            n += 1
+            delta_lat = latitude - lat
+            delta_lon = longitude - lon
+            lat += delta_lat / n
+            lon += delta_lon / n
+            m2_lat += delta_lat * (latitude - lat)
+            m2_lon += delta_lon * (longitude - lon)
+        self._db.execute('INSERT OR REPLACE INTO bssids VALUES (?, ?, ?, ?, ?, ?)', (bssid, n, lat, lon, m2_lat, m2_lon))
+
+    @staticmethod
+    def _spread(n, lat, lon, m2_lat, m2_lon):
+        # Standard deviation of the observed positions, in meters
+        scale = METERS_PER_DEGREE * math.cos(math.radians(lat))
+        return(math.sqrt((m2_lat * METERS_PER_DEGREE ** 2 + m2_lon * scale ** 2) / n))
+
+    @staticmethod
+    def _distance(lat1, lon1, lat2, lon2):
+        # Equirectangular approximation, in meters: fine at the scale of access points
+        x = (lon2 - lon1) * METERS_PER_DEGREE * math.cos(math.radians((lat1 + lat2) / 2))
+        y = (lat2 - lat1) * METERS_PER_DEGREE
+        return(math.hypot(x, y))
+
+
+def wifi_observations(wifi):
+    """
+    Converts the WiFi list of a client position dictionary (MAC address
+    strings and RSSI) into the (BSSID bytes, RSSI) pairs used by the learner.
+    """
+    return([ (bytes.fromhex(w['macAddress'].replace(':', '')), w['signalStrength']) for w in wifi ])
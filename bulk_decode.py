@@ -0,0 +1,394 @@
+#!/bin/python
+
+"""
+Offline bulk decoder of the packets archived in server_log.txt.
+
+Every packet received by the server is logged to server_log.txt (and its
+rotated files) as a TSV line: time, IP, IMEI, IN/OUT and the packet in hex.
+After a fix of the decoding of a protocol, the positions of months of
+archives can be decoded again from these lines, to backfill the position
+store, without replaying them through the server one packet at a time.
+
+Files are read in large chunks (cut at line boundaries), which are decoded
+by a pool of processes. In each chunk, the IN packets are grouped by
+protocol and length: packets of fixed-layout protocols (GPS positioning
+0x10 and 0x11, status 0x13) are decoded in bulk with NumPy, as arrays of
+columns rather than one packet at a time; those with an unexpected length
+go through codec.py. Without NumPy, all packets go through codec.py.
+
+Output:
+    - GPS positions, as TSV: timestamp (UTC epoch), IMEI, method, validity,
+      latitude, longitude, accuracy, speed, heading and satellites, as
+      stored by the server (an undated fix is dated from the log line, with
+      validity 2), or appended to a position store (--store),
+    - status records, as TSV: timestamp of the log line, IMEI, battery,
+      software version, upload interval and signal strength (-1 if not sent).
+WiFi/LBS scans need the Geolocation API to be located: they are counted,
+not decoded (their positions are in location_log.txt).
+
+Positions appended to a store are not deduplicated: backfill a new store
+directory rather than the one of the server.
+
+Usage:
+    python bulk_decode.py logs/server_log.txt* --positions positions.tsv --status status.tsv
+    python bulk_decode.py logs/server_log.txt* --store ./data/positions-backfill/ --workers 4
+"""
+
+from collections import Counter
+from multiprocessing import Pool
+import argparse
+import gzip
+import os
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import clock
+import codec
+
+
+# Size of the chunks of the files handed over to the workers, in bytes
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Length of the time column of the log lines: YYYY/MM/DD hh:mm:ss (local time)
+TIME_LENGTH = 19
+
+# GPS positioning frame (24 bytes), as a NumPy record
+GPS_FRAME_SIZE = 4 + codec.GPS_LAYOUT.size + codec.STOP_LENGTH
+GPS_DTYPE = None if np is None else np.dtype([('start', 'V2'), ('length', 'u1'), ('protocol', 'u1'), ('datetime', 'u1', (6,)),
+    ('satellites', 'u1'), ('latitude', '>u4'), ('longitude', '>u4'), ('speed', 'u1'), ('flags', '>u2'), ('stop', 'V2')])
+
+# First day of each month (days from the epoch) and number of days, from clock.FIRST_YEAR
+MONTH_START = None if np is None else np.array(clock.MONTH_START, dtype=np.int64)
+MONTH_DAYS = None if np is None else np.array(clock.MONTH_DAYS, dtype=np.int64)
+
+POSITION_HEADER = 'timestamp\timei\tmethod\tvalid\tlatitude\tlongitude\taccuracy\tspeed\theading\tsatellites\n'
+STATUS_HEADER = 'timestamp\timei\tbattery\tsoftware_version\tupload_interval\tsignal_strength\n'
+
+
+def read_chunks(paths, chunk_size=CHUNK_SIZE):
+    """
+    Yields the contents of files (plain or gzipped) in chunks of about
+    chunk_size bytes, cut after the end of a line.
+    """
+    for path in paths:
+        with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+            rest = b''
+            while (True):
+                data = f.read(chunk_size)
+                if (not data):
+                    break
+                data = rest + data
+                end = data.rfind(b'\n') + 1
+                if (end == 0):
+                    rest = data
+                    continue
+                rest = data[end:]
+                yield(data[:end])
+            if (rest):
+                yield(rest + b'\n')
+
+
+def parse_lines(chunk):
+    """
+    Returns the IN packets of a chunk of log lines, grouped by protocol and
+    length of the packet, as lists of (time, IMEI, packet in hex), along with
+    the number of lines.
+    """
+    groups = {}
+    lines = chunk.split(b'\n')
+    for line in lines:
+        fields = line.split(b'\t', 4)
+        if (len(fields) < 5 or fields[3] != b'IN'):
+            continue
+        packet = fields[4].rstrip(b'\r')
+        key = (packet[6:8].lower(), len(packet))
+        group = groups.get(key)
+        if (group is None):
+            group = groups[key] = ([], [], [])
+        group[0].append(fields[0])
+        group[1].append(fields[2])
+        group[2].append(packet)
+    return(groups, len(lines) - 1)
+
+
+def local_times(times):
+    """
+    Converts the times of log lines (local time, YYYY/MM/DD hh:mm:ss) into
+    UTC epochs, as an array, from their digits.
+    """
+    digits = np.frombuffer(b''.join(times), dtype=np.uint8).reshape(len(times), TIME_LENGTH).astype(np.int64) - 48
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 5] * 10 + digits[:, 6]
+    day = digits[:, 8] * 10 + digits[:, 9]
+    seconds = (digits[:, 11] * 10 + digits[:, 12]) * 3600 + (digits[:, 14] * 10 + digits[:, 15]) * 60 + digits[:, 17] * 10 + digits[:, 18]
+    local = (MONTH_START[(year - clock.FIRST_YEAR) * 12 + month - 1] + day - 1) * 86400 + seconds
+    # UTC offsets, by hour of local time
+    hours, inverse = np.unique(local // 3600, return_inverse=True)
+    offsets = np.array([ clock.utc_offset(hour * 3600 - clock.utc_offset(hour * 3600)) for hour in hours.tolist() ], dtype=np.int64)
+    return(local - offsets[inverse])
+
+
+def local_time(text):
+    """
+    Same as local_times(), for a single time.
+    """
+    digits = [ int(text[i:i + 2]) for i in (2, 5, 8, 11, 14, 17) ]
+    local = clock.device_timestamp(tuple(digits))
+    return(local - clock.utc_offset(local - clock.utc_offset(local)))
+
+
+def imei_values(imeis):
+    """
+    Converts IMEI columns (text, possibly empty before login) into integers, 0 when unknown.
+    """
+    return([ (int(imei) if imei else 0) for imei in imeis ])
+
+
+def decode_gps_bulk(times, imeis, packets):
+    """
+    Decodes GPS positioning packets of 24 bytes, as columns. Returns the
+    positions as a dictionary of arrays, and the number of packets whose
+    datetime was invalid (they are dropped, as the server does).
+    """
+    frames = np.frombuffer(bytes.fromhex(b''.join(packets).decode()), dtype=GPS_DTYPE)
+    flags = frames['flags'].astype(np.int64)
+    latitude = frames['latitude'] / codec.COORDINATE_DIVISOR
+    longitude = frames['longitude'] / codec.COORDINATE_DIVISOR
+    longitude = np.where(flags & 0x0800, -longitude, longitude)
+    latitude = np.where(flags & 0x0400, latitude, -latitude)
+    valid = (flags >> 12) & 1
+
+    # Device datetimes (binary values, UTC): undated fixes are dated from the log line
+    dt = frames['datetime'].astype(np.int64)
+    year, month, day, hour, minute, second = dt.T
+    undated = ~dt.any(axis=1)
+    ok = undated | ((year <= clock.LAST_YEAR - clock.FIRST_YEAR) & (month >= 1) & (month <= 12) & (hour < 24) & (minute < 60) & (second < 62))
+    index = np.where(ok & ~undated, year * 12 + month - 1, 0)
+    ok &= undated | ((day >= 1) & (day <= MONTH_DAYS[index]))
+    timestamp = ((MONTH_START[index] + day - 1) * 86400 + hour * 3600 + minute * 60 + second).astype(np.float64)
+    if (undated.any()):
+        timestamp[undated] = local_times([ times[i] for i in np.flatnonzero(undated).tolist() ])
+        valid = np.where(undated & (valid == 1), 2, valid)
+
+    positions = {
+        'timestamp': timestamp,
+        'imei': np.array(imei_values(imeis), dtype=np.uint64),
+        'valid': valid,
+        'latitude': latitude,
+        'longitude': longitude,
+        'speed': frames['speed'].astype(np.float64),
+        'heading': (flags & 0x03FF).astype(np.float64),
+        'satellites': frames['satellites'] & 0x0F,
+    }
+    keep = ok & (positions['imei'] != 0)
+    return({ name: column[keep] for name, column in positions.items() }, int((~ok).sum()))
+
+
+def decode_gps_frames(times, imeis, packets):
+    """
+    Decodes GPS positioning packets one by one, with codec.py. Same results as decode_gps_bulk().
+    """
+    positions = {name: [] for name in ('timestamp', 'imei', 'valid', 'latitude', 'longitude', 'speed', 'heading', 'satellites')}
+    errors = 0
+    for text, imei, packet in zip(times, imeis, packets):
+        try:
+            fix = codec.decode_gps(bytes.fromhex(packet.decode()))
+            timestamp = clock.device_timestamp(fix.datetime)
+        except (ValueError, codec.DecodeError):
+            errors += 1
+            continue
+        valid = fix.valid
+        if (timestamp is None):
+            timestamp = local_time(text.decode())
+            valid = (2 if valid == 1 else valid)
+        if (not imei):
+            continue
+        for name, value in (('timestamp', float(timestamp)), ('imei', int(imei)), ('valid', valid), ('latitude', fix.latitude),
+                ('longitude', fix.longitude), ('speed', float(fix.speed)), ('heading', float(fix.heading)), ('satellites', fix.nb_sat)):
+            positions[name].append(value)
+    return(positions, errors)
+
+
+def decode_status_bulk(times, imeis, packets):
+    """
+    Decodes status packets of the same length, as columns.
+    """
+    n = len(packets)
+    frames = np.frombuffer(bytes.fromhex(b''.join(packets).decode()), dtype=np.uint8).reshape(n, -1)
+    content = codec.CONTENT_OFFSET
+    if (frames.shape[1] < content + codec.STATUS_LAYOUT.size + codec.STOP_LENGTH):
+        return(None, n)
+    with_signal = (frames[:, 2] == 0x07) & (frames.shape[1] > 7 + codec.STOP_LENGTH)
+    signal = np.where(with_signal, frames[:, min(7, frames.shape[1] - 1)].astype(np.int64), -1)
+    status = {
+        'timestamp': local_times(times).astype(np.float64),
+        'imei': np.array(imei_values(imeis), dtype=np.uint64),
+        'battery': frames[:, content],
+        'software_version': frames[:, content + 1],
+        'upload_interval': frames[:, content + 2],
+        'signal_strength': signal,
+    }
+    return(status, 0)
+
+
+def decode_status_frames(times, imeis, packets):
+    """
+    Decodes status packets one by one, with codec.py.
+    """
+    status = {name: [] for name in ('timestamp', 'imei', 'battery', 'software_version', 'upload_interval', 'signal_strength')}
+    errors = 0
+    for text, imei, packet in zip(times, imeis, packets):
+        try:
+            record = codec.decode_status(bytes.fromhex(packet.decode()))
+        except (ValueError, codec.DecodeError):
+            errors += 1
+            continue
+        for name, value in (('timestamp', float(local_time(text.decode()))), ('imei', int(imei or 0)), ('battery', record.battery),
+                ('software_version', record.software_version), ('upload_interval', record.upload_interval),
+                ('signal_strength', (-1 if record.signal_strength is None else record.signal_strength))):
+            status[name].append(value)
+    return(status, errors)
+
+
+def format_positions(positions):
+    """
+    Formats positions as TSV lines (GPS method, accuracy 0 as stored by the server).
+    """
+    columns = [ (column.tolist() if hasattr(column, 'tolist') else column) for column in
+        (positions['timestamp'], positions['imei'], positions['valid'], positions['latitude'], positions['longitude'],
+         positions['speed'], positions['heading'], positions['satellites']) ]
+    return(''.join([ '%d\t%d\tGPS\t%d\t%.6f\t%.6f\t0.0\t%g\t%g\t%d\n' % row for row in zip(*columns) ]))
+
+
+def format_status(status):
+    """
+    Formats status records as TSV lines.
+    """
+    columns = [ (column.tolist() if hasattr(column, 'tolist') else column) for column in
+        (status['timestamp'], status['imei'], status['battery'], status['software_version'], status['upload_interval'], status['signal_strength']) ]
+    return(''.join([ '%d\t%d\t%d\t%d\t%d\t%d\n' % row for row in zip(*columns) ]))
+
+
+def decode_chunk(chunk, arrays=False, bulk=True):
+    """
+    Decodes the IN packets of a chunk of log lines. Returns the positions
+    (as TSV text, or as columns if arrays is True), the status records as
+    TSV text, and counters (lines, packets by protocol, decoding errors).
+    """
+    groups, n_lines = parse_lines(chunk)
+    bulk = bulk and np is not None
+    counters = Counter(lines=n_lines)
+    positions = []
+    status = []
+    for (protocol, length), (times, imeis, packets) in groups.items():
+        counters['packets'] += len(packets)
+        counters['protocol_' + protocol.decode()] += len(packets)
+        if (protocol in (b'10', b'11')):
+            if (bulk and length == 2 * GPS_FRAME_SIZE):
+                records, errors = decode_gps_bulk(times, imeis, packets)
+            else:
+                records, errors = decode_gps_frames(times, imeis, packets)
+            counters['positions'] += len(records['timestamp'])
+            positions.append(records)
+        elif (protocol == b'13'):
+            records, errors = (None, 0)
+            if (bulk and length % 2 == 0):
+                records, errors = decode_status_bulk(times, imeis, packets)
+            if (records is None):
+                records, errors = decode_status_frames(times, imeis, packets)
+            counters['status'] += len(records['timestamp'])
+            status.append(format_status(records))
+        else:
+            errors = 0
+        counters['errors'] += errors
+
+    if (arrays):
+        positions_out = positions
+    else:
+        positions_out = ''.join(format_positions(records) for records in positions)
+    return(positions_out, ''.join(status), counters)
+
+
+def store_positions(store, positions):
+    """
+    Appends decoded positions (columns) to a position store.
+    """
+    columns = [ (column.tolist() if hasattr(column, 'tolist') else column) for column in
+        (positions['imei'], positions['timestamp'], positions['valid'], positions['latitude'], positions['longitude'],
+         positions['speed'], positions['heading']) ]
+    for imei, timestamp, valid, latitude, longitude, speed, heading in zip(*columns):
+        store.append(imei, timestamp, 'GPS', valid, latitude, longitude, 0.0, speed, heading)
+
+
+def _decode_chunk_task(task):
+    # Pool workers receive (chunk, arrays, bulk)
+    return(decode_chunk(*task))
+
+
+def run(paths, positions_path='-', status_path=None, store_path=None, workers=None, chunk_size=CHUNK_SIZE, bulk=True):
+    """
+    Decodes log files with a pool of workers, and writes or stores the
+    records. Returns the counters.
+    """
+    arrays = store_path is not None
+    store = None
+    if (arrays):
+        from position_store import PositionStore
+        store = PositionStore(directory=store_path)
+    positions_file = None
+    if (not arrays):
+        positions_file = sys.stdout if positions_path == '-' else open(positions_path, 'w')
+        positions_file.write(POSITION_HEADER)
+    status_file = None
+    if (status_path):
+        status_file = sys.stdout if status_path == '-' else open(status_path, 'w')
+        status_file.write(STATUS_HEADER)
+
+    totals = Counter()
+    tasks = ((chunk, arrays, bulk) for chunk in read_chunks(paths, chunk_size))
+    try:
+        with Pool(processes=workers) as pool:
+            for positions, status, counters in pool.imap(_decode_chunk_task, tasks):
+                totals.update(counters)
+                if (arrays):
+                    for records in positions:
+                        store_positions(store, records)
+                else:
+                    positions_file.write(positions)
+                if (status_file is not None):
+                    status_file.write(status)
+    finally:
+        for f in (positions_file, status_file):
+            if (f is not None and f is not sys.stdout):
+                f.close()
+        if (store is not None):
+            store.close()
+    return(totals)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode the IN packets of server_log.txt archives into positions and status records.')
+    parser.add_argument('paths', nargs='+', help='server_log.txt files (or rotated, possibly gzipped, files)')
+    parser.add_argument('--positions', default='-', help="TSV file of the GPS positions ('-' for stdout)")
+    parser.add_argument('--status', default=None, help="TSV file of the status records ('-' for stdout)")
+    parser.add_argument('--store', default=None, help='append the positions to the position store of this directory instead')
+    parser.add_argument('--workers', type=int, default=None, help='decoding processes (default: one per core)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='bytes of the files per chunk')
+    parser.add_argument('--no-numpy', action='store_true', help='decode every packet with codec.py')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    totals = run(args.paths, args.positions, args.status, args.store, args.workers, args.chunk_size, bulk=not args.no_numpy)
+    elapsed = time.perf_counter() - start
+    protocols = ', '.join('%s: %d' % (name[9:], count) for name, count in sorted(totals.items()) if name.startswith('protocol_'))
+    print('Lines           :', totals['lines'], file=sys.stderr)
+    print('IN packets      : %d (%s)' % (totals['packets'], protocols), file=sys.stderr)
+    print('Positions       :', totals['positions'], file=sys.stderr)
+    print('Status records  :', totals['status'], file=sys.stderr)
+    print('Decoding errors :', totals['errors'], file=sys.stderr)
+    print('Time            : %.1f s (%.0f packets/min)' % (elapsed, 60 * totals['packets'] / max(elapsed, 1e-9)), file=sys.stderr)
@@ -0,0 +1,152 @@
+"""
+Time service shared by all the connections of the server.
+
+Time is needed by nearly every packet: the response to time requests
+(protocol 0x30), the date of the positions sent by the devices, converted
+to local time for location_log.txt, and the timestamp of each log line.
+Going through datetime objects, strftime() and strptime() for each of them
+costs much more than the rest of the packet handling.
+
+Here, what only depends on the current second (the encoded 0x30 response,
+the local time of log lines) is encoded once per second, for all the
+connections. Device datetimes, already decoded to integers from their hex
+or BCD bytes (see codec.py), are converted to UNIX timestamps with integer
+arithmetic from a table of the first day of each month, and timestamps are
+converted to local time with the UTC offset of their hour, from a table
+filled as it goes, instead of a timezone lookup each time.
+
+Caches are replaced as a whole, rather than updated in place: they can be
+read from any thread without a lock.
+"""
+
+import calendar
+import time
+import codec
+
+
+# Device datetimes have 2-digit years, from 2000
+FIRST_YEAR = 2000
+LAST_YEAR = 2099
+
+# Days from the epoch to the first day of each month, from FIRST_YEAR, and number of days of each month
+MONTH_START = [ (calendar.timegm((year, month, 1, 0, 0, 0)) // 86400) for year in range(FIRST_YEAR, LAST_YEAR + 1) for month in range(1, 13) ]
+MONTH_DAYS = [ calendar.monthrange(year, month)[1] for year in range(FIRST_YEAR, LAST_YEAR + 1) for month in range(1, 13) ]
+
+# UTC offsets by hour, or None for the hours during which the offset changes (DST and timezone changes)
+OFFSET_PERIOD = 3600
+MAX_OFFSETS = 100000
+_offsets = {}
+
+# (second, value) of the last encodings
+_local_text = (None, '')
+_log_timestamp = (None, '')
+_utc_fields = (None, None)
+_time_reply = (None, b'')
+
+
+def device_timestamp(fields):
+    """
+    Converts the (YY, MM, DD, hh, mm, ss) UTC datetime of a packet into a
+    UNIX timestamp. Returns None when the device did not set it (all zeros),
+    raises ValueError when it is not a valid datetime.
+    """
+    year, month, day, hour, minute, second = fields
+    if (not (year or month or day or hour or minute or second)):
+        return(None)
+    if (not (0 <= year <= LAST_YEAR - FIRST_YEAR and 1 <= month <= 12 and hour < 24 and minute < 60 and second < 62)):
+        raise ValueError('invalid device datetime: %r' % (fields,))
+    index = year * 12 + month - 1
+    if (not (1 <= day <= MONTH_DAYS[index])):
+        raise ValueError('invalid device datetime: %r' % (fields,))
+    return((MONTH_START[index] + day - 1) * 86400 + hour * 3600 + minute * 60 + second)
+
+
+def utc_offset(timestamp):
+    """
+    Returns the offset of local time from UTC at a UNIX timestamp, in seconds.
+    """
+    global _offsets
+    period = int(timestamp) // OFFSET_PERIOD
+    try:
+        offset = _offsets[period]
+    except KeyError:
+        offset = time.localtime(period * OFFSET_PERIOD).tm_gmtoff
+        if (time.localtime(period * OFFSET_PERIOD + OFFSET_PERIOD - 1).tm_gmtoff != offset):
+            offset = None
+        if (len(_offsets) >= MAX_OFFSETS):
+            _offsets = {}
+        _offsets[period] = offset
+    if (offset is None):
+        return(time.localtime(timestamp).tm_gmtoff)
+    return(offset)
+
+
+def local_text(timestamp):
+    """
+    Formats a UNIX timestamp as local time, as written to the logs
+    (YYYY/MM/DD hh:mm:ss).
+    """
+    global _local_text
+    second = int(timestamp)
+    cached = _local_text
+    if (cached[0] == second):
+        return(cached[1])
+    text = '%04d/%02d/%02d %02d:%02d:%02d' % time.gmtime(second + utc_offset(second))[:6]
+    _local_text = (second, text)
+    return(text)
+
+
+def log_timestamp(timestamp):
+    """
+    Same as local_text(), for the timestamps of log lines: these are close to
+    now, and are cached apart from the datetimes of the devices.
+    """
+    global _log_timestamp
+    second = int(timestamp)
+    cached = _log_timestamp
+    if (cached[0] == second):
+        return(cached[1])
+    text = '%04d/%02d/%02d %02d:%02d:%02d' % time.gmtime(second + utc_offset(second))[:6]
+    _log_timestamp = (second, text)
+    return(text)
+
+
+def utc_fields(timestamp=None):
+    """
+    Returns the UTC (year, month, day, hour, minute, second) of a UNIX
+    timestamp, or of now.
+    """
+    global _utc_fields
+    second = int(time.time() if timestamp is None else timestamp)
+    cached = _utc_fields
+    if (cached[0] == second):
+        return(cached[1])
+    fields = time.gmtime(second)[:6]
+    _utc_fields = (second, fields)
+    return(fields)
+
+
+def hexified_datetime(truncated_year):
+    """
+    Returns the current UTC datetime as YY YY MM DD hh mm ss bytes, or as
+    YY MM DD hh mm ss if truncated_year is True.
+    """
+    year, month, day, hour, minute, second = utc_fields()
+    if (truncated_year):
+        return(codec.DATETIME_LAYOUT.pack(year % 100, month, day, hour, minute, second))
+    return(codec.FULL_DATETIME_LAYOUT.pack(year, month, day, hour, minute, second))
+
+
+def time_reply():
+    """
+    Returns the complete response to a time request (protocol 0x30) for the
+    current second, encoded once per second.
+    """
+    global _time_reply
+    second = int(time.time())
+    cached = _time_reply
+    if (cached[0] == second):
+        return(cached[1])
+    reply = codec.encode_response(0x30, hexified_datetime(truncated_year=False))
+    _time_reply = (second, reply)
+    return(reply)
@@ -0,0 +1,231 @@
+"""
+Binary codec for the packets sent by TOPIN trackers.
+
+Frames (as cut by framing.FrameDecoder, start and stop bytes included)
+are decoded straight from bytes or memoryview objects with precompiled
+struct layouts, one per protocol number, into compact named tuples.
+No hex string is built along the way.
+
+Responses sent back to the devices are encoded here as well, directly
+as bytes.
+
+Offsets below are relative to the start of the frame:
+    0-1 start bytes (0x78 0x78)
+    2   length (or number of WiFi hotspots for WiFi/LBS packets)
+    3   protocol number
+    4-  content, then the 0x0D 0x0A stop bytes
+"""
+
+from collections import namedtuple
+import struct
+
+
+class DecodeError(ValueError):
+    """
+    Raised when a frame is too short or malformed for its protocol number.
+    """
+
+
+# Records returned by decode_frame()
+Login = namedtuple('Login', ['protocol', 'imei', 'software_version'])
+GpsFix = namedtuple('GpsFix', ['protocol', 'datetime', 'raw_datetime', 'nb_sat', 'latitude', 'longitude', 'speed', 'valid', 'heading'])
+WifiLbs = namedtuple('WifiLbs', ['protocol', 'datetime', 'raw_datetime', 'wifi', 'mcc', 'mnc', 'cells'])
+WifiAccessPoint = namedtuple('WifiAccessPoint', ['bssid', 'rssi'])
+GsmCell = namedtuple('GsmCell', ['lac', 'cell_id', 'rssi'])
+Status = namedtuple('Status', ['protocol', 'battery', 'software_version', 'upload_interval', 'signal_strength'])
+UploadInterval = namedtuple('UploadInterval', ['protocol', 'interval', 'raw_interval'])
+Packet = namedtuple('Packet', ['protocol', 'content'])
+
+
+# Precompiled layouts (big endian)
+# GPS: datetime (6 x 1 byte, binary), length/satellites, latitude, longitude, speed, flags
+GPS_LAYOUT = struct.Struct('>6BBIIBH')
+# WiFi hotspot: BSSID (6 bytes) and RSSI
+WIFI_LAYOUT = struct.Struct('>6sB')
+# GSM carrier: number of cells, MCC, MNC
+CARRIER_LAYOUT = struct.Struct('>BHB')
+# GSM cell: LAC, Cell ID, RSSI
+CELL_LAYOUT = struct.Struct('>HHB')
+# Status: battery, software version, upload interval (and signal strength)
+STATUS_LAYOUT = struct.Struct('>3B')
+# Upload interval in seconds
+INTERVAL_LAYOUT = struct.Struct('>H')
+# Datetime sent to the devices: YY MM DD HH MM SS, or YYYY MM DD HH MM SS
+DATETIME_LAYOUT = struct.Struct('>6B')
+FULL_DATETIME_LAYOUT = struct.Struct('>H5B')
+
+# Latitude and longitude are sent in 1/30000th of seconds-of-angle
+COORDINATE_DIVISOR = 30000 * 60
+
+# Offset of the content in a frame
+CONTENT_OFFSET = 4
+STOP_LENGTH = 2
+
+START = b'\x78\x78'
+STOP = b'\x0d\x0a'
+
+
+def decode_bcd(data):
+    """
+    Decodes a BCD-encoded sequence of bytes into a tuple of integers,
+    e.g. b'\\x20\\x01\\x31' into (20, 1, 31).
+    """
+    return(tuple((b >> 4) * 10 + (b & 0x0F) for b in data))
+
+
+def decode_login(frame):
+    """
+    Login packet: IMEI is BCD-encoded over 8 bytes (15 digits, padded with
+    a leading 0) and followed by the software version.
+    """
+    if (len(frame) < 15):
+        raise DecodeError('login packet is too short')
+    imei = int(bytes(frame[4:12]).hex())
+    return(Login(frame[3], imei, frame[12]))
+
+
+def decode_gps(frame):
+    """
+    GPS positioning packets (0x10 and 0x11).
+    Datetime bytes are binary values (not BCD) at UTC.
+    The last two bytes hold flags: bit 12 is validity, bit 11 is set for
+    western longitudes, bit 10 is set for northern latitudes and the
+    10 lowest bits are the heading.
+    """
+    if (len(frame) < CONTENT_OFFSET + GPS_LAYOUT.size + STOP_LENGTH):
+        raise DecodeError('GPS packet is too short')
+    yy, mo, dd, hh, mi, ss, sat, lat, lon, speed, flags = GPS_LAYOUT.unpack_from(frame, CONTENT_OFFSET)
+    latitude = lat / COORDINATE_DIVISOR
+    longitude = lon / COORDINATE_DIVISOR
+    if (flags & 0x0800):
+        longitude = -longitude
+    if (not flags & 0x0400):
+        latitude = -latitude
+    return(GpsFix(frame[3], (yy, mo, dd, hh, mi, ss), bytes(frame[4:10]), sat & 0x0F,
+                  latitude, longitude, speed, (flags >> 12) & 1, flags & 0x03FF))
+
+
+def decode_wifi_lbs(frame):
+    """
+    WiFi/LBS positioning packets (0x17 and 0x69).
+    The length byte is the number of WiFi hotspots, datetime is BCD-encoded
+    at UTC, then come the hotspots, the GSM carrier and the GSM cells.
+    RSSI values are sent as positive numbers and are returned as dBm.
+    """
+    n_wifi = frame[2]
+    offset = CONTENT_OFFSET + 6
+    try:
+        wifi = []
+        for i in range(n_wifi):
+            bssid, rssi = WIFI_LAYOUT.unpack_from(frame, offset)
+            wifi.append(WifiAccessPoint(bssid, -rssi))
+            offset += WIFI_LAYOUT.size
+
+        n_cells, mcc, mnc = CARRIER_LAYOUT.unpack_from(frame, offset)
+        offset += CARRIER_LAYOUT.size
+        cells = []
+        for i in range(n_cells):
+            lac, cell_id, rssi = CELL_LAYOUT.unpack_from(frame, offset)
+            cells.append(GsmCell(lac, cell_id, -rssi))
+            offset += CELL_LAYOUT.size
+    except struct.error:
+        raise DecodeError('WiFi/LBS packet is too short')
+
+    return(WifiLbs(frame[3], decode_bcd(frame[4:10]), bytes(frame[4:10]), tuple(wifi), mcc, mnc, tuple(cells)))
+
+
+def decode_status(frame):
+    """
+    Status packet: length 0x06 carries battery, software version and upload
+    interval; length 0x07 carries the signal strength as well.
+    """
+    try:
+        battery, software_version, upload_interval = STATUS_LAYOUT.unpack_from(frame, CONTENT_OFFSET)
+    except struct.error:
+        raise DecodeError('status packet is too short')
+    signal_strength = frame[7] if (frame[2] == 0x07 and len(frame) > 7 + STOP_LENGTH) else None
+    return(Status(frame[3], battery, software_version, upload_interval, signal_strength))
+
+
+def decode_upload_interval(frame):
+    """
+    Upload interval packet: new interval (in seconds) set by SMS on the device.
+    """
+    try:
+        interval, = INTERVAL_LAYOUT.unpack_from(frame, CONTENT_OFFSET)
+    except struct.error:
+        raise DecodeError('upload interval packet is too short')
+    return(UploadInterval(frame[3], interval, bytes(frame[4:6])))
+
+
+# Decoders by protocol number, other protocols are returned as generic packets
+DECODERS = {
+    0x01: decode_login,
+    0x10: decode_gps,
+    0x11: decode_gps,
+    0x13: decode_status,
+    0x17: decode_wifi_lbs,
+    0x69: decode_wifi_lbs,
+    0x98: decode_upload_interval,
+}
+
+
+def decode_frame(frame):
+    """
+    Decodes a complete frame (bytes or memoryview, start and stop bytes
+    included) into the record matching its protocol number.
+    """
+    if (len(frame) < CONTENT_OFFSET + STOP_LENGTH):
+        raise DecodeError('frame is too short')
+    decoder = DECODERS.get(frame[3])
+    if (decoder is None):
+        return(Packet(frame[3], bytes(frame[CONTENT_OFFSET:-STOP_LENGTH])))
+    return(decoder(frame))
+
+
+def format_bssid(bssid):
+    """
+    Formats a 6-byte BSSID as a MAC address string, e.g. 'aa:bb:cc:dd:ee:ff'.
+    """
+    return(bssid.hex(':'))
+
+
+def encode_response(protocol, content=b'', length=None):
+    """
+    Encodes a response as start-start-length-protocol-content-stop_1-stop_2.
+    Length is that of the content plus the protocol byte, unless forced.
+    """
+    if (length is None):
+        length = len(content) + 1
+    return(START + bytes((length, protocol)) + content + STOP)
+
+
+class ResponseBuilder():
+    """
+    Encodes responses into a reusable buffer, so that building a response
+    does not allocate anything but the returned view.
+    The view is only valid until the next call to build().
+    """
+
+    __slots__ = ('_buffer',)
+
+    def __init__(self, size=64):
+        self._buffer = bytearray(size)
+        self._buffer[0:2] = START
+
+    def build(self, protocol, content, length=None):
+        """
+        Same as encode_response(), but written into the buffer.
+        """
+        n = len(content)
+        size = n + CONTENT_OFFSET + STOP_LENGTH
+        buffer = self._buffer
+        if (size > len(buffer)):
+            # Views on the former buffer may still exist, so it can not be resized
+            buffer = self._buffer = bytearray(2 * size)
+            buffer[0:2] = START
+        buffer[2] = (n + 1) if (length is None) else length
+        buffer[3] = protocol
+        buffer[CONTENT_OFFSET:CONTENT_OFFSET + n] = content
+        buffer[CONTENT_OFFSET + n:size] = STOP
+        return(memoryview(buffer)[:size])
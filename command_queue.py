@@ -0,0 +1,448 @@
+"""
+Commands sent by the server to the devices, by IMEI.
+
+Devices can only be reached while they are connected, and 2G connections
+come and go: commands (upload interval, status interval, positioning
+request, setup) are queued in a SQLite database (WAL mode, shared by the
+worker processes and by the command line below), and sent when the device
+next logs in or sends a packet, along with the response to that packet, in
+a single write.
+
+Commands whose effect the device reports are kept until it does: a new
+upload interval is acknowledged by the 0x98 packet of the device with the
+same interval. They are sent again if the acknowledgement does not come within
+retry_interval seconds (or when the device reconnects), up to max_attempts
+times. Other commands are done once written. A new command replaces the
+command of the same kind still queued for the device.
+
+The settings answered to the setup requests (0x57) of a device are kept
+in the same database; changing them queues a setup command as well.
+
+    python command_queue.py upload-interval 359339075016807 60
+    python command_queue.py setup 359339075016807 --sos 0600000000
+    python command_queue.py list 359339075016807
+"""
+
+from collections import namedtuple
+from threading import Lock
+import codec
+import json
+import math
+import os
+import serverlog
+import sqlite3
+import time
+
+
+# A queued command: state is 'pending' (not sent yet), 'sent' (waiting for its acknowledgement),
+# 'acked', 'done' (sent, no acknowledgement expected), 'failed', 'replaced', 'expired' or 'cancelled'
+Command = namedtuple('Command', ['id', 'imei', 'kind', 'frame', 'ack_protocol', 'ack_value', 'state', 'attempts', 'created', 'sent', 'done'])
+
+# Field of the packets acknowledging a command, by protocol number (see codec.py)
+ACK_FIELDS = {
+    0x98: 'interval',
+}
+
+# Settings answered to setup requests, as in the protocol documentation: upload interval in seconds,
+# switches as bits, alarms, do-not-disturb and GPS timer times as hex strings, and SOS numbers
+DEFAULT_SETTINGS = {
+    'upload_interval': 300,
+    'switches': 0b00110001,
+    'alarms': ['000000', '000000', '000000'],
+    'dnd_switch': 0,
+    'dnd_times': ['000000', '000000', '000000'],
+    'gps_timer_switch': 0,
+    'gps_timer': '00000000',
+    'phones': ['', '', ''],
+}
+
+
+def upload_interval_command(seconds):
+    """
+    Returns the kind, frame and acknowledgement (protocol and value) of the
+    command setting the interval between positions (0x97), in seconds.
+    """
+    seconds = int(seconds)
+    if (not 10 <= seconds <= 7200):
+        raise ValueError('upload interval must be between 10 and 7200 seconds')
+    return('upload_interval', codec.encode_response(0x97, seconds.to_bytes(2, 'big')), 0x98, seconds)
+
+
+def status_interval_command(minutes):
+    """
+    Returns the command setting the interval between status packets (0x13), in minutes.
+    """
+    minutes = int(minutes)
+    if (not 1 <= minutes <= 255):
+        raise ValueError('status interval must be between 1 and 255 minutes')
+    return('status_interval', codec.encode_response(0x13, bytes((minutes,))), None, None)
+
+
+def locate_command(wifi_only=False):
+    """
+    Returns the command asking the device for its position right away (0x80),
+    by GPS, WiFi or LBS, or by WiFi or LBS only.
+    """
+    return('locate', codec.encode_response(0x80, length=(2 if wifi_only else 1)), None, None)
+
+
+def setup_command(settings):
+    """
+    Returns the command sending its settings to the device (0x57).
+    """
+    return('setup', codec.encode_response(0x57, setup_content(settings)), None, None)
+
+
+def setup_content(settings):
+    """
+    Encodes settings (see DEFAULT_SETTINGS) as the content of a setup packet.
+    The upload interval is in BCD.
+    """
+    interval = int(settings['upload_interval'])
+    if (not 0 < interval <= 9999):
+        raise ValueError('upload interval must be between 1 and 9999 seconds')
+    return(b''.join([
+        bytes.fromhex('%04d' % interval),
+        bytes((settings['switches'],)),
+        b''.join(bytes.fromhex(alarm) for alarm in settings['alarms']),
+        bytes((settings['dnd_switch'],)),
+        b''.join(bytes.fromhex(dnd_time) for dnd_time in settings['dnd_times']),
+        bytes((settings['gps_timer_switch'],)),
+        bytes.fromhex(settings['gps_timer']),
+        b';'.join(bytes(phone, 'UTF-8') for phone in settings['phones']) ]))
+
+
+class CommandQueue():
+    """
+    Commands by IMEI, shared by the processes opening the same file.
+    Thread-safe: it is shared by all the connections of a process.
+
+        - retry_interval: time to wait for an acknowledgement before sending
+          a command again, in seconds,
+        - max_attempts: times a command is sent before it is given up,
+        - ttl: time after which commands still queued expire, and finished
+          commands are forgotten, in seconds,
+        - poll_interval: time between checks for commands queued by other
+          processes, in seconds.
+
+    Which devices have commands due is kept in memory, so that checking a
+    device for each of its packets does not query the database.
+    """
+
+    def __init__(self, path=None, retry_interval=120.0, max_attempts=5, ttl=7 * 86400, poll_interval=1.0):
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.counts = {'sent': 0, 'retried': 0, 'acked': 0, 'failed': 0}
+        self._lock = Lock()
+        # Time at which the next command of a device is due, and protocols acknowledging its sent commands, by IMEI
+        self._due = {}
+        self._awaiting = {}
+        # Settings and encoded setup content of the devices that have settings, by IMEI
+        self._settings = {}
+        self._setup_contents = {}
+        self._default_content = setup_content(DEFAULT_SETTINGS)
+        self._version = None
+        self._checked = -math.inf
+        self._purged = -math.inf
+
+        directory = os.path.dirname(path) if path else ''
+        if (directory):
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False, timeout=10)
+        if (path):
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, imei TEXT NOT NULL, kind TEXT NOT NULL, frame BLOB NOT NULL,
+            ack_protocol INTEGER, ack_value INTEGER, state TEXT NOT NULL, attempts INTEGER NOT NULL,
+            created REAL NOT NULL, sent REAL, done REAL)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS commands_imei ON commands (imei, state)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS settings (imei TEXT PRIMARY KEY, settings TEXT NOT NULL)')
+        self._db.commit()
+        self.refresh()
+
+    def enqueue(self, imei, kind, frame, ack_protocol=None, ack_value=None):
+        """
+        Queues a command for a device, in place of the command of the same
+        kind still queued. Returns its id.
+        """
+        imei = int(imei)
+        with self._lock:
+            self._db.execute("UPDATE commands SET state = 'replaced', done = ? WHERE imei = ? AND kind = ? AND state IN ('pending', 'sent')",
+                (time.time(), format(imei, '015d'), kind))
+            cursor = self._db.execute("INSERT INTO commands VALUES (NULL, ?, ?, ?, ?, ?, 'pending', 0, ?, NULL, NULL)",
+                (format(imei, '015d'), kind, bytes(frame), ack_protocol, ack_value, time.time()))
+            self._db.commit()
+            self._schedule(imei)
+        return(cursor.lastrowid)
+
+    def set_upload_interval(self, imei, seconds):
+        """
+        Queues a new upload interval for a device, which is also answered to its setup requests.
+        """
+        command_id = self.enqueue(imei, *upload_interval_command(seconds))
+        self.update_settings(imei, upload_interval=int(seconds))
+        return(command_id)
+
+    def set_status_interval(self, imei, minutes):
+        """
+        Queues a new status packet interval for a device.
+        """
+        return(self.enqueue(imei, *status_interval_command(minutes)))
+
+    def locate(self, imei, wifi_only=False):
+        """
+        Queues a positioning request for a device.
+        """
+        return(self.enqueue(imei, *locate_command(wifi_only)))
+
+    def setup(self, imei, **changes):
+        """
+        Changes settings of a device and queues them for it.
+        """
+        settings = self.update_settings(imei, **changes)
+        return(self.enqueue(imei, *setup_command(settings)))
+
+    def due(self, imei, reconnected=False, now=None):
+        """
+        Returns True if commands are due for a device: queued commands, and
+        sent commands whose acknowledgement is late (or all sent commands,
+        when the device reconnected).
+        """
+        if (time.monotonic() - self._checked > self.poll_interval):
+            self.refresh()
+        due = self._due.get(imei)
+        return(due is not None and (reconnected or due <= (time.time() if now is None else now)))
+
+    def take(self, imei, reconnected=False, now=None):
+        """
+        Returns the commands due for a device, oldest first, and records that
+        they are sent. When the device reconnected, the commands sent over its
+        previous connection are sent again right away.
+        Commands sent max_attempts times already are given up instead.
+        """
+        imei = int(imei)
+        now = (time.time() if now is None else now)
+        commands = []
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM commands WHERE imei = ? AND state IN ('pending', 'sent') ORDER BY id",
+                (format(imei, '015d'),)).fetchall()
+            for row in rows:
+                command = Command(*row)
+                if (command.state == 'sent' and not reconnected and command.sent + self.retry_interval > now):
+                    continue
+                if (command.attempts >= self.max_attempts):
+                    self._db.execute("UPDATE commands SET state = 'failed', done = ? WHERE id = ?", (now, command.id))
+                    self.counts['failed'] += 1
+                    continue
+                state = ('done' if command.ack_protocol is None else 'sent')
+                self._db.execute('UPDATE commands SET state = ?, attempts = attempts + 1, sent = ?, done = ? WHERE id = ?',
+                    (state, now, (now if state == 'done' else None), command.id))
+                self.counts['sent'] += 1
+                if (command.attempts):
+                    self.counts['retried'] += 1
+                commands.append(command._replace(state=state, attempts=command.attempts + 1, sent=now))
+            if (rows):
+                self._db.commit()
+            self._schedule(imei)
+        return(commands)
+
+    def acknowledge(self, imei, record):
+        """
+        Records the commands of a device acknowledged by a packet it sent (a
+        decoded record, see codec.py), and returns them.
+        """
+        awaiting = self._awaiting.get(imei)
+        if (not awaiting or record.protocol not in awaiting):
+            return([])
+        value = getattr(record, ACK_FIELDS.get(record.protocol, ''), None)
+        imei = int(imei)
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM commands WHERE imei = ? AND state = 'sent' AND ack_protocol = ? AND (ack_value IS NULL OR ack_value = ?)",
+                (format(imei, '015d'), record.protocol, value)).fetchall()
+            if (rows):
+                now = time.time()
+                self._db.executemany("UPDATE commands SET state = 'acked', done = ? WHERE id = ?", [ (now, row[0]) for row in rows ])
+                self._db.commit()
+                self.counts['acked'] += len(rows)
+                self._schedule(imei)
+        return([ Command(*row)._replace(state='acked') for row in rows ])
+
+    def cancel(self, command_id):
+        """
+        Cancels a queued command. Returns False if it was not queued anymore.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT imei FROM commands WHERE id = ? AND state IN ('pending', 'sent')", (command_id,)).fetchone()
+            if (row is None):
+                return(False)
+            self._db.execute("UPDATE commands SET state = 'cancelled', done = ? WHERE id = ?", (time.time(), command_id))
+            self._db.commit()
+            self._schedule(int(row[0]))
+        return(True)
+
+    def commands(self, imei=None, limit=100):
+        """
+        Returns the last commands, or those of a device, newest first.
+        """
+        with self._lock:
+            if (imei is None):
+                rows = self._db.execute('SELECT * FROM commands ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+            else:
+                rows = self._db.execute('SELECT * FROM commands WHERE imei = ? ORDER BY id DESC LIMIT ?', (format(int(imei), '015d'), limit)).fetchall()
+        return([ Command(*row) for row in rows ])
+
+    def settings(self, imei):
+        """
+        Returns the settings of a device (see DEFAULT_SETTINGS).
+        """
+        settings = dict(DEFAULT_SETTINGS)
+        settings.update(self._settings.get(imei, {}))
+        return(settings)
+
+    def setup_content(self, imei):
+        """
+        Returns the content of the answer to a setup request of a device.
+        """
+        return(self._setup_contents.get(imei, self._default_content))
+
+    def update_settings(self, imei, **changes):
+        """
+        Changes settings of a device, and returns its settings.
+        """
+        imei = int(imei)
+        unknown = set(changes) - set(DEFAULT_SETTINGS)
+        if (unknown):
+            raise ValueError('unknown settings: %s' % ', '.join(sorted(unknown)))
+        with self._lock:
+            stored = dict(self._settings.get(imei, {}))
+            stored.update(changes)
+            settings = dict(DEFAULT_SETTINGS)
+            settings.update(stored)
+            content = setup_content(settings)
+            self._db.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (format(imei, '015d'), json.dumps(stored, sort_keys=True)))
+            self._db.commit()
+            self._settings[imei] = stored
+            self._setup_contents[imei] = content
+        return(settings)
+
+    def refresh(self):
+        """
+        Reloads the commands and settings if another process changed them,
+        expires the commands queued for longer than ttl and forgets finished ones.
+        """
+        self._checked = time.monotonic()
+        with self._lock:
+            now = time.time()
+            if (now - self._purged > min(self.ttl, 3600)):
+                self._purged = now
+                self._db.execute("UPDATE commands SET state = 'expired', done = ? WHERE state IN ('pending', 'sent') AND created < ?", (now, now - self.ttl))
+                self._db.execute("DELETE FROM commands WHERE state NOT IN ('pending', 'sent') AND done < ?", (now - self.ttl,))
+                self._db.commit()
+            version = self._db.execute('PRAGMA data_version').fetchone()[0]
+            if (version == self._version):
+                return
+            self._version = version
+            self._due = {}
+            self._awaiting = {}
+            for imei, state, sent, ack_protocol in self._db.execute("SELECT imei, state, sent, ack_protocol FROM commands WHERE state IN ('pending', 'sent')"):
+                self._add(int(imei), state, sent, ack_protocol)
+            settings = {}
+            contents = {}
+            for imei, stored in self._db.execute('SELECT imei, settings FROM settings'):
+                stored = json.loads(stored)
+                merged = dict(DEFAULT_SETTINGS)
+                merged.update(stored)
+                try:
+                    contents[int(imei)] = setup_content(merged)
+                except (ValueError, TypeError, KeyError) as e:
+                    serverlog.warning(None, 'Invalid settings for %s, default settings are answered: %s', imei, e)
+                    continue
+                settings[int(imei)] = stored
+            self._settings = settings
+            self._setup_contents = contents
+
+    def stats(self):
+        """
+        Returns the number of devices with queued commands, and of commands
+        sent, sent again, acknowledged and given up by this process.
+        """
+        stats = dict(self.counts)
+        stats['devices'] = len(self._due)
+        return(stats)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _schedule(self, imei):
+        # Recomputes when the next command of a device is due (lock held)
+        self._due.pop(imei, None)
+        self._awaiting.pop(imei, None)
+        for state, sent, ack_protocol in self._db.execute("SELECT state, sent, ack_protocol FROM commands WHERE imei = ? AND state IN ('pending', 'sent')",
+                (format(imei, '015d'),)):
+            self._add(imei, state, sent, ack_protocol)
+
+    def _add(self, imei, state, sent, ack_protocol):
+        # Adds a queued command to the in-memory state of its device (lock held)
+        due = (0.0 if state == 'pending' else sent + self.retry_interval)
+        if (due < self._due.get(imei, math.inf)):
+            self._due[imei] = due
+        if (state == 'sent'):
+            self._awaiting.setdefault(imei, set()).add(ack_protocol)
+
+
+if __name__ == '__main__':
+    import argparse
+    from datetime import datetime
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Queue commands for the devices, and list them.')
+    parser.add_argument('--path', default=os.getenv('COMMAND_QUEUE_PATH', './data/commands.sqlite'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_interval = subparsers.add_parser('upload-interval', help='set the interval between positions (seconds)')
+    parser_interval.add_argument('imei')
+    parser_interval.add_argument('seconds', type=int)
+    parser_status = subparsers.add_parser('status-interval', help='set the interval between status packets (minutes)')
+    parser_status.add_argument('imei')
+    parser_status.add_argument('minutes', type=int)
+    parser_locate = subparsers.add_parser('locate', help='ask the device for its position')
+    parser_locate.add_argument('imei')
+    parser_locate.add_argument('--wifi-only', action='store_true', help='by WiFi or LBS only')
+    parser_setup = subparsers.add_parser('setup', help='change the settings of the device and send them')
+    parser_setup.add_argument('imei')
+    parser_setup.add_argument('--upload-interval', type=int, help='interval between positions (seconds)')
+    parser_setup.add_argument('--switches', type=lambda s: int(s, 2), help='switches, as bits (e.g. 00110001)')
+    parser_setup.add_argument('--sos', nargs='+', help='up to 3 SOS phone numbers')
+    parser_list = subparsers.add_parser('list', help='list the last commands')
+    parser_list.add_argument('imei', nargs='?')
+    parser_cancel = subparsers.add_parser('cancel', help='cancel a queued command')
+    parser_cancel.add_argument('id', type=int)
+    args = parser.parse_args()
+
+    queue = CommandQueue(args.path)
+    if (args.command == 'upload-interval'):
+        print('Queued command', queue.set_upload_interval(args.imei, args.seconds))
+    elif (args.command == 'status-interval'):
+        print('Queued command', queue.set_status_interval(args.imei, args.minutes))
+    elif (args.command == 'locate'):
+        print('Queued command', queue.locate(args.imei, args.wifi_only))
+    elif (args.command == 'setup'):
+        changes = {}
+        if (args.upload_interval is not None):
+            changes['upload_interval'] = args.upload_interval
+        if (args.switches is not None):
+            changes['switches'] = args.switches
+        if (args.sos is not None):
+            changes['phones'] = (args.sos + ['', '', ''])[:3]
+        print('Queued command', queue.setup(args.imei, **changes))
+    elif (args.command == 'cancel'):
+        print('Cancelled' if queue.cancel(args.id) else 'Not queued anymore')
+    else:
+        for command in queue.commands(args.imei):
+            print(command.id, command.imei, command.kind, command.frame.hex(), command.state, command.attempts,
+                datetime.fromtimestamp(command.created).strftime('%Y/%m/%d %H:%M:%S'), sep='\t')
+    queue.close()
@@ -0,0 +1,249 @@
+"""
+Approximate matching of WiFi scans against scans that were already located.
+
+From one WiFi/LBS packet to the next, RSSI values jitter and one or two
+hotspots appear or disappear: the exact fingerprint of the geolocation
+cache misses, although the device has not moved.
+This index finds previously located scans that share most of their
+hotspots with a new scan, so that its position can be answered locally.
+
+Scans are compared by the Jaccard similarity of their BSSID sets, weighted
+by signal strength (strong hotspots count more, by being repeated in the
+set). Similarity is estimated with MinHash signatures, and candidates are
+found with locality-sensitive hashing (LSH): signatures are cut into bands,
+and two scans sharing any band are candidates. Lookups only touch the
+buckets of the bands of the query, whatever the number of stored scans.
+
+Located scans are appended to a binary file, replayed when the index is
+opened, so that the index survives restarts. Several processes may share
+the file (see supervisor.py): each of them follows the records appended to
+it, its own as well as those of the other processes.
+"""
+
+from array import array
+from threading import Lock
+import os
+import random
+import struct
+
+
+# Band keys stored in the hash table: band number in the high byte, hash of the band below
+BAND_KEY_MASK = (1 << 56) - 1
+
+# Record of the persistence file: latitude, longitude, accuracy, number of hotspots,
+# followed by each hotspot as BSSID (6 bytes) and weight
+RECORD_HEADER = struct.Struct('<ddfB')
+RECORD_HOTSPOT = struct.Struct('<6sB')
+
+
+def rssi_weight(rssi):
+    """
+    Weight of a hotspot in the set, given its RSSI in dBm.
+    """
+    if (rssi >= -60):
+        return(3)
+    elif (rssi >= -75):
+        return(2)
+    return(1)
+
+
+def scan_tokens(hotspots):
+    """
+    Returns the weighted set of a scan as integers: each hotspot given as
+    (BSSID bytes, weight) contributes one token per unit of weight.
+    """
+    tokens = []
+    for bssid, weight in hotspots:
+        value = int.from_bytes(bssid, 'big') << 2
+        for i in range(weight):
+            tokens.append(value | i)
+    return(tokens)
+
+
+class FingerprintIndex():
+    """
+    MinHash/LSH index of located WiFi scans.
+
+    bands * rows is the size of the signatures: with the defaults, two scans
+    with a similarity of 0.6 are found as candidates with a probability of
+    1 - (1 - 0.6 ** rows) ** bands, about 0.97, and the estimated similarity
+    of candidates is then checked against the threshold.
+
+    To hold millions of scans, everything is stored in flat arrays rather than
+    Python objects: LSH buckets are an open-addressing hash table of band keys,
+    each pointing to the last scan of the bucket, and scans of a same bucket
+    are chained through the _next array.
+    """
+
+    def __init__(self, path=None, bands=8, rows=2, threshold=0.6, min_hotspots=2, seed=5023):
+        self.bands = bands
+        self.rows = rows
+        self.threshold = threshold
+        self.min_hotspots = min_hotspots
+        self.size = bands * rows
+
+        # Salts of the hash functions, identical from one run to the next
+        rng = random.Random(seed)
+        self._salts = [ rng.getrandbits(62) for i in range(self.size) ]
+
+        # Stored scans: signatures, positions and accuracies
+        self._signatures = array('q')
+        self._latitudes = array('d')
+        self._longitudes = array('d')
+        self._accuracies = array('f')
+        # LSH buckets: band keys (0 for empty slots) and 1 + number of the last scan
+        self._keys = array('Q', bytes(8 * 1024))
+        self._heads = array('I', bytes(4 * 1024))
+        self._used = 0
+        # 1 + number of the previous scan in the same bucket, for each scan and band (0 ends the chain)
+        self._next = array('I')
+        self._lock = Lock()
+
+        self._file = None
+        self._reader = None
+        # Length of the file replayed so far
+        self._offset = 0
+        if (path):
+            directory = os.path.dirname(path)
+            if (directory):
+                os.makedirs(directory, exist_ok=True)
+            if (os.path.exists(path)):
+                with open(path, 'rb') as f:
+                    self._offset = self._replay(f.read())
+                if (self._offset < os.path.getsize(path)):
+                    os.truncate(path, self._offset)
+            self._file = open(path, 'ab')
+            self._reader = open(path, 'rb')
+
+    def __len__(self):
+        return(len(self._latitudes))
+
+    def signature(self, tokens):
+        """
+        MinHash signature of a set of tokens.
+        """
+        return([ min([ hash((salt, t)) for t in tokens ]) for salt in self._salts ])
+
+    def add(self, hotspots, latitude, longitude, accuracy):
+        """
+        Stores a located scan, given as a list of (BSSID bytes, weight).
+        """
+        if (len(hotspots) < self.min_hotspots):
+            return
+        with self._lock:
+            if (self._file is None):
+                self._insert(hotspots, latitude, longitude, accuracy)
+                return
+            # The record is inserted when it is read back from the file, in the
+            # order in which records of all processes were appended
+            record = RECORD_HEADER.pack(latitude, longitude, accuracy, len(hotspots))
+            record += b''.join([ RECORD_HOTSPOT.pack(bssid, weight) for bssid, weight in hotspots ])
+            self._file.write(record)
+            self._file.flush()
+            self._follow()
+
+    def lookup(self, hotspots):
+        """
+        Returns (latitude, longitude, accuracy, similarity) of the most similar
+        stored scan, if its similarity is above the threshold, or None.
+        The accuracy of the stored scan is degraded as similarity decreases.
+        """
+        if (len(hotspots) < self.min_hotspots):
+            return(None)
+        signature = self.signature(scan_tokens(hotspots))
+        size = self.size
+
+        with self._lock:
+            if (self._file is not None):
+                self._follow()
+            candidates = set()
+            for band, key in enumerate(self._band_keys(signature)):
+                scan = self._heads[self._slot(key)]
+                while (scan):
+                    candidates.add(scan - 1)
+                    scan = self._next[(scan - 1) * self.bands + band]
+
+            best = None
+            best_similarity = self.threshold
+            signatures = self._signatures
+            for candidate in candidates:
+                offset = candidate * size
+                similarity = sum([ 1 for i in range(size) if signature[i] == signatures[offset + i] ]) / size
+                if (similarity >= best_similarity):
+                    best = candidate
+                    best_similarity = similarity
+
+            if (best is None):
+                return(None)
+            return(self._latitudes[best], self._longitudes[best], self._accuracies[best] / best_similarity, best_similarity)
+
+    def _band_keys(self, signature):
+        rows = self.rows
+        return([ ((band + 1) << 56) | (hash(tuple(signature[band * rows:(band + 1) * rows])) & BAND_KEY_MASK) for band in range(self.bands) ])
+
+    def _slot(self, key):
+        # Slot of a key in the hash table (linear probing): either the key or an empty slot
+        keys = self._keys
+        capacity = len(keys)
+        slot = key % capacity
+        while (keys[slot] != key and keys[slot] != 0):
+            slot = (slot + 1) % capacity
+        return(slot)
+
+    def _grow(self):
+        keys = self._keys
+        heads = self._heads
+        self._keys = array('Q', bytes(16 * len(keys)))
+        self._heads = array('I', bytes(8 * len(heads)))
+        for slot in range(len(keys)):
+            if (keys[slot]):
+                new_slot = self._slot(keys[slot])
+                self._keys[new_slot] = keys[slot]
+                self._heads[new_slot] = heads[slot]
+
+    def _insert(self, hotspots, latitude, longitude, accuracy):
+        # Must be called with the lock held (or while replaying)
+        signature = self.signature(scan_tokens(hotspots))
+        number = len(self._latitudes)
+        self._signatures.extend(signature)
+        self._latitudes.append(latitude)
+        self._longitudes.append(longitude)
+        self._accuracies.append(accuracy)
+        for key in self._band_keys(signature):
+            if (2 * (self._used + 1) > len(self._keys)):
+                self._grow()
+            slot = self._slot(key)
+            if (self._keys[slot] == 0):
+                self._keys[slot] = key
+                self._used += 1
+            self._next.append(self._heads[slot])
+            self._heads[slot] = number + 1
+
+    def _follow(self):
+        # Replays the records appended to the file since it was last read (lock held)
+        size = os.fstat(self._reader.fileno()).st_size
+        if (size > self._offset):
+            self._reader.seek(self._offset)
+            self._offset += self._replay(self._reader.read(size - self._offset))
+
+    def _replay(self, data):
+        # Inserts the records of data, and returns its length up to its last complete record
+        offset = 0
+        while (offset + RECORD_HEADER.size <= len(data)):
+            latitude, longitude, accuracy, n = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + n * RECORD_HOTSPOT.size
+            if (end > len(data)):
+                # Truncated last record (server stopped while writing, or record being appended)
+                break
+            hotspots = [ RECORD_HOTSPOT.unpack_from(data, offset + RECORD_HEADER.size + i * RECORD_HOTSPOT.size) for i in range(n) ]
+            self._insert(hotspots, latitude, longitude, accuracy)
+            offset = end
+        return(offset)
+
+
+def wifi_hotspots(wifi):
+    """
+    Converts the WiFi list of a client position dictionary (MAC address
+    strings and RSSI) into the (BSSID bytes, weight) pairs used by the index.
+    """
+    return([ (bytes.fromhex(w['macAddress'].replace(':', '')), rssi_weight(w['signalStrength'])) for w in wifi ])
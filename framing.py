@@ -0,0 +1,155 @@
+"""
+Stream framing for the TOPIN protocol.
+
+TCP is a stream: over a lossy 2G link, and when a device flushes its
+buffered (offline) positions after reconnecting, a single recv() may
+return several packets at once, or only part of one.
+The FrameDecoder below keeps the bytes received on a connection in a
+buffer and cuts them into complete 0x7878 ... 0x0D0A frames, whatever
+the way they were split by the network.
+
+The length byte that follows the start marker can not be trusted to
+find the end of a frame (for WiFi packets it is the number of hotspots),
+so frames are delimited by their stop bytes, searched for after the
+minimal length of the frame for its protocol number.
+"""
+
+
+START = b'\x78\x78'
+STOP = b'\x0d\x0a'
+
+# Smallest possible frame: start, length, protocol, stop
+MIN_FRAME_LENGTH = 6
+
+# Above this size, a frame that is still missing its stop bytes is garbage
+MAX_FRAME_LENGTH = 1024
+
+# Minimal length of the frames (start and stop bytes included) for protocols
+# with a known layout, so that stop bytes appearing by chance within the
+# binary content (e.g. latitude) are not mistaken for the end of the frame.
+MIN_LENGTH_BY_PROTOCOL = {
+    0x01: 15,   # login: IMEI (8 bytes) + software version
+    0x10: 24,   # GPS positioning: datetime, satellites, lat, lon, speed, flags
+    0x11: 24,   # Offline GPS positioning
+    0x13: 9,    # status: battery (e.g. 13% = 0x0d), software version (e.g. 0x0a), upload interval
+    0x98: 8,    # upload interval (2 bytes)
+}
+
+
+def wifi_lbs_frame_length(buffer, start, end):
+    """
+    Returns the exact length of a WiFi/LBS frame (0x17 or 0x69) starting at
+    offset start of the buffer, or None if not enough bytes were received
+    yet to know it.
+    The frame is made of N WiFi hotspots (7 bytes each) after the datetime,
+    then the number of GSM cells, MCC/MNC and 5 bytes per cell.
+    """
+
+    n_wifi = buffer[start + 2]
+    if (10 + (7 * n_wifi) >= MAX_FRAME_LENGTH):
+        return(MAX_FRAME_LENGTH + 1)
+    n_cells_offset = start + 10 + (7 * n_wifi)
+    if (n_cells_offset >= end):
+        return(None)
+    n_cells = buffer[n_cells_offset]
+    return(10 + (7 * n_wifi) + 1 + 3 + (5 * n_cells) + 2)
+
+
+class FrameDecoder():
+    """
+    Incremental decoder that reassembles frames from the chunks of bytes
+    received on one connection.
+
+    The received bytes are appended to a buffer that is consumed from its
+    head, like a ring buffer: the consumed part is only discarded once it
+    outweighs the pending data, so that a burst of frames does not cost
+    one copy of the buffer per frame.
+    """
+
+    __slots__ = ('_buffer', '_head', 'discarded')
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._head = 0
+        # Number of bytes dropped while resynchronizing on a start marker
+        self.discarded = 0
+
+    def feed(self, data):
+        """
+        Appends newly received bytes and returns the list of all the frames
+        that are now complete, in order. Incomplete data is kept for the
+        next call.
+        """
+
+        buffer = self._buffer
+        if (self._head and self._head >= len(buffer) - self._head):
+            del buffer[:self._head]
+            self._head = 0
+        buffer += data
+
+        frames = []
+        while (True):
+            frame = self._next_frame()
+            if (frame is None):
+                break
+            frames.append(frame)
+        return(frames)
+
+    def pending(self):
+        """
+        Returns the number of bytes waiting for the rest of their frame.
+        """
+        return(len(self._buffer) - self._head)
+
+    def _next_frame(self):
+        buffer = self._buffer
+        end = len(buffer)
+
+        while (True):
+            start = self._head
+
+            # Resynchronize on the start marker, dropping anything before it
+            if (buffer[start:start + 2] != START):
+                marker = buffer.find(START, start)
+                if (marker == -1):
+                    # Keep a trailing 0x78, it may be the first half of a marker
+                    keep = 1 if (end > start and buffer[end - 1] == 0x78) else 0
+                    self.discarded += end - start - keep
+                    self._head = end - keep
+                    return(None)
+                self.discarded += marker - start
+                self._head = start = marker
+
+            if (end - start < MIN_FRAME_LENGTH):
+                return(None)
+
+            # A stray 0x78 right before the marker: the frame starts one byte later
+            if (buffer[start + 2] == 0x78):
+                self.discarded += 1
+                self._head = start + 1
+                continue
+
+            # Find where the stop bytes may be, depending on the protocol
+            protocol = buffer[start + 3]
+            if (protocol == 0x17 or protocol == 0x69):
+                min_length = wifi_lbs_frame_length(buffer, start, end)
+                if (min_length is None):
+                    # Number of GSM cells not received yet
+                    return(None)
+            else:
+                min_length = MIN_LENGTH_BY_PROTOCOL.get(protocol, MIN_FRAME_LENGTH)
+
+            stop = -1
+            if (min_length <= MAX_FRAME_LENGTH):
+                stop = buffer.find(STOP, start + min_length - 2, start + MAX_FRAME_LENGTH)
+            if (stop != -1):
+                self._head = stop + 2
+                return(bytes(buffer[start:stop + 2]))
+
+            # No stop bytes yet: wait for more data, unless this cannot be a frame
+            if (min_length <= MAX_FRAME_LENGTH and end - start < MAX_FRAME_LENGTH):
+                return(None)
+
+            # Garbage: skip this start marker and look for the next one
+            self.discarded += 2
+            self._head = start + 2
@@ -0,0 +1,159 @@
+"""
+Cache of geolocation results for WiFi/LBS scans.
+
+A device that does not move sends the same WiFi hotspots and GSM cells
+over and over again: each of these scans would cost a (paid) query to the
+Google Maps Geolocation API and hundreds of milliseconds.
+Results are cached here, keyed on a fingerprint of the scan that does not
+depend on the order of hotspots and cells, nor on their signal strength.
+
+The cache is made of two levels:
+    - an in-memory LRU dictionary, bounded in number of entries,
+    - a SQLite file, so that results survive restarts of the server and can
+      be shared by several server processes.
+Entries expire after a TTL. Errors returned by the API are cached as well
+(negative caching) but with a shorter TTL, so that a scan that cannot be
+located is not queried again and again.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import json
+import os
+import sqlite3
+import time
+
+
+def scan_fingerprint(positionDict):
+    """
+    Returns the cache key of a scan, given the position dictionary of a client
+    (the one sent to GoogleMaps_geolocation_service()): MCC and MNC, sorted
+    (LAC, Cell ID) pairs and sorted BSSIDs.
+    """
+    cells = sorted([ (c['locationAreaCode'], c['cellId']) for c in positionDict['gsm-cells'] ])
+    bssids = sorted([ w['macAddress'].lower().replace(':', '') for w in positionDict['wifi'] ])
+    return('%d-%d|%s|%s' % (positionDict['gsm-carrier']['MCC'], positionDict['gsm-carrier']['MNC'],
+                            ','.join([ '%d:%d' % c for c in cells ]), ','.join(bssids)))
+
+
+def parse_fingerprint(key):
+    """
+    Reverse of scan_fingerprint(): returns MCC, MNC, the list of (LAC, Cell ID)
+    pairs and the list of BSSIDs (as 12 hex characters) of a cache key.
+    """
+    carrier, cells, bssids = key.split('|')
+    mcc, mnc = [ int(x) for x in carrier.split('-') ]
+    cells = [ tuple(int(x) for x in c.split(':')) for c in cells.split(',') if c ]
+    bssids = [ b for b in bssids.split(',') if b ]
+    return(mcc, mnc, cells, bssids)
+
+
+class GeolocationCache():
+    """
+    LRU cache with TTL and negative caching, persisted to a SQLite file.
+    Thread-safe: it is shared by all the connections of the server.
+    """
+
+    def __init__(self, path=None, max_entries=10000, ttl=7 * 24 * 3600, negative_ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db = None
+        if (path):
+            directory = os.path.dirname(path)
+            if (directory):
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS geocache (key TEXT PRIMARY KEY, result TEXT NOT NULL, expires REAL NOT NULL)')
+            self._db.execute('DELETE FROM geocache WHERE expires < ?', (time.time(),))
+            self._db.commit()
+
+    def get(self, key):
+        """
+        Returns the cached result for a scan fingerprint, or None if it is
+        not cached or has expired.
+        """
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and entry[1] < now):
+                del self._entries[key]
+                entry = None
+
+            # Not in memory: another process may have stored it in the file
+            if (entry is None and self._db is not None):
+                row = self._db.execute('SELECT result, expires FROM geocache WHERE key = ? AND expires >= ?', (key, now)).fetchone()
+                if (row is not None):
+                    entry = (json.loads(row[0]), row[1])
+                    self._store(key, entry)
+
+            if (entry is None):
+                self.misses += 1
+                return(None)
+
+            self._entries.move_to_end(key)
+            if ('error' in entry[0]):
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return(entry[0])
+
+    def put(self, key, result):
+        """
+        Stores the result of the API for a scan fingerprint.
+        Results holding an 'error' key are cached for negative_ttl only.
+        """
+
+        expires = time.time() + (self.negative_ttl if ('error' in result) else self.ttl)
+        with self._lock:
+            self._store(key, (result, expires))
+            if (self._db is not None):
+                self._db.execute('INSERT OR REPLACE INTO geocache (key, result, expires) VALUES (?, ?, ?)', (key, json.dumps(result), expires))
+                self._db.commit()
+
+    def items(self):
+        """
+        Returns all the (key, result) pairs that have not expired, from the
+        file if the cache is persisted, or from memory otherwise.
+        """
+
+        now = time.time()
+        with self._lock:
+            if (self._db is not None):
+                rows = self._db.execute('SELECT key, result FROM geocache WHERE expires >= ?', (now,)).fetchall()
+                return([ (key, json.loads(result)) for key, result in rows ])
+            return([ (key, entry[0]) for key, entry in self._entries.items() if entry[1] >= now ])
+
+    def stats(self):
+        """
+        Returns hit/miss statistics of the cache.
+        """
+
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return({
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': ((self.hits + self.negative_hits) / lookups if lookups else 0.0),
+            })
+
+    def _store(self, key, entry):
+        # Must be called with the lock held
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while (len(self._entries) > self.max_entries):
+            self._entries.popitem(last=False)
+            self.evictions += 1
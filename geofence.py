@@ -0,0 +1,303 @@
+"""
+Geofences: events when devices enter or leave areas ("the cat left the
+garden", "the cat entered the neighbour's yard").
+
+Fences are circles or polygons, for one device or for all of them, read
+from a JSON file (reloaded when it changes):
+
+    [
+        {"id": "garden", "name": "Garden", "imei": "359339075016807",
+         "polygon": [[48.8566, 2.3522], [48.8567, 2.3530], [48.8560, 2.3531]]},
+        {"id": "vet", "name": "Veterinary clinic",
+         "circle": {"latitude": 48.8600, "longitude": 2.3400, "radius": 30}}
+    ]
+
+(coordinates in degrees, radius in meters; without an IMEI, a fence applies
+to every device).
+
+Every fix is checked against the fences around it, found in a grid index
+(fences are listed in every cell of 0.01 degree their bounding box covers),
+and against the fences the device is inside of. Whether a device is inside
+or outside of a fence is kept per (IMEI, fence), and only changes when the
+fix is clearly on the other side of the border: by more than its accuracy
+(WiFi/LBS positions are hundreds of meters off) or than a margin (GPS
+jitter), whichever is larger. Fixes closer to the border leave the state as
+it is, so that a device along the border does not flap in and out.
+
+The first fix of a device after a restart only sets its state: events are
+only sent for changes seen by the server.
+"""
+
+from collections import namedtuple
+from threading import Lock
+import json
+import math
+import os
+import serverlog
+import time
+
+
+# Meters per degree of latitude (spherical Earth)
+METERS_PER_DEGREE = math.pi * 6371000.0 / 180
+
+# Size of the cells of the grid index, in degrees
+CELL_SIZE = 0.01
+
+# Fences covering more cells than this are checked for every fix of their devices instead
+MAX_CELLS = 10000
+
+GeofenceEvent = namedtuple('GeofenceEvent', ['event', 'imei', 'fence', 'name', 'timestamp', 'latitude', 'longitude', 'accuracy', 'method'])
+
+
+class Fence():
+    """
+    Circle (center and radius) or polygon (list of (latitude, longitude)
+    vertices) of one device (imei) or of all devices (imei 0).
+    Coordinates are projected in meters around the center of the fence.
+    """
+
+    __slots__ = ('id', 'name', 'imei', 'bbox', 'latitude', 'longitude', 'scale', 'radius', 'xs', 'ys')
+
+    def __init__(self, fence_id, name='', imei=0, circle=None, polygon=None):
+        self.id = fence_id
+        self.name = name
+        self.imei = imei
+        if (circle is not None):
+            self.latitude, self.longitude, self.radius = circle
+            if (not self.radius > 0):
+                raise ValueError('fence %r: radius must be positive' % (fence_id,))
+            self.scale = METERS_PER_DEGREE * math.cos(math.radians(self.latitude))
+            self.xs = self.ys = None
+            dlat = self.radius / METERS_PER_DEGREE
+            dlon = self.radius / max(self.scale, 1e-6)
+            self.bbox = (self.latitude - dlat, self.longitude - dlon, self.latitude + dlat, self.longitude + dlon)
+        elif (polygon is not None and len(polygon) >= 3):
+            latitudes = [ vertex[0] for vertex in polygon ]
+            longitudes = [ vertex[1] for vertex in polygon ]
+            self.bbox = (min(latitudes), min(longitudes), max(latitudes), max(longitudes))
+            self.latitude = (self.bbox[0] + self.bbox[2]) / 2
+            self.longitude = (self.bbox[1] + self.bbox[3]) / 2
+            self.scale = METERS_PER_DEGREE * math.cos(math.radians(self.latitude))
+            self.radius = None
+            self.xs = [ (longitude - self.longitude) * self.scale for longitude in longitudes ]
+            self.ys = [ (latitude - self.latitude) * METERS_PER_DEGREE for latitude in latitudes ]
+        else:
+            raise ValueError('fence %r: a circle or a polygon of at least 3 vertices is needed' % (fence_id,))
+
+    def distance(self, latitude, longitude):
+        """
+        Returns the distance from a position to the border of the fence, in
+        meters: negative inside, positive outside.
+        """
+        x = (longitude - self.longitude) * self.scale
+        y = (latitude - self.latitude) * METERS_PER_DEGREE
+        if (self.radius is not None):
+            return(math.hypot(x, y) - self.radius)
+
+        # Crossings of a ray towards +x (inside if odd), and closest edge
+        xs, ys = self.xs, self.ys
+        inside = False
+        closest = math.inf
+        x1, y1 = xs[-1] - x, ys[-1] - y
+        for i in range(len(xs)):
+            x2, y2 = xs[i] - x, ys[i] - y
+            if ((y1 > 0) != (y2 > 0) and x1 + (0 - y1) * (x2 - x1) / (y2 - y1) > 0):
+                inside = not inside
+            dx, dy = x2 - x1, y2 - y1
+            length = dx * dx + dy * dy
+            t = (0.0 if length == 0 else min(1.0, max(0.0, -(x1 * dx + y1 * dy) / length)))
+            ex, ey = x1 + t * dx, y1 + t * dy
+            d = ex * ex + ey * ey
+            if (d < closest):
+                closest = d
+            x1, y1 = x2, y2
+        closest = math.sqrt(closest)
+        return(-closest if inside else closest)
+
+
+def parse_fences(data):
+    """
+    Returns the fences of a list of definitions, as loaded from the JSON file.
+    """
+    fences = []
+    ids = set()
+    for definition in data:
+        fence_id = str(definition['id'])
+        if (fence_id in ids):
+            raise ValueError('fence %r is defined twice' % (fence_id,))
+        ids.add(fence_id)
+        circle = definition.get('circle')
+        if (circle is not None):
+            circle = (float(circle['latitude']), float(circle['longitude']), float(circle['radius']))
+        polygon = definition.get('polygon')
+        if (polygon is not None):
+            polygon = [ (float(latitude), float(longitude)) for latitude, longitude in polygon ]
+        fences.append(Fence(fence_id, definition.get('name', ''), int(definition.get('imei') or 0), circle, polygon))
+    return(fences)
+
+
+class GeofenceIndex():
+    """
+    Grid index of fences, by IMEI (0 for the fences of all devices) and cell.
+    Read-only once built.
+    """
+
+    def __init__(self, fences, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.fences = { fence.id: fence for fence in fences }
+        # Fences by (IMEI, cell row, cell column), and fences too large for the grid by IMEI
+        self.cells = {}
+        self.large = {}
+        for fence in fences:
+            r0, c0 = self.cell(fence.bbox[0], fence.bbox[1])
+            r1, c1 = self.cell(fence.bbox[2], fence.bbox[3])
+            if ((r1 - r0 + 1) * (c1 - c0 + 1) > MAX_CELLS):
+                self.large.setdefault(fence.imei, []).append(fence)
+                continue
+            for row in range(r0, r1 + 1):
+                for column in range(c0, c1 + 1):
+                    self.cells.setdefault((fence.imei, row, column), []).append(fence)
+
+    def __len__(self):
+        return(len(self.fences))
+
+    def cell(self, latitude, longitude):
+        return(int(math.floor(latitude / self.cell_size)), int(math.floor(longitude / self.cell_size)))
+
+    def candidates(self, imei, latitude, longitude):
+        """
+        Returns the fences of a device (and of all devices) whose bounding
+        box may hold a position.
+        """
+        row, column = self.cell(latitude, longitude)
+        fences = self.cells.get((imei, row, column), []) + self.cells.get((0, row, column), [])
+        for key in (imei, 0):
+            for fence in self.large.get(key, ()):
+                bbox = fence.bbox
+                if (bbox[0] <= latitude <= bbox[2] and bbox[1] <= longitude <= bbox[3]):
+                    fences.append(fence)
+        return(fences)
+
+
+class GeofenceEngine():
+    """
+    Checks the fixes of the devices against the fences, and returns the
+    events. Thread-safe.
+
+        - path: JSON file of the fences (None or a missing file: no fences),
+        - margin: smallest distance to the border for a fix to change the
+          state of a device, in meters,
+        - reload_interval: time between checks of the file for changes, in seconds.
+    """
+
+    def __init__(self, path=None, margin=10.0, reload_interval=5.0, cell_size=CELL_SIZE):
+        self.path = path
+        self.margin = margin
+        self.reload_interval = reload_interval
+        self.cell_size = cell_size
+        self.index = GeofenceIndex([], cell_size)
+        self.evaluations = 0
+        self.events = 0
+        # Timestamp of the last fix and ids of the fences it was inside of, by IMEI
+        self._states = {}
+        self._lock = Lock()
+        self._version = None
+        self._checked = -math.inf
+        self.reload()
+
+    def load(self, fences):
+        """
+        Replaces the fences. Devices keep their state for the fences that remain.
+        """
+        self.index = GeofenceIndex(fences, self.cell_size)
+
+    def reload(self):
+        """
+        Loads the fences from the file if it changed. Returns True if it did.
+        An invalid file is reported, and the fences are kept as they were.
+        """
+        self._checked = time.monotonic()
+        if (self.path is None):
+            return(False)
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            stat = None
+        version = (None if stat is None else (stat.st_mtime_ns, stat.st_size))
+        if (version == self._version):
+            return(False)
+        self._version = version
+        if (stat is None):
+            self.load([])
+            return(True)
+        try:
+            with open(self.path) as f:
+                self.load(parse_fences(json.load(f)))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            serverlog.warning(None, 'Could not load the geofences of %s: %s', self.path, e)
+            return(False)
+        return(True)
+
+    def evaluate(self, imei, timestamp, latitude, longitude, accuracy=0.0, method='GPS'):
+        """
+        Checks a fix of a device against the fences. Returns the events
+        ('enter' and 'exit') it causes. Fixes older than the last one of the
+        device (sent offline) are ignored.
+        """
+        if (time.monotonic() - self._checked > self.reload_interval):
+            self.reload()
+        index = self.index
+        imei = int(imei)
+        # The fix is known to be inside or outside of a fence beyond this distance to its border (NaN: unknown accuracy)
+        margin = (accuracy if accuracy > self.margin else self.margin)
+
+        with self._lock:
+            self.evaluations += 1
+            state = self._states.get(imei)
+            if (state is not None and timestamp < state[0]):
+                return([])
+            inside = (set() if state is None else state[1])
+            if (not index.fences and not inside):
+                self._states[imei] = (timestamp, inside)
+                return([])
+
+            events = []
+            entered = set()
+            # Fences around the fix, to enter (the fix must be within their bounding box)
+            for fence in index.candidates(imei, latitude, longitude):
+                bbox = fence.bbox
+                if (fence.id not in inside and bbox[0] <= latitude <= bbox[2] and bbox[1] <= longitude <= bbox[3]
+                        and fence.distance(latitude, longitude) <= -margin):
+                    entered.add(fence.id)
+                    events.append(GeofenceEvent('enter', imei, fence.id, fence.name, timestamp, latitude, longitude, accuracy, method))
+            # Fences the device is inside of, to leave (fences that were removed are forgotten)
+            left = set()
+            for fence_id in inside:
+                fence = index.fences.get(fence_id)
+                if (fence is None):
+                    left.add(fence_id)
+                elif (fence.distance(latitude, longitude) >= margin):
+                    left.add(fence_id)
+                    events.append(GeofenceEvent('exit', imei, fence.id, fence.name, timestamp, latitude, longitude, accuracy, method))
+            if (entered or left):
+                inside = (inside - left) | entered
+            self._states[imei] = (timestamp, inside)
+            if (state is None):
+                # First fix of the device: it only sets its state
+                return([])
+            self.events += len(events)
+        return(events)
+
+    def inside(self, imei):
+        """
+        Returns the ids of the fences a device is inside of.
+        """
+        with self._lock:
+            state = self._states.get(int(imei))
+        return(set() if state is None else set(state[1]))
+
+    def stats(self):
+        """
+        Returns the number of fences, of fixes evaluated and of events.
+        """
+        return({'fences': len(self.index), 'evaluations': self.evaluations, 'events': self.events})
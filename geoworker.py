@@ -0,0 +1,116 @@
+"""
+Bounded worker pool for slow external calls, such as the Google Maps
+Geolocation API.
+
+Connections must never wait for such calls: jobs are run by a fixed number
+of worker threads, and their result is handed to a callback. The number of
+pending jobs is bounded, so that a slow API cannot pile up unlimited work,
+and a circuit breaker stops sending jobs for a while after repeated
+failures, instead of letting every device wait for a timeout.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+import time
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised (passed to the callback) when the circuit breaker rejects a job.
+    """
+
+
+class QueueFullError(Exception):
+    """
+    Raised (passed to the callback) when too many jobs are already pending.
+    """
+
+
+class CircuitBreaker():
+    """
+    Classic three-state circuit breaker:
+        - closed: jobs are allowed, consecutive failures are counted,
+        - open: after failure_threshold consecutive failures, jobs are
+          rejected for reset_timeout seconds,
+        - half-open: then one trial job is allowed, which closes the circuit
+          if it succeeds or opens it again if it fails.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = 0
+        self._lock = Lock()
+
+    def allow(self):
+        """
+        Returns True if a job may be run now.
+        """
+        with self._lock:
+            if (self.state == 'closed'):
+                return(True)
+            if (self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_timeout):
+                # Let a single trial job through
+                self.state = 'half-open'
+                return(True)
+            return(False)
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == 'half-open' or self.failures >= self.failure_threshold):
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+
+class WorkerPool():
+    """
+    Runs jobs on max_workers threads, with at most max_pending jobs queued
+    or running. Each job ends with a call to callback(result, error) from
+    the worker thread, where error is None on success.
+    """
+
+    def __init__(self, max_workers=4, max_pending=100, breaker=None):
+        self.breaker = breaker if (breaker is not None) else CircuitBreaker()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='geolocation')
+        self._slots = BoundedSemaphore(max_pending)
+        self.rejected = 0
+
+    def submit(self, function, args, callback):
+        """
+        Schedules function(*args). Returns False (after calling the callback
+        with the error) if the job was rejected.
+        """
+        # The slot is taken first: a trial job of the half-open breaker must
+        # not be rejected afterwards, or the breaker would never close again
+        if (not self._slots.acquire(blocking=False)):
+            self.rejected += 1
+            callback(None, QueueFullError('too many pending jobs'))
+            return(False)
+        if (not self.breaker.allow()):
+            self._slots.release()
+            self.rejected += 1
+            callback(None, CircuitOpenError('circuit breaker is open'))
+            return(False)
+        self._executor.submit(self._run, function, args, callback)
+        return(True)
+
+    def _run(self, function, args, callback):
+        try:
+            try:
+                result = function(*args)
+            except Exception as e:
+                self.breaker.record_failure()
+                callback(None, e)
+            else:
+                self.breaker.record_success()
+                callback(result, None)
+        finally:
+            self._slots.release()
@@ -10,19 +10,47 @@ sending and receiving TCP packets over 2G network.
 This program will create a TCP socket and each client will have
 its dedicated thread created, so that multipe clients can connect 
 simultaneously should this be necessary someday.
+Alternatively, the server can run in 'asyncio' mode (set SERVER_MODE
+in the .env file), where all clients are served from a single event loop
+instead, which scales to many more idle devices.
+With SERVER_WORKERS above 1, several worker processes share the port
+(see supervisor.py), to use more than one core.
 
 This server is based on the work from:
 https://medium.com/swlh/lets-write-a-chat-app-in-python-f6783a9ac170
 """
 
 from dotenv import load_dotenv
-from socket import AF_INET, socket, SOCK_STREAM
-from threading import Thread
-from datetime import datetime
-from dateutil import tz
+from socket import AF_INET, socket, SOCK_STREAM, SOL_SOCKET, SO_REUSEPORT, SHUT_RDWR, MSG_DONTWAIT
+from threading import Thread, get_ident
+from command_queue import CommandQueue
+from framing import FrameDecoder
+from geofence import GeofenceEngine
+from geocache import GeolocationCache, scan_fingerprint
+from fingerprint_index import FingerprintIndex, wifi_hotspots
+from geoworker import CircuitBreaker, WorkerPool
+from opencellid import CellDatabase
+from bssid_learner import BssidLearner, wifi_observations
+from logwriter import LogWriter
+from position_store import Position
+from track_simplifier import TieredStore
+from session import Session, SessionTable
+from session_registry import SessionRegistry
+from timer_wheel import IdleReaper
+import clock
+import codec
+import live_feed
+import metrics
+import serverlog
+import supervisor
+import asyncio
+import atexit
 import googlemaps
 import math
 import os
+import signal
+import sys
+import time
 
 
 def accept_incoming_connections():
@@ -33,49 +61,145 @@ def accept_incoming_connections():
     
     while True:
         client, client_address = SERVER.accept()
-        print('%s:%s has connected.' % client_address)
         
-        # Initialize the dictionaries
-        addresses[client] = {}
-        positions[client] = {}
-        
-        # Add current client address into adresses
-        addresses[client]['address'] = client_address
-        Thread(target=handle_client, args=(client,)).start()
+        # New session for that client, indexed by IMEI once the device logs in
+        session = Session(client, client_address, FrameDecoder(), codec.ResponseBuilder())
+        serverlog.info(session, 'Connected from port %d.', client_address[1])
+        session.set_timeout(IDLE_TIMEOUTS['login'])
+        idle_reaper.watch(session)
+        connections_open.inc()
+        Thread(target=handle_client, args=(session,), daemon=True).start()
 
 def LOGGER(event, filename, ip, client, type, data):
     """
     A logging function to store all input packets, 
     as well as output ones when they are generated.
 
-    There are two types of logs implemented: 
+    There are three types of logs implemented: 
         - a general (info) logger that will keep track of all 
             incoming and outgoing packets,
         - a position (location) logger that will write to a 
-            file contianing only results og GPS or LBS data.
+            file contianing only results og GPS or LBS data,
+        - a geofence logger, for devices entering or leaving geofences.
+
+    Lines are only queued here: they are timestamped and written to the
+    files of ./logs/ by the background thread of log_writer.
     """
     
-    with open(os.path.join('./logs/', filename), 'a+') as log:
-        if (event == 'info'):
-            # TSV format of: Timestamp, Client IP, IN/OUT, Packet
-            logMessage = datetime.now().strftime('%Y/%m/%d %H:%M:%S') + '\t' + ip + '\t' + client + '\t' + type + '\t' + data + '\n'
-        elif (event == 'location'):
-            # TSV format of: Timestamp, Client IP, Location DateTime, GPS/LBS, Validity, Nb Sat, Latitude, Longitude, Accuracy, Speed, Heading
-            logMessage = datetime.now().strftime('%Y/%m/%d %H:%M:%S') + '\t' + ip + '\t' + client + '\t' + '\t'.join(list(str(x) for x in data.values())) + '\n'
-        log.write(logMessage)
+    if (event == 'info'):
+        # TSV format of: Timestamp, Client IP, IN/OUT, Packet
+        logMessage = ip + '\t' + client + '\t' + type + '\t' + data
+    elif (event == 'location'):
+        # TSV format of: Timestamp, Client IP, Location DateTime, GPS/LBS, Validity, Nb Sat, Latitude, Longitude, Accuracy, Speed, Heading
+        logMessage = ip + '\t' + client + '\t' + '\t'.join(list(str(x) for x in data.values()))
+    elif (event == 'geofence'):
+        # TSV format of: Timestamp, Client IP, IMEI, enter/exit, Fence id, Fence name, Location DateTime, Method, Latitude, Longitude, Accuracy
+        logMessage = ip + '\t' + client + '\t' + '\t'.join(list(str(x) for x in data.values()))
+    log_writer.write(filename, logMessage)
+
+
+def store_position(session, timestamp, method, valid, latitude, longitude, accuracy=math.nan, speed=math.nan, heading=math.nan, satellites=0):
+    """
+    Records a position (NaN for unknown values), at the UTC timestamp of the
+    packet: as the last fix of the session when it is known, and in the
+    binary position store. Fixes are checked against the geofences, and
+    published to the live feed.
+    """
+
+    if (not math.isnan(latitude)):
+        session.set_fix(timestamp, method, valid, latitude, longitude, accuracy, speed, heading, satellites)
+    if (not session.imei):
+        return
+    position_store.append(session.imei, timestamp, method, valid, latitude, longitude, accuracy, speed, heading)
+    live_events.publish('position', session.imei, Position(timestamp, session.imei, method, valid, latitude, longitude, accuracy, speed, heading), timestamp)
+    # GPS positions without a fix (valid = 0) are the last known position
+    if (valid and not math.isnan(latitude)):
+        for event in geofences.evaluate(session.imei, timestamp, latitude, longitude, accuracy, method):
+            report_geofence_event(session, event)
+
+
+def report_geofence_event(session, event):
+    """
+    Logs a device entering or leaving a geofence, to the console and to geofence_log.txt,
+    and publishes it to the live feed.
+    """
+
+    serverlog.info(session, 'GEOFENCE : %s %s (%s)', event.event, event.fence, event.name)
+    geofence_events.labels(event.event).inc()
+    live_events.publish('geofence', session.imei, event, event.timestamp)
+    LOGGER('geofence', 'geofence_log.txt', session.address[0], session.imei_text, '', {
+        'event': event.event, 
+        'fence': event.fence, 
+        'name': event.name, 
+        'datetime': clock.local_text(event.timestamp), 
+        'method': event.method, 
+        'latitude': event.latitude, 
+        'longitude': event.longitude, 
+        'accuracy': event.accuracy})
+
+
+def close_session(session):
+    """
+    Releases the session of a connection that closed: it is detached from
+    its connection and buffers, and unregistered from the session registry.
+    """
+
+    idle_reaper.forget(session)
+    if (session.imei):
+        session_registry.release(session.imei_text, id(session))
+    sessions.close(session)
+
+
+def close_taken_over_session(imei, connection):
+    """
+    Closes the connection of a device that logged in on another worker since
+    (called by session_registry): the device dropped this one without
+    closing it.
+    """
+
+    session = sessions.get(int(imei))
+    if (session is None or id(session) != connection or session.client is None):
+        return
+    serverlog.info(session, 'Logged in on another worker: closing this stale connection.')
+    drop_connection(session.client)
 
 
-def handle_client(client):
+def drop_connection(client):
     """
-    Takes client socket as argument. 
+    Closes a connection from any thread. Sockets are shut down rather than
+    closed, which wakes up the thread blocked reading them.
+    """
+
+    try:
+        if (isinstance(client, TrackerProtocol)):
+            client.close()
+        elif (client is not None):
+            client.shutdown(SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def close_idle_connection(session):
+    """
+    Closes a connection on which nothing was received for longer than its
+    idle timeout (called by idle_reaper): the device is gone, most likely
+    out of coverage, without the connection being closed.
+    """
+
+    if (session.client is None):
+        return
+    serverlog.info(session, 'Idle: nothing received for %d s, closing the connection.', session.timeout)
+    idle_connections_closed.inc()
+    drop_connection(session.client)
+
+
+def handle_client(session):
+    """
+    Takes the session of a client socket as argument. 
     Handles a single client connection, by listening indefinitely for packets.
     """
     
-    # Initialize dictionaries for that client
-    positions[client]['wifi'] = []
-    positions[client]['gsm-cells'] = []
-    positions[client]['gsm-carrier'] = {}
-    positions[client]['gps'] = {}
+    client = session.client
 
     # Keep receiving and analyzing packets until end of time
     # or until device sends disconnection signal
@@ -88,235 +212,362 @@ def handle_client(client):
             
             # Only process non-empty packets
             if (len(packet) > 0):
-                print('[', addresses[client]['address'][0], ']', 'IN Hex :', packet.hex(), '(length in bytes =', len(packet), ')')
-                keepAlive = read_incoming_packet(client, packet)
-                LOGGER('info', 'server_log.txt', addresses[client]['address'][0], addresses[client]['imei'], 'IN', packet.hex())
+                received = time.perf_counter()
+                # The device is reading again: what its socket did not accept goes first
+                if (session.outbox is not None):
+                    flush_outbox(session)
+                # A single recv() may hold several packets, or only part of one
+                decoder = session.decoder
+                discarded = decoder.discarded
+                for frame in decoder.feed(packet):
+                    serverlog.debug(session, 'IN Hex : %s (length in bytes = %d)', frame, len(frame))
+                    keepAlive = read_incoming_packet(session, frame, received)
+                    LOGGER('info', 'server_log.txt', session.address[0], session.imei_text, 'IN', frame.hex())
+                if (decoder.discarded != discarded):
+                    bytes_discarded.inc(decoder.discarded - discarded)
                 
                 # Disconnect if client sent disconnect signal
                 #if (keepAlive is False):
-                #    print('[', addresses[client]['address'][0], ']', 'DISCONNECTED: socket was closed by client.')
+                #    serverlog.info(session, 'Disconnected: socket was closed by client.')
                 #    client.close()
                 #    break
 
             # Close socket if recv() returns 0 bytes, i.e. connection has been closed
             else:
-                print('[', addresses[client]['address'][0], ']', 'DISCONNECTED: socket was closed for an unknown reason.')
+                serverlog.info(session, 'Disconnected: socket was closed for an unknown reason.')
                 client.close()
                 break                
 
         # Something went sideways... close the socket so that it does not hang
         except Exception as e:
-            print('[', addresses[client]['address'][0], ']', 'ERROR: socket was closed due to the following exception:')
-            print(e)
+            serverlog.error(session, 'Socket was closed due to the following exception: %r', e)
             client.close()
             break
-    print("This thread is now closed.")
+    connections_open.dec()
+    close_session(session)
+    serverlog.debug(session, 'This thread is now closed.')
 
 
-def read_incoming_packet(client, packet):
+class TrackerProtocol(asyncio.Protocol):
+    """
+    Asyncio counterpart of handle_client(), used when the server runs in 
+    'asyncio' mode. One instance is created per connection and stands for 
+    the client socket in its session: it exposes send() and close() so that 
+    read_incoming_packet() and the answer_* functions work unchanged.
+
+    A protocol object is much lighter than a thread and its stack, which is 
+    what allows holding many idle 2G devices from a single event loop.
+    """
+
+    __slots__ = ('transport', 'loop', 'thread', 'session', 'paused')
+
+    def __init__(self):
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.thread = get_ident()
+        # Writes are buffered by the transport; above the high-water mark, commands are held back (see congested())
+        self.paused = False
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        client_address = transport.get_extra_info('peername')[:2]
+
+        # New session for that client, indexed by IMEI once the device logs in
+        self.session = Session(self, client_address, FrameDecoder(), codec.ResponseBuilder())
+        serverlog.info(self.session, 'Connected from port %d.', client_address[1])
+        self.session.set_timeout(IDLE_TIMEOUTS['login'])
+        idle_reaper.watch(self.session)
+        connections_open.inc()
+
+    def data_received(self, packet):
+        # Same processing as in handle_client(), minus the blocking recv()
+        received = time.perf_counter()
+        try:
+            decoder = self.session.decoder
+            discarded = decoder.discarded
+            for frame in decoder.feed(packet):
+                serverlog.debug(self.session, 'IN Hex : %s (length in bytes = %d)', frame, len(frame))
+                read_incoming_packet(self.session, frame, received)
+                LOGGER('info', 'server_log.txt', self.session.address[0], self.session.imei_text, 'IN', frame.hex())
+            if (decoder.discarded != discarded):
+                bytes_discarded.inc(decoder.discarded - discarded)
+
+        # Something went sideways... close the connection so that it does not hang
+        except Exception as e:
+            serverlog.error(self.session, 'Socket was closed due to the following exception: %r', e)
+            self.close()
+
+    def connection_lost(self, exc):
+        connections_open.dec()
+        serverlog.info(self.session, 'Disconnected: socket was closed.')
+        close_session(self.session)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+    def send(self, data):
+        # Transports are not thread-safe: writes from other threads
+        # (geolocation workers) are handed over to the event loop
+        if (get_ident() == self.thread):
+            self.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.write, bytes(data))
+
+    def write(self, data):
+        # The transport buffers what the socket does not accept, up to a limit. It may keep the object
+        # written rather than a copy, and responses are views on the buffer of the next response (see
+        # codec.ResponseBuilder): they are copied (bytes() of bytes is not a copy)
+        self.transport.write(bytes(data))
+        if (self.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT):
+            write_overflow(self.session)
+
+    def close(self):
+        if (get_ident() == self.thread):
+            self.transport.close()
+        else:
+            self.loop.call_soon_threadsafe(self.transport.close)
+
+
+async def serve_asyncio(sock):
+    """
+    Serves all clients from a single event loop, on an already 
+    bound and listening socket.
+    """
+
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(TrackerProtocol, sock=sock)
+    async with server:
+        await server.serve_forever()
+
+
+def read_incoming_packet(session, packet, received=None):
     """
     Handle incoming packets to identify the protocol they are related to,
     and then redirects to response functions that will generate the apropriate 
     packet that should be sent back.
     Actual sending of the response packet will be done by an external function.
-    """
-
-    # Convert hex string into list for convenience
-    # Strip packet of bits 1 and 2 (start 0x78 0x78) and n-1 and n (end 0x0d 0x0a)
-    packet_list = [packet.hex()[i:i+2] for i in range(4, len(packet.hex())-4, 2)]
-    
-    # DEBUG: Print the role of current packet
-    protocol_name = protocol_dict['protocol'][packet_list[1]]
-    protocol_method = protocol_dict['response_method'][protocol_name]
-    print('The current packet is for protocol:', protocol_name, 'which has method:', protocol_method)
-    
-    # Prepare the response, initialize as empty
-    r = ''
-
-    # Get the protocol name and react accordingly
-    if (protocol_name == 'login'):
-        r = answer_login(client, packet_list)
-    
-    elif (protocol_name == 'gps_positioning' or protocol_name == 'gps_offline_positioning'):
-        r = answer_gps(client, packet_list)
-
-    elif (protocol_name == 'status'):
-        # Status can sometimes carry signal strength and sometimes not
-        if (packet_list[0] == '06'): 
-            print('[', addresses[client]['address'][0], ']', 'STATUS : Battery =', int(packet_list[2], base=16), '; Sw v. =', int(packet_list[3], base=16), '; Status upload interval =', int(packet_list[4], base=16))
-        elif (packet_list[0] == '07'): 
-            print('[', addresses[client]['address'][0], ']', 'STATUS : Battery =', int(packet_list[2], base=16), '; Sw v. =', int(packet_list[3], base=16), '; Status upload interval =', int(packet_list[4], base=16), '; Signal strength =', int(packet_list[5], base=16))
-        # Exit function without altering anything
-        return(True)
-    
-    elif (protocol_name == 'hibernation'):
-        # Exit function returning False to break main while loop in handle_client()
-        print('[', addresses[client]['address'][0], ']', 'STATUS : Sent hibernation packet. Disconnecting now.')
-        return(False)
 
-    elif (protocol_name == 'setup'):
-        # TODO: HANDLE NON-DEFAULT VALUES
-        r = answer_setup(packet_list, '0300', '00110001', '000000', '000000', '000000', '00', '000000', '000000', '000000', '00', '0000', '0000', ['', '', ''])
+    Response functions are looked up by protocol number in protocol_handlers;
+    protocols without a response function are not answered.
+    Commands queued for the device (see command_queue.py) are sent along with
+    the response, and the packet is checked for their acknowledgements.
 
-    elif (protocol_name == 'time'):
-        r = answer_time(packet_list)
+    received is the perf_counter() time at which the packet was read from the
+    socket, from which the latency of the response is measured.
+    """
 
-    elif (protocol_name == 'wifi_positioning' or protocol_name == 'wifi_offline_positioning'):
-        r = answer_wifi_lbs(client, packet_list)
+    if (received is None):
+        received = time.perf_counter()
+    session.received = received
+    # Any packet (heartbeat, status...) shows that the connection is alive
+    session.deadline = time.monotonic() + session.timeout
+
+    # Ignore packets with a protocol number that is not documented
+    protocol = packet[3]
+    protocol_name = protocol_names.get(protocol)
+    if (protocol_name is None):
+        unknown_protocols.labels(format(protocol, '02x')).inc()
+        serverlog.warning(session, 'Unknown protocol number %02x, packet ignored.', protocol)
+        return(True)
+    packets_in.labels(protocol_name).inc()
+
+    # Decode the binary packet into a record, according to its protocol
+    # A frame that can not be decoded is skipped, as unknown protocols are: the connection is kept
+    try:
+        record = codec.decode_frame(packet)
+    except codec.DecodeError as e:
+        decode_errors.labels(protocol_name).inc()
+        serverlog.warning(session, 'Could not decode %s packet %s (%s), packet ignored.', protocol_name, packet, e)
+        return(True)
 
-    elif (protocol_name == 'position_upload_interval'):
-        r = answer_upload_interval(client, packet_list)
-    
-    # Else, prepare a generic response with only the protocol number
-    # else:
-        # r = generic_response(packet_list[1])
+    # DEBUG: Print the role of current packet
+    protocol_method = protocol_dict['response_method'].get(protocol_name, '')
+    serverlog.debug(session, 'The current packet is for protocol: %s which has method: %s', protocol_name, protocol_method)
+
+    # Get the response function for this protocol and react accordingly
+    handler = protocol_handlers.get(protocol)
+    r = handler(session, record) if handler else None
+
+    # Commands queued for the device go out with the response, in the same write,
+    # unless the connection did not write everything it was given already
+    commands = ()
+    if (session.imei):
+        for command in command_queue.acknowledge(session.imei, record):
+            serverlog.info(session, 'COMMAND : %s acknowledged (id %d).', command.kind, command.id)
+        reconnected = (protocol == 0x01)
+        if (command_queue.due(session.imei, reconnected) and not congested(session)):
+            commands = queued_commands(session, reconnected)
 
     # Send response to client, if it exists
-    if (r != ''):
-        print('[', addresses[client]['address'][0], ']', 'OUT Hex :', r, '(length in bytes =', len(bytes.fromhex(r)), ')')
-        send_response(client, r)
+    if (r or commands):
+        if (r):
+            serverlog.debug(session, 'OUT Hex : %s (length in bytes = %d)', r, len(r))
+        send_response(session, r, received, commands)
     
-    # Return True to avoid failing in main while loop in handle_client()
-    return(True)
+    # Return False to break main while loop in handle_client() after hibernation,
+    # True otherwise
+    return(protocol != 0x14)
 
 
-def answer_login(client, query):
+def answer_login(session, query):
     """
     This function extracts IMEI and Software Version from the login packet. 
-    The IMEI and Software Version will be stored into a client dictionary to 
-    allow handling of multiple devices at once, in the future.
+    The IMEI and Software Version will be stored into the session of the client,
+    which is then indexed by IMEI.
     
-    The client socket is passed as an argument because it is in this packet
-    that IMEI is sent and will be stored in the address dictionary.
+    The session is passed as an argument because it is in this packet
+    that IMEI is sent.
     """
     
-    # Read data: Bits 2 through 9 are IMEI and 10 is software version
-    protocol = query[1]
-    addresses[client]['imei'] = ''.join(query[2:10])[1:]
-    addresses[client]['software_version'] = int(query[10], base=16)
-
-    # DEBUG: Print IMEI and software version
-    print("Detected IMEI :", addresses[client]['imei'], "and Sw v. :", addresses[client]['software_version'])
+    # IMEI and software version were decoded from the packet
+    session.software_version = query.software_version
+
+    # A device that reconnects takes over the state of its previous session,
+    # whose connection is stale (the device dropped it without closing it)
+    stale = sessions.login(session, query.imei)
+    session.set_timeout(IDLE_TIMEOUTS['online'])
+    idle_reaper.watch(session)
+
+    # Log IMEI and software version
+    serverlog.info(session, 'Logged in, software version %d.', session.software_version)
+    if (stale is not None):
+        serverlog.info(session, 'Reconnected: closing its previous connection from %s.', stale.address[0])
+        drop_connection(stale.client)
+
+    # Register the device as connected to this worker: another worker still holding
+    # a connection of the device closes it (see close_taken_over_session())
+    previous = session_registry.claim(session.imei_text, id(session), '%s:%s' % session.address)
+    if (previous is not None and previous.pid != session_registry.pid):
+        serverlog.info(session, 'Was connected to worker %d from %s.', previous.worker, previous.address)
 
     # Prepare response: in absence of control values, 
-    # always accept the client
-    response = '01'
-    # response = '44'
-    # r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'], ignoreDatetimeLength=False, ignoreSeparatorLength=False)
-    r = generic_response(response)
+    # always accept the client (the pre-encoded 0x01 response)
+    r = LOGIN_ACCEPTED
+    # r = LOGIN_REJECTED
     return(r)
 
 
-def answer_setup(query, uploadIntervalSeconds, binarySwitch, alarm1, alarm2, alarm3, dndTimeSwitch, dndTime1, dndTime2, dndTime3, gpsTimeSwitch, gpsTimeStart, gpsTimeStop, phoneNumbers):
+def answer_status(session, query):
+    """
+    Status packets are not answered: battery, software version and upload interval 
+    are only printed, along with signal strength when the device sends it,
+    and published to the live feed.
+    """
+
+    # Status can sometimes carry signal strength and sometimes not
+    if (query.signal_strength is None): 
+        serverlog.debug(session, 'STATUS : Battery = %d ; Sw v. = %d ; Status upload interval = %d', query.battery, query.software_version, query.upload_interval)
+    else: 
+        serverlog.debug(session, 'STATUS : Battery = %d ; Sw v. = %d ; Status upload interval = %d ; Signal strength = %d', query.battery, query.software_version, query.upload_interval, query.signal_strength)
+    if (session.imei):
+        live_events.publish('status', session.imei, query)
+    return(None)
+
+
+def answer_hibernation(session, query):
+    """
+    The device is going to sleep: nothing to answer, the connection will be dropped.
+    """
+
+    serverlog.info(session, 'Sent hibernation packet. Disconnecting now.')
+    # The device is expected to close the connection: close it soon if it does not
+    session.set_timeout(IDLE_TIMEOUTS['hibernation'])
+    idle_reaper.watch(session)
+    return(None)
+
+
+def answer_setup(session, query):
     """
     Synchronous setup is initiated by the device who asks the server for 
     instructions.
     These instructions will consists of bits for different flags as well as
     alarm clocks ans emergency phone numbers.
-    """
-    
-    # Read protocol
-    protocol = query[1]
 
-    # Convert binarySwitch from byte to hex
-    binarySwitch = format(int(binarySwitch, base=2), '02X')
-
-    # Convert phone numbers to 'ASCII' (?) by padding each digit with 3's and concatenate
-    for n in range(len(phoneNumbers)):
-        phoneNumbers[n] = bytes(phoneNumbers[n], 'UTF-8').hex()
-    phoneNumbers = '3B'.join(phoneNumbers)
+    They are the settings of the device kept by command_queue (changed with
+    `python command_queue.py setup`, see DEFAULT_SETTINGS for their defaults),
+    encoded once.
+    """
 
-    # Build response
-    response = uploadIntervalSeconds + binarySwitch + alarm1 + alarm2 + alarm3 + dndTimeSwitch + dndTime1 + dndTime2 + dndTime3 + gpsTimeSwitch + gpsTimeStart + gpsTimeStop + phoneNumbers
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'], ignoreDatetimeLength=False, ignoreSeparatorLength=False)
+    r = make_content_response(session, query.protocol, command_queue.setup_content(session.imei))
     return(r)
 
 
-def answer_time(query):
+def answer_time(session, query):
     """
     Time synchronization is initiated by the device, which expects a response
     contianing current datetime over 7 bytes: YY YY MM DD HH MM SS.
     This function is a wrapper to generate the proper response
     """
-    
-    # Read protocol
-    protocol = query[1]
 
-    # Get current date and time into the pretty-fied hex format
-    response = get_hexified_datetime(truncatedYear=False)
-
-    # Build response
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'], ignoreDatetimeLength=False, ignoreSeparatorLength=False)
+    # The response holds the current date and time: it is encoded once per second, for all clients
+    r = clock.time_reply()
     return(r)
 
-
-def answer_gps(client, query):
+def answer_gps(session, query):
     """
     GPS positioning can come into two packets that have the exact same structure, 
     but protocol can be 0x10 (GPS positioning) or 0x11 (Offline GPS positioning)... ?
     Anyway: the structure of these packets is constant, not like GSM or WiFi packets
     """
 
-    # Reset positions lists (Wi-Fi, and LBS) and dictionary (carrier) for that client
-    positions[client]['gps'] = {}
-
-    # Read protocol
-    protocol = query[1]
+    # Position dictionary, as logged to location_log.txt
+    gps = {}
 
     # Extract datetime from incoming query to put into the response
     # Datetime is in HEX format here, contrary to LBS packets...
     # That means it's read as HEX(YY) HEX(MM) HEX(DD) HEX(HH) HEX(MM) HEX(SS)...
-    dt = ''.join([ format(int(x, base = 16), '02d') for x in query[2:8] ])
-    # GPS DateTime is at UTC timezone: we need to store that information in the object
-    if (dt != '000000000000'): 
-        dt = datetime.strptime(dt, '%y%m%d%H%M%S').replace(tzinfo=tz.tzutc())
-
-    
-    # Read in the incoming GPS positioning
-    # Byte 8 contains length of packet on 1st char and number of satellites on 2nd char
-    gps_data_length = int(query[8][0], base=16)
-    gps_nb_sat = int(query[8][1], base=16)
-    # Latitude and longitude are both on 4 bytes, and were multiplied by 30000
-    # after being converted to seconds-of-angle. Let's convert them back to degree
-    gps_latitude = int(''.join(query[9:13]), base=16) / (30000 * 60)
-    gps_longitude = int(''.join(query[13:17]), base=16) / (30000 * 60)
-    # Speed is on the next byte
-    gps_speed = int(query[17], base=16)
-    # Last two bytes contain flags in binary that will be interpreted
-    gps_flags = format(int(''.join(query[18:20]), base=16), '0>16b')
-    position_is_valid = gps_flags[3]
-    # Flip sign of GPS latitude if South, longitude if West
-    if (gps_flags[4] == '1'):
-        gps_longitude = -gps_longitude
-    if (gps_flags[5] == '0'):
-        gps_latitude = -gps_latitude
-    gps_heading = int(''.join(gps_flags[6:]), base = 2)
+    # GPS DateTime is at UTC timezone; it is None when the device sent '000000000000'
+    timestamp = clock.device_timestamp(query.datetime)
+
+    # The GPS positioning was decoded from the packet: latitude and longitude
+    # are in degrees, with their sign flipped if South or West
+    gps_nb_sat = query.nb_sat
+    gps_latitude = query.latitude
+    gps_longitude = query.longitude
+    gps_speed = query.speed
+    position_is_valid = query.valid
+    gps_heading = query.heading
 
     # Store GPS information into the position dictionary and print them
-    positions[client]['gps']['method'] = 'GPS'
-    # In some cases dt is empty with value '000000000000': let's avoid that because it'll crash strptime
-    positions[client]['gps']['datetime'] = (datetime.strptime(datetime.now().strftime('%y%m%d%H%M%S') if dt == '000000000000' else dt.astimezone(tz.tzlocal()).strftime('%y%m%d%H%M%S'), '%y%m%d%H%M%S').strftime('%Y/%m/%d %H:%M:%S'))
-    # Special value for 'valid' flag when dt is '000000000000' which may be an invalid position after all
-    positions[client]['gps']['valid'] = (2 if (dt == '000000000000' and position_is_valid == 1) else position_is_valid)
-    positions[client]['gps']['nb_sat'] = gps_nb_sat
-    positions[client]['gps']['latitude'] = gps_latitude
-    positions[client]['gps']['longitude'] = gps_longitude
-    positions[client]['gps']['accuracy'] = 0.0
-    positions[client]['gps']['speed'] = gps_speed
-    positions[client]['gps']['heading'] = gps_heading
-    print('[', addresses[client]['address'][0], ']', "POSITION/GPS : Valid =", position_is_valid, "; Nb Sat =", gps_nb_sat, "; Lat =", gps_latitude, "; Long =", gps_longitude, "; Speed =", gps_speed, "; Heading =", gps_heading)
-    LOGGER('location', 'location_log.txt', addresses[client]['address'][0], addresses[client]['imei'], '', positions[client]['gps'])
+    gps['method'] = 'GPS'
+    # In some cases dt is empty with value '000000000000': the position is dated from now
+    if (timestamp is None):
+        timestamp = time.time()
+        # Special value for 'valid' flag, which may be an invalid position after all
+        gps['valid'] = (2 if (position_is_valid == 1) else position_is_valid)
+    else:
+        gps['valid'] = position_is_valid
+    gps['datetime'] = clock.local_text(timestamp)
+    gps['nb_sat'] = gps_nb_sat
+    gps['latitude'] = gps_latitude
+    gps['longitude'] = gps_longitude
+    gps['accuracy'] = 0.0
+    gps['speed'] = gps_speed
+    gps['heading'] = gps_heading
+    serverlog.debug(session, 'POSITION/GPS : Valid = %d ; Nb Sat = %d ; Lat = %s ; Long = %s ; Speed = %d ; Heading = %d', position_is_valid, gps_nb_sat, gps_latitude, gps_longitude, gps_speed, gps_heading)
+    LOGGER('location', 'location_log.txt', session.address[0], session.imei_text, '', gps)
+    store_position(session, timestamp, 'GPS', gps['valid'], 
+        gps_latitude, gps_longitude, 0.0, gps_speed, gps_heading, gps_nb_sat)
+
+    # Valid fixes locate the WiFi scans sent around the same time by this device
+    # (devices that did not log in can not be told apart)
+    if (gps['valid'] == 1 and session.imei):
+        bssid_learner.observe_fix(session.imei, timestamp, gps_latitude, gps_longitude, gps_speed)
 
     # Get current datetime for answering
     # TEST: Return datetime that was extracted from packet instead of current server datetime
     # response = get_hexified_datetime(truncatedYear=True)
-    response = ''.join(query[2:8])
+    response = query.raw_datetime
 
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'], ignoreDatetimeLength=False, ignoreSeparatorLength=False, forceLengthToValue=0)
+    r = make_content_response(session, query.protocol, response, forceLengthToValue=0)
     return(r)
 
 
-def answer_wifi_lbs(client, query):
+def answer_wifi_lbs(session, query):
     """
     iFi + LBS data can come into two packets that have the exact same structure, 
     but protocol can be 0x17 or 0x69. Likely similar to GPS/offline GPS... ?
@@ -339,123 +590,143 @@ def answer_wifi_lbs(client, query):
     - decoded positions as latitude and longitude, based from transmitted elements.
     """
 
-    # Reset positions lists (Wi-Fi, and LBS) and dictionary (carrier) for that client
-    positions[client]['wifi'] = []
-    positions[client]['gsm-cells'] = []
-    positions[client]['gsm-carrier'] = {}
-    positions[client]['gps'] = {}
-
-    # Read protocol
-    protocol = query[1]
+    # New scan for that client: Wi-Fi and LBS lists and carrier dictionary.
+    # The position will be decoded later on, possibly from another thread:
+    # the scan is handed over to geolocate() rather than kept in the session.
+    scan = {'wifi': [], 'gsm-cells': [], 'gsm-carrier': {}}
 
     # Datetime is BCD-encoded in bytes 2:7, meaning it's read *directly* as YY MM DD HH MM SS
     # and does not need to be decoded from hex. YY value above 2000.
-    dt = ''.join(query[2:8])
-    # WiFi DateTime seems to be UTC timezone: add that info to the object
-    if (dt != '000000000000'): 
-        dt = datetime.strptime(dt, '%y%m%d%H%M%S').replace(tzinfo=tz.tzutc())
+    # WiFi DateTime seems to be UTC timezone; it is None when the device sent '000000000000'
+    timestamp = clock.device_timestamp(query.datetime)
 
     # WIFI
-    n_wifi = int(query[0])
-    if (n_wifi > 0):
-        for i in range(n_wifi):
-            current_wifi = {'macAddress': ':'.join(query[(8 + (7 * i)):(8 + (7 * (i + 1)) - 2 + 1)]), # That +1 is because l[start:stop] returnes elements from start to stop-1...
-                            'signalStrength': -int(query[(8 + (7 * (i + 1)) - 1)], base = 16)}
-            positions[client]['wifi'].append(current_wifi)
-            
-            # Print Wi-Fi hotspots into the logs
-            print('[', addresses[client]['address'][0], ']', "POSITION/WIFI : BSSID =", current_wifi['macAddress'], "; RSSI =", current_wifi['signalStrength'])
-
-    # GSM Cell towers
-    n_gsm_cells = int(query[(8 + (7 * n_wifi))])
-    # The first three bytes after n_lbs are MCC(2 bytes)+MNC(1 byte)
-    gsm_mcc = int(''.join(query[((8 + (7 * n_wifi)) + 1):((8 + (7 * n_wifi)) + 2 + 1)]), base=16)
-    gsm_mnc = int(query[((8 + (7 * n_wifi)) + 3)], base=16)
-    positions[client]['gsm-carrier']['n_gsm_cells'] = n_gsm_cells
-    positions[client]['gsm-carrier']['MCC'] = gsm_mcc
-    positions[client]['gsm-carrier']['MNC'] = gsm_mnc
-
-    if (n_gsm_cells > 0):
-        for i in range(n_gsm_cells):
-            current_gsm_cell = {'locationAreaCode': int(''.join(query[(((8 + (7 * n_wifi)) + 4) + (5 * i)):(((8 + (7 * n_wifi)) + 4) + (5 * i) + 1 + 1)]), base=16),
-                                'cellId': int(''.join(query[(((8 + (7 * n_wifi)) + 4) + (5 * i) + 1 + 1):(((8 + (7 * n_wifi)) + 4) + (5 * i) + 2 + 1 + 1)]), base=16),
-                                'signalStrength': -int(query[(((8 + (7 * n_wifi)) + 4) + (5 * i) + 2 + 1 + 1)], base=16)}
-            positions[client]['gsm-cells'].append(current_gsm_cell)
-            
-            # Print LBS data into logs as well
-            print('[', addresses[client]['address'][0], ']', "POSITION/LBS : LAC =", current_gsm_cell['locationAreaCode'], "; CellID =", current_gsm_cell['cellId'], "; MCISS =", current_gsm_cell['signalStrength'])
+    for access_point in query.wifi:
+        current_wifi = {'macAddress': codec.format_bssid(access_point.bssid),
+                        'signalStrength': access_point.rssi}
+        scan['wifi'].append(current_wifi)
+        
+        # Print Wi-Fi hotspots into the logs
+        serverlog.debug(session, 'POSITION/WIFI : BSSID = %s ; RSSI = %d', current_wifi['macAddress'], current_wifi['signalStrength'])
+
+    # GSM Cell towers, after MCC(2 bytes)+MNC(1 byte)
+    scan['gsm-carrier']['n_gsm_cells'] = len(query.cells)
+    scan['gsm-carrier']['MCC'] = query.mcc
+    scan['gsm-carrier']['MNC'] = query.mnc
+
+    for cell in query.cells:
+        current_gsm_cell = {'locationAreaCode': cell.lac,
+                            'cellId': cell.cell_id,
+                            'signalStrength': cell.rssi}
+        scan['gsm-cells'].append(current_gsm_cell)
+        
+        # Print LBS data into logs as well
+        serverlog.debug(session, 'POSITION/LBS : LAC = %d ; CellID = %d ; MCISS = %d', current_gsm_cell['locationAreaCode'], current_gsm_cell['cellId'], current_gsm_cell['signalStrength'])
 
-    # Build first stage of response with dt and send it to devices
-    r_1 = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, dt.strftime('%y%m%d%H%M%S'), hex_dict['stop_1'] + hex_dict['stop_2'], ignoreDatetimeLength=False, ignoreSeparatorLength=False, forceLengthToValue=0)
+    # Learn the position of these hotspots if a GPS fix of this device is close in time
+    if (session.imei):
+        bssid_learner.observe_scan(session.imei, (time.time() if timestamp is None else timestamp), 
+            [ (access_point.bssid, access_point.rssi) for access_point in query.wifi ])
+
+    # Build first stage of response with dt (as sent by the device) and send it right away
+    r_1 = make_content_response(session, query.protocol, query.raw_datetime, forceLengthToValue=0)
+    serverlog.debug(session, 'OUT Hex : %s (length in bytes = %d)', r_1, len(r_1))
+    received = session.received
+    send_response(session, r_1, received)
+
+    # Build second stage of response, which requires decoding the positioning data.
+    # This may take a while: it is sent by answer_wifi_lbs_position() once the position 
+    # is known, while this connection keeps on reading packets.
+    serverlog.debug(session, 'Decoding location-based data...')
+    geolocate(scan, lambda decoded_position: answer_wifi_lbs_position(session, query, timestamp, scan, decoded_position, received))
+    return(None)
+
+
+def answer_wifi_lbs_position(session, query, timestamp, scan, decoded_position, received=None):
+    """
+    Second stage of answer_wifi_lbs(), called with the position decoded from 
+    the scan (possibly from a geolocation worker thread).
+    The position is stored and logged, and for 0x69 packets it is sent
+    to the device as latitude and longitude.
+    timestamp is the UNIX time of the scan, None when the device did not date it.
+    received is the time at which the scan was read, as in read_incoming_packet().
+    """
+
+    # In some cases dt is empty with value '000000000000': the position is dated from now
+    dated = (timestamp is not None)
+    if (not dated):
+        timestamp = time.time()
 
-    # Build second stage of response, which requires decoding the positioning data
-    print("Decoding location-based data using Google Maps Geolocation API...")
-    decoded_position = GoogleMaps_geolocation_service(gmaps, positions[client])
-    
     # Handle errors in decoding location
-    if (list(decoded_position.keys())[0] == 'error'):
+    gps = {}
+    if ('error' in decoded_position):
         # Google API returned an error
-        positions[client]['gps']['method'] = 'LBS'
-        positions[client]['gps']['datetime'] = ''
-        positions[client]['gps']['valid'] = 0
-        positions[client]['gps']['nb_sat'] = ''
-        positions[client]['gps']['latitude'] = ''
-        positions[client]['gps']['longitude'] = ''
-        positions[client]['gps']['accuracy'] = ''
-        positions[client]['gps']['speed'] = ''
-        positions[client]['gps']['heading'] = ''
+        gps['method'] = 'LBS'
+        gps['datetime'] = ''
+        gps['valid'] = 0
+        gps['nb_sat'] = ''
+        gps['latitude'] = ''
+        gps['longitude'] = ''
+        gps['accuracy'] = ''
+        gps['speed'] = ''
+        gps['heading'] = ''
     
     else:
-        # Google API returned a location
-        if (len(positions[client]['wifi']) > 0):
-            positions[client]['gps']['method'] = 'LBS-GSM-WIFI'
+        # Google API returned a location (OpenCellID positions only come from the GSM cells)
+        if (len(scan['wifi']) > 0 and 'cells' not in decoded_position):
+            gps['method'] = 'LBS-GSM-WIFI'
         else:
-            positions[client]['gps']['method'] = 'LBS-GSM'
-        # In some cases dt is empty with value '000000000000': let's avoid that because it'll crash strptime
-        positions[client]['gps']['datetime'] = (datetime.strptime(datetime.now().strftime('%y%m%d%H%M%S') if dt == '000000000000' else dt.astimezone(tz.tzlocal()).strftime('%y%m%d%H%M%S'), '%y%m%d%H%M%S').strftime('%Y/%m/%d %H:%M:%S'))
+            gps['method'] = 'LBS-GSM'
+        gps['datetime'] = clock.local_text(timestamp)
         # Special value for 'valid' flag when dt is '000000000000' which may be an invalid position after all
-        positions[client]['gps']['valid'] = (2 if dt == '000000000000' else 1)
-        positions[client]['gps']['nb_sat'] = ''
+        gps['valid'] = (1 if dated else 2)
+        gps['nb_sat'] = ''
         # We will need to pad latitude and longitude with + sign if missing
-        positions[client]['gps']['latitude'] = '{0:{1}}'.format(decoded_position['location']['lat'], '+' if decoded_position['location']['lat'] else '')
-        positions[client]['gps']['longitude'] = '{0:{1}}'.format(decoded_position['location']['lng'], '+' if decoded_position['location']['lng'] else '')
-        positions[client]['gps']['accuracy'] = decoded_position['accuracy']
-        positions[client]['gps']['speed'] = ''
-        positions[client]['gps']['heading'] = ''
-    LOGGER('location', 'location_log.txt', addresses[client]['address'][0], addresses[client]['imei'], '', positions[client]['gps'])
-
-    # And return the second stage of response, which will be sent in the handle_package() function
-    # The latitudes and longitudes are truncated to the 6th digit after decimal separator but must preserve the sign
-    response = '2C'.join(
-        [ bytes(positions[client]['gps']['latitude'][0] + str(round(float(positions[client]['gps']['latitude'][1:]), 6)), 'UTF-8').hex(), 
-        bytes(positions[client]['gps']['longitude'][0] + str(round(float(positions[client]['gps']['longitude'][1:]), 6)), 'UTF-8').hex() ])
-    r_2 = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'], ignoreDatetimeLength=False, ignoreSeparatorLength=False, forceLengthToValue=0)
+        gps['latitude'] = '{0:{1}}'.format(decoded_position['location']['lat'], '+' if decoded_position['location']['lat'] else '')
+        gps['longitude'] = '{0:{1}}'.format(decoded_position['location']['lng'], '+' if decoded_position['location']['lng'] else '')
+        gps['accuracy'] = decoded_position['accuracy']
+        gps['speed'] = ''
+        gps['heading'] = ''
+    LOGGER('location', 'location_log.txt', session.address[0], session.imei_text, '', gps)
+    if ('error' in decoded_position):
+        store_position(session, timestamp, 'LBS', 0, math.nan, math.nan)
+    else:
+        store_position(session, timestamp, gps['method'], gps['valid'], 
+            decoded_position['location']['lat'], decoded_position['location']['lng'], float(decoded_position['accuracy']))
 
     # Send the response corresponding to what is expected by the protocol
-    # 0x17 : only send r_1 (returned and handled by send_content_response())
-    if (protocol == '17'):
-        return(r_1)
-
-    elif (protocol == '69'):
-        print('[', addresses[client]['address'][0], ']', 'OUT Hex :', r_1, '(length in bytes =', len(bytes.fromhex(r_1)), ')')
-        send_response(client, r_1)
-        return(r_2)
+    # 0x17 : only r_1, which was already sent
+    # 0x69 : r_2, when the position could be decoded
+    if (query.protocol == 0x17 or gps['latitude'] == ''):
+        return
 
-
-def answer_upload_interval(client, query):
+    # The latitudes and longitudes are truncated to the 6th digit after decimal separator but must preserve the sign
+    response = b','.join(
+        [ bytes(gps['latitude'][0] + str(round(float(gps['latitude'][1:]), 6)), 'UTF-8'), 
+        bytes(gps['longitude'][0] + str(round(float(gps['longitude'][1:]), 6)), 'UTF-8') ])
+    # Not using the reusable buffer of the client: this may run in another thread
+    r_2 = codec.encode_response(query.protocol, response, length=0)
+    serverlog.debug(session, 'OUT Hex : %s (length in bytes = %d)', r_2, len(r_2))
+    send_response(session, r_2)
+    if (received is not None):
+        position_reply_latency.observe(time.perf_counter() - received)
+
+
+def answer_upload_interval(session, query):
     """
     Whenever the device received an SMS that changes the value of an upload interval,
     it sends this information to the server.
     The server should answer with the exact same content to acknowledge the packet.
     """
 
-    # Read protocol
-    protocol = query[1]
+    # The new interval is answered to the next setup requests of the device (if the setup packet can hold it)
+    if (session.imei and 0 < query.interval <= 9999 and command_queue.settings(session.imei)['upload_interval'] != query.interval):
+        command_queue.update_settings(session.imei, upload_interval=query.interval)
 
-    # Response is new upload interval reported by device (HEX formatted, no need to alter it)
-    response = ''.join(query[2:4])
+    # Response is new upload interval reported by device, as it was sent
+    response = query.raw_interval
 
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'], ignoreDatetimeLength=False, ignoreSeparatorLength=False)
+    r = make_content_response(session, query.protocol, response)
     return(r)
 
 
@@ -465,12 +736,12 @@ def generic_response(protocol):
     response: most of the times, the device expects the exact same packet.
     Here, we will answer with the same value of protocol that the device sent, 
     not using any content.
+    These responses never change, so they are encoded once (see generic_responses).
     """
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, None, hex_dict['stop_1'] + hex_dict['stop_2'], ignoreDatetimeLength=False, ignoreSeparatorLength=False)
-    return(r)
+    return(generic_responses[protocol])
 
 
-def make_content_response(start, protocol, content, stop, ignoreDatetimeLength, ignoreSeparatorLength, forceLengthToValue=None):
+def make_content_response(session, protocol, content, forceLengthToValue=None):
     """
     This is just a wrapper to generate the complete response
     to a query, given its content.
@@ -482,55 +753,230 @@ def make_content_response(start, protocol, content, stop, ignoreDatetimeLength,
     The forceLengthToValue flag allows bypassing calculation of content length,
     in case the expected response should contain the length that was in the query,
     and not the actual length of the response
-    """
-    
-    # Length is easier that of content (minus some stuff) or fixed to 1, supposedly
-    if (forceLengthToValue is None):
-        length = (len(bytes.fromhex(content))+1 if content else 1)
-
-        # Length is computed either on the full content or by discarding datetime and separators
-        # This is really a wild guess, because documentation is poor...
-        if (ignoreDatetimeLength and length >= 6):
-            length = length - 6
-        # When latitude/longitude are returned, the separator 2C isn't counted in length, apparently
-        if (ignoreSeparatorLength and length >= 1):
-            length = length - 1
-
-    # Handle case of length forced to a given value
-    else:
-        length = int(forceLengthToValue)
-        
-    # Convert length to hexadecimal value
-    length = format(length, '02X')
 
-    return(start + length + protocol + (content if content else '') + stop)
+    The response is written into the reusable buffer of the client and is only
+    valid until the next response is built for that client.
+    """
+    return(session.builder.build(protocol, content, forceLengthToValue))
 
 
-def send_response(client, response):
+def send_response(session, response, received=None, commands=()):
     """
     Function to send a response packet to the client.
+    When received (perf_counter() time of the query) is given, the latency of
+    the response is measured.
+    Commands (frames queued for the device, see queued_commands()) are sent
+    after the response, if any, in the same write.
+    """
+    if (response):
+        LOGGER('info', 'server_log.txt', session.address[0], session.imei_text, 'OUT', response.hex())
+    for frame in commands:
+        LOGGER('info', 'server_log.txt', session.address[0], session.imei_text, 'OUT', frame.hex())
+    # Responses may be sent from geolocation workers as well as from the connection itself,
+    # possibly once the connection closed
+    data = (b''.join([ response or b'' ] + list(commands)) if commands else response)
+    if (not write_to_client(session, data)):
+        return
+    for frame in commands:
+        packets_out.labels(protocol_names.get(frame[3]) or format(frame[3], '02x')).inc()
+    if (not response):
+        return
+    protocol_name = protocol_names.get(response[3]) or format(response[3], '02x')
+    packets_out.labels(protocol_name).inc()
+    if (received is not None):
+        reply_latency.labels(protocol_name).observe(time.perf_counter() - received)
+
+
+def queued_commands(session, reconnected=False):
+    """
+    Returns the frames of the commands due for the device of a session, and
+    records them as sent (see command_queue.py). When the device reconnected,
+    the commands sent over its previous connection are sent again.
     """
-    LOGGER('info', 'server_log.txt', addresses[client]['address'][0], addresses[client]['imei'], 'OUT', response)
-    client.send(bytes.fromhex(response))
+    commands = command_queue.take(session.imei, reconnected)
+    for command in commands:
+        serverlog.info(session, 'COMMAND : %s sent (id %d, attempt %d).', command.kind, command.id, command.attempts)
+    return([ command.frame for command in commands ])
+
+
+def write_to_client(session, data):
+    """
+    Writes to the connection of a session without ever blocking: a device
+    whose 2G link stalls must not hold the thread of its connection, nor a
+    geolocation worker. What the socket does not accept is kept in the outbox
+    of the session and written first, with the next write or once the device
+    sends a packet (see flush_outbox()); in 'asyncio' mode, the transport
+    buffers it. Connections with more than WRITE_BUFFER_LIMIT bytes left to
+    write are closed (see write_overflow()).
+    Returns False if the session has no connection anymore.
+    """
+    client = session.client
+    if (client is None):
+        return(False)
+    if (isinstance(client, TrackerProtocol)):
+        client.send(data)
+        return(True)
+    with session.send_lock:
+        if (session.outbox is None):
+            try:
+                sent = client.send(data, MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            if (sent == len(data)):
+                return(True)
+            session.outbox = bytearray(data[sent:])
+            partial_writes.inc()
+        else:
+            session.outbox += data
+            write_outbox(session, client)
+        backlog = (0 if session.outbox is None else len(session.outbox))
+    if (backlog > WRITE_BUFFER_LIMIT):
+        write_overflow(session)
+    return(True)
+
+
+def flush_outbox(session):
+    """
+    Writes what the socket of a session did not accept before, as much as it accepts now.
+    """
+    client = session.client
+    if (client is None):
+        return
+    with session.send_lock:
+        write_outbox(session, client)
+
+
+def write_outbox(session, client):
+    # Writes the outbox of a session without blocking (send_lock held)
+    outbox = session.outbox
+    if (outbox is None):
+        return
+    try:
+        sent = client.send(outbox, MSG_DONTWAIT)
+    except (BlockingIOError, InterruptedError):
+        return
+    del outbox[:sent]
+    if (not outbox):
+        session.outbox = None
+
+
+def congested(session):
+    """
+    Returns True if the connection of a session has more to write than its
+    socket accepted (beyond WRITE_BUFFER_HIGH bytes in 'asyncio' mode):
+    its device is not reading, queued commands wait until it does.
+    """
+    client = session.client
+    if (isinstance(client, TrackerProtocol)):
+        return(client.paused)
+    return(session.outbox is not None)
+
+
+def write_overflow(session):
+    """
+    Closes a connection whose device did not read what was written to it,
+    once more than WRITE_BUFFER_LIMIT bytes are waiting.
+    """
+    serverlog.warning(session, 'Over %d bytes left to write: the device does not read, closing the connection.', WRITE_BUFFER_LIMIT)
+    write_overflows.inc()
+    drop_connection(session.client)
 
 
 def get_hexified_datetime(truncatedYear):
     """
-    Make a fancy function that will return current GMT datetime as hex
-    concatenated data, using 2 bytes for year and 1 for the rest.
-    The returned string is YY YY MM DD HH MM SS if truncatedYear is False,
+    Make a fancy function that will return current GMT datetime as binary
+    data, using 2 bytes for year and 1 for the rest.
+    The returned bytes are YY YY MM DD HH MM SS if truncatedYear is False,
     or just YY MM DD HH MM SS if truncatedYear is True.
     """
 
-    # Get current GMT time into a list
-    if (truncatedYear):
-        dt = datetime.utcnow().strftime('%y-%m-%d-%H-%M-%S').split("-")
-    else:
-        dt = datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S').split("-")
+    # Current GMT time is packed once per second (see clock.py)
+    return(clock.hexified_datetime(truncatedYear))
+
+
+def geolocate(positionDict, callback):
+    """
+    Decodes the position of a WiFi/LBS scan and calls callback(position) with it:
+        - right away, from the geolocation cache when the same scan was already 
+          located, or from the fingerprint index when a very similar WiFi scan 
+          was already located,
+        - right away, from the hotspots of the scan whose position was learned
+          from the GPS fixes of the devices (see bssid_learner.py),
+        - right away, from the OpenCellID database when the scan has no WiFi
+          hotspots and its GSM cells are known (these positions are not cached:
+          they cost nothing; with hotspots, the API is far more accurate),
+        - later on, from a geolocation worker thread, once the Google Maps 
+          Geolocation API answered.
+    Errors are passed as a dictionary with an 'error' key, like the API does when
+    it cannot locate a scan. Only these API answers are cached, not the failures
+    to reach the API (timeouts, circuit breaker open, too many pending queries).
+    """
+
+    started = time.perf_counter()
+    key = scan_fingerprint(positionDict)
+    geoloc = geolocation_cache.get(key)
+    if (geoloc is not None):
+        serverlog.debug(None, 'Geolocation cache hit: %s', geoloc)
+        count_geolocation('cache', started)
+        callback(geoloc)
+        return
+
+    # Same place as a scan that was already located, give or take a few hotspots?
+    hotspots = wifi_hotspots(positionDict['wifi'])
+    match = fingerprint_index.lookup(hotspots)
+    if (match is not None):
+        geoloc = {'location': {'lat': match[0], 'lng': match[1]}, 'accuracy': match[2]}
+        serverlog.debug(None, 'Fingerprint index match (similarity = %.2f): %s', match[3], geoloc)
+        geolocation_cache.put(key, geoloc)
+        count_geolocation('fingerprint', started)
+        callback(geoloc)
+        return
+
+    # Hotspots already located by the GPS fixes of the devices?
+    geoloc = bssid_learner.locate(wifi_observations(positionDict['wifi']))
+    if (geoloc is not None):
+        serverlog.debug(None, 'Learned hotspots match (%d hotspots): %s', geoloc['hotspots'], geoloc)
+        count_geolocation('learned', started)
+        callback(geoloc)
+        return
+
+    # Known cell towers? A scan without hotspots can be located offline from the OpenCellID database,
+    # only kilometers accurate (the API does better from the hotspots of the other scans)
+    if (cell_database is not None and not positionDict['wifi']):
+        geoloc = cell_database.locate(positionDict['gsm-carrier']['MCC'], positionDict['gsm-carrier']['MNC'], positionDict['gsm-cells'])
+        if (geoloc is not None and (not OPENCELLID_MAX_ACCURACY or geoloc['accuracy'] <= OPENCELLID_MAX_ACCURACY)):
+            serverlog.debug(None, 'OpenCellID match (%d cells): %s', geoloc['cells'], geoloc)
+            count_geolocation('opencellid', started)
+            callback(geoloc)
+            return
+
+    def on_result(geoloc, error):
+        try:
+            if (error is not None):
+                serverlog.warning(None, 'Google Maps Geolocation API failed: %r', error)
+                geoloc = {'error': {'message': str(error)}}
+                if (isinstance(error, googlemaps.exceptions.ApiError)):
+                    geolocation_cache.put(key, geoloc)
+                count_geolocation('api_error', started)
+            else:
+                geolocation_cache.put(key, geoloc)
+                if ('error' not in geoloc):
+                    fingerprint_index.add(hotspots, geoloc['location']['lat'], geoloc['location']['lng'], geoloc['accuracy'])
+                count_geolocation('api', started)
+            callback(geoloc)
+        except Exception as e:
+            serverlog.error(None, 'Could not handle the decoded position: %r', e)
+
+    geolocation_pool.submit(GoogleMaps_geolocation_service, (gmaps, positionDict), on_result)
 
-    # Then convert to hex with 2 bytes for year and 1 for the rest
-    dt = [ format(int(x), '0'+str(len(x))+'X') for x in dt ]
-    return(''.join(dt))
+
+def count_geolocation(source, started):
+    """
+    Counts a decoded WiFi/LBS scan by source of its position, and measures
+    the time it took since started (perf_counter() time).
+    """
+    geolocations.labels(source).inc()
+    geolocation_latency.labels(source).observe(time.perf_counter() - started)
 
 
 def GoogleMaps_geolocation_service(gmapsClient, positionDict):
@@ -550,16 +996,20 @@ def GoogleMaps_geolocation_service(gmapsClient, positionDict):
 
     A nice source for such data is available at https://opencellid.org/
     """
-    print('Google Maps Geolocation API queried with:', positionDict)
-    geoloc = gmapsClient.geolocate(home_mobile_country_code=positionDict['gsm-carrier']['MCC'], 
-        home_mobile_network_code=positionDict['gsm-carrier']['MCC'], 
-        radio_type='gsm', 
-        carrier='Free', 
-        consider_ip='true', 
-        cell_towers=positionDict['gsm-cells'], 
-        wifi_access_points=positionDict['wifi'])
-
-    print('Google Maps Geolocation API returned:', geoloc)
+    serverlog.debug(None, 'Google Maps Geolocation API queried with: %s', positionDict)
+    started = time.perf_counter()
+    try:
+        geoloc = gmapsClient.geolocate(home_mobile_country_code=positionDict['gsm-carrier']['MCC'], 
+            home_mobile_network_code=positionDict['gsm-carrier']['MCC'], 
+            radio_type='gsm', 
+            carrier='Free', 
+            consider_ip='true', 
+            cell_towers=positionDict['gsm-cells'], 
+            wifi_access_points=positionDict['wifi'])
+    finally:
+        geolocation_api_latency.observe(time.perf_counter() - started)
+
+    serverlog.debug(None, 'Google Maps Geolocation API returned: %s', geoloc)
     return(geoloc)
 
 """
@@ -637,12 +1087,6 @@ cell_towers = [
 ]
 """
 
-# Declare common Hex codes for packets
-hex_dict = {
-    'start': '78', 
-    'stop_1': '0D', 
-    'stop_2': '0A'
-}
 
 protocol_dict = {
     'protocol': {
@@ -697,30 +1141,242 @@ protocol_dict = {
     }
 }
 
+# Protocol names by protocol number, as found in the packets
+protocol_names = { int(k, base=16): v for k, v in protocol_dict['protocol'].items() }
+
+# Response functions by protocol number, called from read_incoming_packet()
+protocol_handlers = {
+    0x01: answer_login,
+    0x10: answer_gps,
+    0x11: answer_gps,
+    0x13: answer_status,
+    0x14: answer_hibernation,
+    0x17: answer_wifi_lbs,
+    0x30: answer_time,
+    0x57: answer_setup,
+    0x69: answer_wifi_lbs,
+    0x98: answer_upload_interval,
+}
+
+# Constant responses, encoded once
+generic_responses = { p: codec.encode_response(p) for p in range(256) }
+LOGIN_ACCEPTED = generic_responses[0x01]
+LOGIN_REJECTED = generic_responses[0x44]
+
 
 # Import dotenv with API keys and initialize API connections
 load_dotenv()
+
+# Console log (see serverlog.py): level, 'text' or 'json' format, rate limit of the events
+# of each device (events per second, 0 to disable, and burst) and queue bound
+serverlog.configure(level=os.getenv('LOG_LEVEL', 'INFO'), 
+    format=os.getenv('LOG_FORMAT', 'text'), 
+    rate=float(os.getenv('LOG_RATE_LIMIT', 5)), 
+    burst=int(os.getenv('LOG_RATE_BURST', 20)), 
+    max_queue=int(os.getenv('LOG_CONSOLE_MAX_QUEUE', 10000)))
+
+# Worker processes sharing the port (see supervisor.py), and number of this worker:
+# SERVER_WORKER is only set by the supervisor, in the environment of the workers
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', 1))
+SERVER_WORKER = os.getenv('SERVER_WORKER')
+WORKER_INDEX = int(SERVER_WORKER or 0)
+
+# Log files are written by a background thread (sizes in bytes, interval in seconds)
+# Workers write their own files, as several processes cannot rotate the same ones
+log_writer = LogWriter(directory=('./logs/' if SERVER_WORKER is None else './logs/worker-%d/' % WORKER_INDEX), 
+    max_queue=int(os.getenv('LOG_MAX_QUEUE', 10000)), 
+    batch_size=int(os.getenv('LOG_BATCH_SIZE', 256)), 
+    flush_interval=float(os.getenv('LOG_FLUSH_INTERVAL', 1.0)), 
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024)), 
+    rotate_daily=(os.getenv('LOG_ROTATE_DAILY', '1') == '1'))
 GMAPS_API_KEY = os.getenv('GMAPS_API_KEY')
-gmaps = googlemaps.Client(key=GMAPS_API_KEY)
+GEOLOCATION_TIMEOUT = float(os.getenv('GEOLOCATION_TIMEOUT', 5))
+gmaps = googlemaps.Client(key=GMAPS_API_KEY, timeout=GEOLOCATION_TIMEOUT, retry_timeout=2 * GEOLOCATION_TIMEOUT)
+# Another Geolocation API endpoint, such as the stand-in of benchmarks/fake_geolocation.py for load tests
+if (os.getenv('GEOLOCATION_BASE_URL')):
+    googlemaps.geolocation._GEOLOCATION_BASE_URL = os.getenv('GEOLOCATION_BASE_URL')
+
+# Geolocation API queries are run by a pool of workers, so that connections never wait for them
+geolocation_pool = WorkerPool(max_workers=int(os.getenv('GEOLOCATION_WORKERS', 4)), 
+    max_pending=int(os.getenv('GEOLOCATION_MAX_PENDING', 100)), 
+    breaker=CircuitBreaker(failure_threshold=int(os.getenv('GEOLOCATION_BREAKER_FAILURES', 5)), 
+        reset_timeout=float(os.getenv('GEOLOCATION_BREAKER_RESET', 30))))
+
+# Cache of geolocation results, persisted so that it survives restarts
+geolocation_cache = GeolocationCache(path=os.getenv('GEOCACHE_PATH', './data/geocache.sqlite'), 
+    max_entries=int(os.getenv('GEOCACHE_MAX_ENTRIES', 10000)), 
+    ttl=float(os.getenv('GEOCACHE_TTL', 7 * 24 * 3600)), 
+    negative_ttl=float(os.getenv('GEOCACHE_NEGATIVE_TTL', 3600)))
+
+# Index of located WiFi scans, to answer similar scans without querying the API
+fingerprint_index = FingerprintIndex(path=os.getenv('FINGERPRINT_INDEX_PATH', './data/fingerprints.bin'), 
+    threshold=float(os.getenv('FINGERPRINT_THRESHOLD', 0.6)))
+
+# Binary store of all positions, by device and month: raw positions, kept for POSITION_RAW_RETENTION seconds,
+# and the tracks simplified with a tolerance in meters and a position at least every max interval seconds
+position_store = TieredStore(directory=os.getenv('POSITION_STORE_PATH', './data/positions/'), 
+    simplified_directory=os.getenv('POSITION_SIMPLIFIED_PATH', './data/positions-simplified/'), 
+    raw_retention=float(os.getenv('POSITION_RAW_RETENTION', 30 * 86400)), 
+    tolerance=float(os.getenv('POSITION_SIMPLIFY_TOLERANCE', 25)), 
+    max_interval=float(os.getenv('POSITION_SIMPLIFY_MAX_INTERVAL', 3600)))
+
+# Geofences of the devices, reloaded when their file changes (margin in meters, see geofence.py)
+geofences = GeofenceEngine(path=os.getenv('GEOFENCES_PATH', './data/geofences.json'), 
+    margin=float(os.getenv('GEOFENCE_MARGIN', 10)))
+
+# Position of hotspots, learned from the WiFi scans and GPS fixes of the devices
+bssid_learner = BssidLearner(path=os.getenv('BSSID_LEARNER_PATH', './data/bssids.sqlite'), 
+    window=float(os.getenv('BSSID_LEARNER_WINDOW', 120)), 
+    max_drift=float(os.getenv('BSSID_LEARNER_MAX_DRIFT', 100)), 
+    min_known=int(os.getenv('BSSID_LEARNER_MIN_KNOWN', 2)))
+
+# Offline database of cell towers (see opencellid.py), used before the API when it was imported
+OPENCELLID_PATH = os.getenv('OPENCELLID_PATH', './data/opencellid.sqlite')
+OPENCELLID_MAX_ACCURACY = float(os.getenv('OPENCELLID_MAX_ACCURACY', 0))
+cell_database = CellDatabase(OPENCELLID_PATH) if (OPENCELLID_PATH and os.path.exists(OPENCELLID_PATH)) else None
+
+# Devices connected to the server (or to each of its workers), by IMEI
+session_registry = SessionRegistry(path=os.getenv('SESSION_REGISTRY_PATH', './data/sessions.sqlite'), worker=WORKER_INDEX)
+
+# Commands queued for the devices and their settings (see command_queue.py): commands are sent again when
+# not acknowledged within COMMAND_RETRY_INTERVAL seconds, at most COMMAND_MAX_ATTEMPTS times, and expire after COMMAND_TTL seconds
+command_queue = CommandQueue(path=os.getenv('COMMAND_QUEUE_PATH', './data/commands.sqlite'), 
+    retry_interval=float(os.getenv('COMMAND_RETRY_INTERVAL', 120)), 
+    max_attempts=int(os.getenv('COMMAND_MAX_ATTEMPTS', 5)), 
+    ttl=float(os.getenv('COMMAND_TTL', 7 * 86400)))
+
+# Live feed of the positions, status and geofence events of the devices, served as Server-Sent Events
+# (see live_feed.py), with a bound of the queue of each subscriber, in devices
+live_events = live_feed.LiveFeed(max_queue=int(os.getenv('LIVE_FEED_MAX_QUEUE', 1000)))
+LIVE_FEED_HOST = os.getenv('LIVE_FEED_HOST', '127.0.0.1')
+# Each worker serves its own feed, on the next ports (port 0 to disable)
+LIVE_FEED_PORT = int(os.getenv('LIVE_FEED_PORT', 9200))
+if (LIVE_FEED_PORT):
+    LIVE_FEED_PORT += WORKER_INDEX
+
+# Runtime metrics, served in the Prometheus text format (see metrics.py)
+packets_in = metrics.Counter('petgps_packets_in_total', 'Packets received, by protocol', ['protocol'])
+packets_out = metrics.Counter('petgps_packets_out_total', 'Responses sent, by protocol', ['protocol'])
+unknown_protocols = metrics.Counter('petgps_unknown_protocols_total', 'Packets ignored for an undocumented protocol number', ['protocol'])
+decode_errors = metrics.Counter('petgps_decode_errors_total', 'Packets too short or malformed for their protocol', ['protocol'])
+bytes_discarded = metrics.Counter('petgps_frame_bytes_discarded_total', 'Bytes of the streams that were not part of a frame')
+connections_open = metrics.Gauge('petgps_connections', 'Open device connections')
+reply_latency = metrics.Histogram('petgps_reply_seconds', 'Time from reading a packet to sending its response, by protocol', ['protocol'])
+position_reply_latency = metrics.Histogram('petgps_position_reply_seconds', 'Time from reading a WiFi/LBS scan to sending its decoded position')
+geolocations = metrics.Counter('petgps_geolocations_total', 'Decoded WiFi/LBS scans, by source of the position', ['source'])
+geolocation_latency = metrics.Histogram('petgps_geolocation_seconds', 'Time to decode a WiFi/LBS scan, by source of the position', ['source'])
+geolocation_api_latency = metrics.Histogram('petgps_geolocation_api_seconds', 'Duration of the Geolocation API queries')
+geocache_lookups = metrics.Counter('petgps_geocache_lookups_total', 'Lookups of the geolocation cache, by result', ['result'])
+geocache_lookups.labels('hit').set_function(lambda: geolocation_cache.stats()['hits'])
+geocache_lookups.labels('negative_hit').set_function(lambda: geolocation_cache.stats()['negative_hits'])
+geocache_lookups.labels('miss').set_function(lambda: geolocation_cache.stats()['misses'])
+log_queue_depth = metrics.Gauge('petgps_log_queue_depth', 'Log records waiting to be written')
+log_queue_depth.set_function(lambda: log_writer.stats()['queued'])
+log_records_dropped = metrics.Counter('petgps_log_records_dropped_total', 'Log records dropped because the queue was full')
+log_records_dropped.set_function(lambda: log_writer.stats()['dropped'])
+console_events_dropped = metrics.Counter('petgps_console_events_dropped_total', 'Console log events dropped because the queue was full')
+console_events_dropped.set_function(lambda: serverlog.dropped)
+console_events_suppressed = metrics.Counter('petgps_console_events_suppressed_total', 'Console log events suppressed by the rate limits of the devices')
+console_events_suppressed.set_function(serverlog.suppressed)
+idle_connections_closed = metrics.Counter('petgps_idle_connections_closed_total', 'Connections closed after their idle timeout')
+geofence_events = metrics.Counter('petgps_geofence_events_total', 'Devices entering or leaving a geofence, by event', ['event'])
+geofence_count = metrics.Gauge('petgps_geofences', 'Geofences loaded')
+geofence_count.set_function(lambda: geofences.stats()['fences'])
+stored_positions = metrics.Counter('petgps_stored_positions_total', 'Positions written to the position store, by tier', ['tier'])
+stored_positions.labels('raw').set_function(lambda: position_store.stats()['appended'])
+stored_positions.labels('simplified').set_function(lambda: position_store.stats()['kept'])
+commands_total = metrics.Counter('petgps_commands_total', 'Commands sent to the devices, sent again, acknowledged and given up', ['state'])
+commands_total.labels('sent').set_function(lambda: command_queue.stats()['sent'])
+commands_total.labels('retried').set_function(lambda: command_queue.stats()['retried'])
+commands_total.labels('acked').set_function(lambda: command_queue.stats()['acked'])
+commands_total.labels('failed').set_function(lambda: command_queue.stats()['failed'])
+command_devices = metrics.Gauge('petgps_command_devices', 'Devices with queued commands')
+command_devices.set_function(lambda: command_queue.stats()['devices'])
+partial_writes = metrics.Counter('petgps_partial_writes_total', 'Writes that the socket of a device did not fully accept')
+write_overflows = metrics.Counter('petgps_write_overflows_total', 'Connections closed because their device did not read what was written')
+live_subscribers = metrics.Gauge('petgps_live_subscribers', 'Subscribers of the live feed')
+live_subscribers.set_function(lambda: live_events.stats()['subscribers'])
+live_feed_events = metrics.Counter('petgps_live_events_total', 'Live feed events published, dropped before encoding, queued for subscribers, coalesced and dropped from their queues', ['result'])
+live_feed_events.labels('published').set_function(lambda: live_events.stats()['published'])
+live_feed_events.labels('overflow').set_function(lambda: live_events.stats()['overflows'])
+live_feed_events.labels('sent').set_function(lambda: live_events.stats()['sent'])
+live_feed_events.labels('coalesced').set_function(lambda: live_events.stats()['coalesced'])
+live_feed_events.labels('dropped').set_function(lambda: live_events.stats()['dropped'])
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Each worker serves its own metrics, on the next ports
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9105))
+if (METRICS_PORT):
+    METRICS_PORT += WORKER_INDEX
 
 # Details about host server
 HOST = ''
-PORT = 5023
+PORT = int(os.getenv('SERVER_PORT', 5023))
 BUFSIZ = 4096
 ADDR = (HOST, PORT)
 
-# Initialize socket
-SERVER = socket(AF_INET, SOCK_STREAM)
-SERVER.bind(ADDR)
+# Bytes left to write to a device beyond which queued commands are held back (in 'asyncio' mode;
+# in 'threads' mode, as soon as its socket does not accept everything), and its connection is closed
+WRITE_BUFFER_HIGH = int(os.getenv('WRITE_BUFFER_HIGH', 16384))
+WRITE_BUFFER_LIMIT = int(os.getenv('WRITE_BUFFER_LIMIT', 262144))
+
+# Server mode: 'threads' (one thread per device) or 'asyncio' (single event loop)
+SERVER_MODE = os.getenv('SERVER_MODE', 'threads')
+BACKLOG = int(os.getenv('SERVER_BACKLOG', 128))
 
-# Store client data into dictionaries
-addresses = {}
-positions = {}
+# Listening socket, initialized when the server starts
+SERVER = None
+
+# Sessions of the devices, by IMEI (sessions of disconnected devices are kept for SESSION_TTL seconds)
+sessions = SessionTable(ttl=float(os.getenv('SESSION_TTL', 24 * 3600)))
+
+# Connections on which nothing is received for longer than the timeout of their state are closed
+# (timeouts in seconds, 0 to disable): before login, once logged in, and after a hibernation packet
+IDLE_TIMEOUTS = {
+    'login': float(os.getenv('IDLE_TIMEOUT_LOGIN', 120)) or math.inf,
+    'online': float(os.getenv('IDLE_TIMEOUT_ONLINE', 1800)) or math.inf,
+    'hibernation': float(os.getenv('IDLE_TIMEOUT_HIBERNATION', 60)) or math.inf,
+}
+idle_reaper = IdleReaper(close_idle_connection, resolution=float(os.getenv('IDLE_REAPER_RESOLUTION', 1.0)))
 
 if __name__ == '__main__':
-    SERVER.listen(5)
-    print("Waiting for connection...")
-    ACCEPT_THREAD = Thread(target=accept_incoming_connections)
-    ACCEPT_THREAD.start()
-    ACCEPT_THREAD.join()
+    if (SERVER_WORKERS > 1 and SERVER_WORKER is None):
+        # Supervisor: the workers listen on the port
+        session_registry.clear()
+        serverlog.info(None, 'Starting %d workers... (mode: %s)', SERVER_WORKERS, SERVER_MODE)
+        supervisor.supervise(os.path.abspath(__file__), SERVER_WORKERS)
+        sys.exit(0)
+
+    # Sessions left over by the previous run (of this worker)
+    session_registry.clear(worker=(None if SERVER_WORKER is None else WORKER_INDEX))
+    if (SERVER_WORKER is not None):
+        session_registry.start(close_taken_over_session)
+    # Pending simplified positions are written on exit; a single process compacts the raw positions
+    position_store.start(compact=(WORKER_INDEX == 0))
+    atexit.register(position_store.close)
+    SERVER = socket(AF_INET, SOCK_STREAM)
+    if (SERVER_WORKER is not None):
+        # One listening socket per worker on the same port: the kernel balances connections
+        SERVER.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    SERVER.bind(ADDR)
+    SERVER.listen(BACKLOG)
+    if (METRICS_PORT):
+        metrics.start_http_server(METRICS_PORT, METRICS_HOST)
+        serverlog.info(None, 'Metrics served on http://%s:%d/metrics', METRICS_HOST, METRICS_PORT)
+    if (LIVE_FEED_PORT):
+        live_feed.start_http_server(live_events, LIVE_FEED_PORT, LIVE_FEED_HOST, os.getenv('LIVE_FEED_ALLOW_ORIGIN', ''))
+        serverlog.info(None, 'Live feed served on http://%s:%d/live', LIVE_FEED_HOST, LIVE_FEED_PORT)
+    serverlog.info(None, 'Waiting for connection... (mode: %s%s)', SERVER_MODE, ('' if SERVER_WORKER is None else ', worker %d' % WORKER_INDEX))
+    # SIGTERM (sent by the supervisor to its workers) stops the server as Ctrl+C does: the process exits
+    # normally, and pending simplified positions and log lines are written (see atexit above)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    try:
+        if (SERVER_MODE == 'asyncio'):
+            asyncio.run(serve_asyncio(SERVER))
+        else:
+            # Connection threads are daemons, so that they do not hold the exit
+            ACCEPT_THREAD = Thread(target=accept_incoming_connections, daemon=True)
+            ACCEPT_THREAD.start()
+            ACCEPT_THREAD.join()
+    except KeyboardInterrupt:
+        serverlog.info(None, 'Stopping...')
     SERVER.close()
\ No newline at end of file
@@ -0,0 +1,357 @@
+"""
+HTTP API serving the positions of the devices, from the position store
+written by gps_tcp_server.py (see position_store.py).
+
+It runs as its own process, alongside the server:
+    python http_api.py
+
+Endpoints (timestamps are UTC epoch seconds, JSON responses):
+    GET /positions/latest[?cursor=&limit=]
+        latest position of every device, by IMEI
+    GET /devices/<imei>/latest
+        latest position of a device
+    GET /devices/<imei>/track[?start=&end=&resolution=&tolerance=&cursor=&limit=]
+        positions of a device between start and end (default: last 24 hours)
+    GET /positions?bbox=<min lat>,<min lon>,<max lat>,<max lon>[&start=&end=&resolution=&cursor=&limit=]
+        positions of all devices within a bounding box, by IMEI then timestamp
+
+Positions come from the raw or the simplified tier of the store (see
+track_simplifier.py), as chosen by the resolution parameter: 'raw',
+'simplified', or 'auto' (default: raw positions while they are kept).
+Tracks can be simplified further with a tolerance, in meters, to draw them
+at a coarser scale.
+
+Queries only read the blocks of the position store whose bounds match,
+and stop after the positions of the page. Lists are paginated: when there
+are more results, the response holds a 'next_cursor' to pass as the cursor
+parameter of the next request.
+Responses are streamed (chunked transfer encoding) rather than built in
+memory, and carry an ETag derived from the size of the files they read,
+so that polling clients get a 304 Not Modified until new positions come.
+Time ranges without an end (up to now) have no ETag: their results change
+with time.
+"""
+
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from track_simplifier import TieredStore
+from urllib.parse import parse_qs, urlsplit
+import hashlib
+import json
+import math
+import os
+import re
+import time
+
+
+# Default and maximum number of results per page
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+
+# Positions per chunk of the streamed responses
+CHUNK_POSITIONS = 100
+
+RESOLUTIONS = ('auto', 'raw', 'simplified')
+
+
+class BadRequest(Exception):
+    """
+    Raised for invalid parameters, answered with a 400 status.
+    """
+
+
+def position_json(position):
+    """
+    JSON-serializable dictionary of a position, with None for unknown values.
+    """
+    return({
+        'imei': '%d' % position.imei,
+        'timestamp': position.timestamp,
+        'datetime': datetime.fromtimestamp(position.timestamp, timezone.utc).isoformat(),
+        'method': position.method,
+        'valid': position.valid,
+        'latitude': (None if math.isnan(position.latitude) else position.latitude),
+        'longitude': (None if math.isnan(position.longitude) else position.longitude),
+        'accuracy': (None if math.isnan(position.accuracy) else position.accuracy),
+        'speed': (None if math.isnan(position.speed) else position.speed),
+        'heading': (None if math.isnan(position.heading) else position.heading),
+    })
+
+
+def paginate(positions, cursor, limit):
+    """
+    Returns the page of positions (sorted by timestamp) following a cursor
+    ('<timestamp>,<number of positions already returned at that timestamp>'),
+    and the cursor of the next page or None.
+    """
+    if (cursor is not None):
+        timestamp, skip = cursor
+        positions = [ p for p in positions if p.timestamp >= timestamp ]
+        same = 0
+        while (same < len(positions) and same < skip and positions[same].timestamp == timestamp):
+            same += 1
+        positions = positions[same:]
+    if (len(positions) <= limit):
+        return(positions, None)
+
+    page = positions[:limit]
+    last = page[-1].timestamp
+    skip = sum([ 1 for p in page if p.timestamp == last ])
+    if (cursor is not None and cursor[0] == last):
+        skip += cursor[1]
+    return(page, (last, skip))
+
+
+def page_size(cursor, limit):
+    """
+    Number of positions to query for a page following a cursor (see
+    paginate()): those skipped at the timestamp of the cursor, the page,
+    and one more to know if there are more.
+    """
+    return((0 if cursor is None else cursor[1]) + limit + 1)
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the API. The position store is set on the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'petGPS'
+
+    routes = [
+        (re.compile(r'^/positions/latest$'), 'latest_all'),
+        (re.compile(r'^/devices/(\d+)/latest$'), 'latest_device'),
+        (re.compile(r'^/devices/(\d+)/track$'), 'track'),
+        (re.compile(r'^/positions$'), 'bbox'),
+    ]
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = { k: v[-1] for k, v in parse_qs(url.query).items() }
+        for pattern, name in self.routes:
+            match = pattern.match(url.path)
+            if (match):
+                try:
+                    getattr(self, name)(params, *match.groups())
+                except BadRequest as e:
+                    self.send_json(400, {'error': str(e)})
+                return
+        self.send_json(404, {'error': 'not found'})
+
+    def log_message(self, format, *args):
+        # Quiet: polling clients would flood the console
+        pass
+
+    # Endpoints
+
+    def latest_all(self, params):
+        store = self.server.store
+        limit = self.limit(params)
+        cursor = int(params['cursor']) if params.get('cursor', '').isdigit() else -1
+        imeis = [ imei for imei in store.imeis() if imei > cursor ]
+        page = imeis[:limit]
+        if (self.not_modified([ (imei, store.version(imei)) for imei in page ])):
+            return
+        positions = (store.latest(imei) for imei in page)
+        self.stream(( p for p in positions if p is not None ), (('%d' % page[-1]) if len(imeis) > limit else None))
+
+    def latest_device(self, params, imei):
+        store = self.server.store
+        if (self.not_modified(store.version(imei))):
+            return
+        position = store.latest(imei)
+        if (position is None):
+            self.send_json(404, {'error': 'no position for this device'})
+            return
+        self.send_json(200, position_json(position), etag=self.etag)
+
+    def track(self, params, imei):
+        store = self.server.store
+        start, end = self.time_range(params)
+        resolution = self.resolution(params)
+        tolerance = self.tolerance(params)
+        cursor = self.cursor(params)
+        limit = self.limit(params)
+        if (self.not_modified(store.version(imei), params)):
+            return
+        # A simplified track depends on where it starts: pages are cut from the whole track
+        if (tolerance):
+            positions = store.query(imei, start, end, resolution=resolution, tolerance=tolerance)
+        else:
+            if (cursor is not None):
+                start = max(start, cursor[0])
+            positions = store.query(imei, start, end, resolution=resolution, limit=page_size(cursor, limit))
+        positions, next_cursor = paginate(positions, cursor, limit)
+        self.stream(positions, (None if next_cursor is None else '%r,%d' % next_cursor))
+
+    def bbox(self, params):
+        store = self.server.store
+        try:
+            bbox = tuple([ float(x) for x in params['bbox'].split(',') ])
+        except (KeyError, ValueError):
+            raise BadRequest('bbox=<min lat>,<min lon>,<max lat>,<max lon> is required')
+        if (len(bbox) != 4):
+            raise BadRequest('bbox=<min lat>,<min lon>,<max lat>,<max lon> is required')
+        start, end = self.time_range(params)
+        resolution = self.resolution(params)
+        limit = self.limit(params)
+        # Cursor: IMEI, then the cursor within the positions of that device
+        cursor_imei, cursor = -1, None
+        if (params.get('cursor')):
+            try:
+                imei, timestamp, skip = params['cursor'].split(',')
+                cursor_imei, cursor = int(imei), (float(timestamp), int(skip))
+            except ValueError:
+                raise BadRequest('invalid cursor')
+
+        imeis = [ imei for imei in store.imeis() if imei >= cursor_imei ]
+        if (self.not_modified([ (imei, store.version(imei)) for imei in imeis ], params)):
+            return
+
+        def results():
+            # Pages are filled device after device; the next cursor is only known at the end
+            remaining = limit
+            for imei in imeis:
+                device_cursor = (cursor if imei == cursor_imei else None)
+                positions = store.query(imei, (start if device_cursor is None else max(start, device_cursor[0])), end, bbox, resolution,
+                    limit=page_size(device_cursor, remaining))
+                page, next_cursor = paginate(positions, device_cursor, remaining)
+                yield from page
+                remaining -= len(page)
+                if (next_cursor is not None):
+                    self.next_cursor = '%d,%r,%d' % ((imei,) + next_cursor)
+                    return
+                if (remaining == 0):
+                    # Next device, if any
+                    following = [ i for i in imeis if i > imei ]
+                    if (following):
+                        self.next_cursor = '%d,%r,%d' % (following[0], -math.inf, 0)
+                    return
+
+        self.next_cursor = None
+        self.stream(results(), lambda: self.next_cursor)
+
+    # Parameters
+
+    def limit(self, params):
+        try:
+            limit = int(params.get('limit', DEFAULT_LIMIT))
+        except ValueError:
+            raise BadRequest('invalid limit')
+        if (limit < 1 or limit > MAX_LIMIT):
+            raise BadRequest('limit must be between 1 and %d' % MAX_LIMIT)
+        return(limit)
+
+    def time_range(self, params):
+        try:
+            end = float(params.get('end', time.time()))
+            start = float(params.get('start', end - 24 * 3600))
+        except ValueError:
+            raise BadRequest('start and end must be UTC epoch timestamps')
+        return(start, end)
+
+    def resolution(self, params):
+        resolution = params.get('resolution', 'auto')
+        if (resolution not in RESOLUTIONS):
+            raise BadRequest('resolution must be one of %s' % ', '.join(RESOLUTIONS))
+        return(resolution)
+
+    def tolerance(self, params):
+        try:
+            tolerance = float(params.get('tolerance', 0))
+        except ValueError:
+            raise BadRequest('invalid tolerance')
+        if (not 0 <= tolerance < math.inf):
+            raise BadRequest('tolerance must be a positive number of meters')
+        return(tolerance)
+
+    def cursor(self, params):
+        if (not params.get('cursor')):
+            return(None)
+        try:
+            timestamp, skip = params['cursor'].split(',')
+            return(float(timestamp), int(skip))
+        except ValueError:
+            raise BadRequest('invalid cursor')
+
+    # Responses
+
+    def not_modified(self, version, params=None):
+        """
+        Computes the ETag of the response from the version of the files it
+        reads and from the request, and answers 304 if the client has it.
+        Responses to time ranges (params) without an end have no ETag.
+        """
+        if (params is not None and 'end' not in params):
+            self.etag = None
+            return(False)
+        self.etag = '"%s"' % hashlib.sha1(repr((self.path, version)).encode()).hexdigest()[:20]
+        if (self.headers.get('If-None-Match') == self.etag):
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return(True)
+        return(False)
+
+    def send_json(self, status, body, etag=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if (etag):
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream(self, positions, next_cursor):
+        """
+        Streams {"positions": [...], "next_cursor": ...} with chunked transfer
+        encoding, CHUNK_POSITIONS positions at a time. next_cursor may be a
+        function, called once all positions were sent.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        if (self.etag):
+            self.send_header('ETag', self.etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        self.write_chunk('{"positions": [')
+        batch = []
+        first = True
+        for position in positions:
+            batch.append(json.dumps(position_json(position)))
+            if (len(batch) == CHUNK_POSITIONS):
+                self.write_chunk(('' if first else ', ') + ', '.join(batch))
+                batch = []
+                first = False
+        if (batch):
+            self.write_chunk(('' if first else ', ') + ', '.join(batch))
+        if (callable(next_cursor)):
+            next_cursor = next_cursor()
+        self.write_chunk('], "next_cursor": %s}' % json.dumps(next_cursor))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    server = ThreadingHTTPServer((os.getenv('HTTP_API_HOST', ''), int(os.getenv('HTTP_API_PORT', 8080))), ApiHandler)
+    server.daemon_threads = True
+    # Read-only: the files belong to gps_tcp_server.py
+    server.store = TieredStore(directory=os.getenv('POSITION_STORE_PATH', './data/positions/'), 
+        simplified_directory=os.getenv('POSITION_SIMPLIFIED_PATH', './data/positions-simplified/'), 
+        raw_retention=float(os.getenv('POSITION_RAW_RETENTION', 30 * 86400)), writable=False)
+    print('HTTP API listening on port', server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
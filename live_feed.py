@@ -0,0 +1,299 @@
+"""
+Live feed of the positions and status of the devices, served as
+Server-Sent Events (SSE), so that a map can follow them without polling:
+
+    curl -N http://127.0.0.1:9200/live?imei=359339075016807
+    new EventSource('http://127.0.0.1:9200/live?events=position')
+
+The connections of the devices only record each event (a dictionary
+assignment and a queue append): a background thread encodes it once, and
+hands the encoded message to the subscribers that want it. Each subscriber
+is served by its own thread, from a bounded queue holding the latest
+position and status of each device: a viewer that does not keep up skips
+the positions it missed rather than slowing down the others, or the
+devices. Geofence events are transitions, each of which matters: they are
+queued one by one, never replaced by the next.
+
+Subscribers can filter by IMEI (imei=, comma-separated) and by event
+(events=position,status,geofence). On subscription they get the latest
+position and status of each device they follow.
+"""
+
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Event, Lock, Thread
+from urllib.parse import parse_qs, urlsplit
+import itertools
+import json
+import math
+import time
+
+
+EVENTS = ('position', 'status', 'geofence')
+
+# Events of which only the latest one of each device matters (the others are all sent)
+LATEST_EVENTS = ('position', 'status')
+
+# Time between keep-alive comments on idle streams, in seconds
+KEEPALIVE_INTERVAL = 15.0
+
+
+def encode_event(event, imei, timestamp, record, sequence):
+    """
+    Encodes an event (record is a named tuple, see position_store.Position,
+    codec.Status and geofence.GeofenceEvent) as an SSE message, with None for
+    unknown (NaN) values. The name of the event is that of the SSE message.
+    """
+    data = {'imei': '%d' % imei, 'timestamp': timestamp}
+    for name, value in zip(record._fields, record):
+        if (name in ('protocol', 'imei')):
+            continue
+        if (isinstance(value, float) and math.isnan(value)):
+            value = None
+        data[name] = value
+    return(('id: %d\nevent: %s\ndata: %s\n\n' % (sequence, event, json.dumps(data, separators=(',', ':')))).encode())
+
+
+class Subscriber():
+    """
+    Bounded queue of the messages to send to a subscriber, by key: a new
+    message replaces the one with the same key still waiting (it is
+    coalesced). Positions and status are keyed by (event, IMEI), other
+    events by (event, IMEI, sequence), so that none replaces another. When
+    max_queue messages are waiting, the oldest one is dropped.
+    """
+
+    __slots__ = ('imeis', 'events', 'max_queue', 'pending', 'condition', 'coalesced', 'dropped', 'closed')
+
+    def __init__(self, imeis=None, events=None, max_queue=1000):
+        # IMEIs and events followed, None for all
+        self.imeis = imeis
+        self.events = events
+        self.max_queue = max_queue
+        self.pending = OrderedDict()
+        self.condition = Condition(Lock())
+        self.coalesced = 0
+        self.dropped = 0
+        self.closed = False
+
+    def wants(self, event, imei):
+        return((self.events is None or event in self.events) and (self.imeis is None or imei in self.imeis))
+
+    def put(self, key, message, replace=True):
+        with self.condition:
+            if (key in self.pending):
+                if (not replace):
+                    return
+                self.coalesced += 1
+            elif (len(self.pending) >= self.max_queue):
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[key] = message
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Returns the messages waiting, oldest first, after waiting at most
+        timeout seconds for one (an empty list if none came or if closed).
+        """
+        with self.condition:
+            if (not self.pending and not self.closed):
+                self.condition.wait(timeout)
+            messages = list(self.pending.values())
+            self.pending.clear()
+        return(messages)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class LiveFeed():
+    """
+    Hub of the live events, from the connections of the devices to the
+    subscribers. Thread-safe.
+
+        - max_queue: bound of the queue of each subscriber, in devices,
+        - max_backlog: bound of the events waiting to be encoded (the oldest
+          are dropped if the encoding thread does not keep up),
+        - interval: time between the checks of the backlog by the encoding
+          thread while there are subscribers, in seconds (waking it up for
+          each event would cost the connections of the devices more than
+          the rest of the publication).
+    """
+
+    def __init__(self, max_queue=1000, max_backlog=10000, interval=0.005):
+        self.max_queue = max_queue
+        self.interval = interval
+        self.published = 0
+        self.sent = 0
+        # Messages coalesced and dropped for the subscribers that left, and events dropped from the backlog
+        self.coalesced = 0
+        self.dropped = 0
+        self.overflows = 0
+        self._backlog = deque(maxlen=max_backlog)
+        self._wakeup = Event()
+        self._lock = Lock()
+        # Subscribers following all devices, and by IMEI; tuples, replaced on change
+        self._all = ()
+        self._by_imei = {}
+        self._count = 0
+        self._sequence = itertools.count(1)
+        # Latest position and status of each device, for new subscribers: (timestamp, record) by (event, IMEI)
+        self._latest = {}
+        self._thread = Thread(target=self._run, name='live-feed', daemon=True)
+        self._thread.start()
+
+    def publish(self, event, imei, record, timestamp=None):
+        """
+        Publishes an event of a device (a named tuple record). Only recorded
+        here: it is encoded and sent by the background thread.
+        """
+        timestamp = (time.time() if timestamp is None else timestamp)
+        if (event in LATEST_EVENTS):
+            self._latest[(event, imei)] = (timestamp, record)
+        self.published += 1
+        if (self._count):
+            backlog = self._backlog
+            if (len(backlog) == backlog.maxlen):
+                self.overflows += 1
+            backlog.append((event, imei, timestamp, record))
+
+    def subscribe(self, imeis=None, events=None):
+        """
+        Returns a new subscriber, with the latest position and status of each device it follows queued.
+        """
+        subscriber = Subscriber(imeis, events, self.max_queue)
+        with self._lock:
+            if (imeis is None):
+                self._all = self._all + (subscriber,)
+            else:
+                for imei in imeis:
+                    self._by_imei[imei] = self._by_imei.get(imei, ()) + (subscriber,)
+            self._count += 1
+        self._wakeup.set()
+        # Events published since it was added are newer than these
+        sequence = next(self._sequence)
+        for (event, imei), (timestamp, record) in sorted(self._latest.copy().items(), key=lambda item: item[1][0]):
+            if (subscriber.wants(event, imei)):
+                subscriber.put((event, imei), encode_event(event, imei, timestamp, record, sequence), replace=False)
+        return(subscriber)
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self._lock:
+            if (subscriber.imeis is None):
+                self._all = tuple(s for s in self._all if s is not subscriber)
+            else:
+                for imei in subscriber.imeis:
+                    remaining = tuple(s for s in self._by_imei.get(imei, ()) if s is not subscriber)
+                    if (remaining):
+                        self._by_imei[imei] = remaining
+                    else:
+                        self._by_imei.pop(imei, None)
+            self._count -= 1
+            self.coalesced += subscriber.coalesced
+            self.dropped += subscriber.dropped
+
+    def stats(self):
+        """
+        Returns the number of subscribers, of events published (and dropped
+        before they were encoded), of messages queued for the subscribers, and
+        of messages coalesced and dropped from their queues.
+        """
+        with self._lock:
+            subscribers = set(self._all)
+            for followers in self._by_imei.values():
+                subscribers.update(followers)
+            coalesced = self.coalesced + sum(s.coalesced for s in subscribers)
+            dropped = self.dropped + sum(s.dropped for s in subscribers)
+        return({'subscribers': self._count, 'published': self.published, 'overflows': self.overflows, 'sent': self.sent,
+            'coalesced': coalesced, 'dropped': dropped})
+
+    def _run(self):
+        # Encodes each event once, and queues it for the subscribers that want it
+        backlog = self._backlog
+        while (True):
+            # Idle until there is a subscriber
+            while (not self._count):
+                self._wakeup.wait()
+                self._wakeup.clear()
+            time.sleep(self.interval)
+            while (backlog):
+                event, imei, timestamp, record = backlog.popleft()
+                message = None
+                for subscriber in self._all + self._by_imei.get(imei, ()):
+                    if (subscriber.events is not None and event not in subscriber.events):
+                        continue
+                    if (message is None):
+                        sequence = next(self._sequence)
+                        message = encode_event(event, imei, timestamp, record, sequence)
+                        key = ((event, imei) if event in LATEST_EVENTS else (event, imei, sequence))
+                    subscriber.put(key, message)
+                    self.sent += 1
+
+
+class LiveFeedHandler(BaseHTTPRequestHandler):
+    """
+    Serves the live feed of the server on /live, as an SSE stream.
+    """
+
+    # Streams whose client does not read for this long are closed
+    timeout = 60
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if (url.path != '/live'):
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        try:
+            imeis = None
+            if ('imei' in query):
+                imeis = set(int(imei) for value in query['imei'] for imei in value.split(',') if imei)
+            events = None
+            if ('events' in query):
+                events = set(event for value in query['events'] for event in value.split(',') if event)
+                if (events - set(EVENTS)):
+                    raise ValueError('unknown events: %s' % ', '.join(sorted(events - set(EVENTS))))
+        except ValueError as e:
+            self.send_error(400, explain=str(e))
+            return
+
+        feed = self.server.feed
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        if (self.server.allow_origin):
+            self.send_header('Access-Control-Allow-Origin', self.server.allow_origin)
+        self.end_headers()
+        subscriber = feed.subscribe(imeis, events)
+        try:
+            # Messages waiting are sent in a single write
+            self.wfile.write(b'retry: 5000\n\n')
+            while (True):
+                messages = subscriber.get(KEEPALIVE_INTERVAL)
+                self.wfile.write(b''.join(messages) if messages else b': keep-alive\n\n')
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            feed.unsubscribe(subscriber)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(feed, port, host='127.0.0.1', allow_origin=''):
+    """
+    Serves the live feed from a background thread, and returns the server.
+    allow_origin is sent as Access-Control-Allow-Origin (for a map served
+    from another origin), when set.
+    """
+    server = ThreadingHTTPServer((host, port), LiveFeedHandler)
+    server.daemon_threads = True
+    server.feed = feed
+    server.allow_origin = allow_origin
+    Thread(target=server.serve_forever, name='live-feed-http', daemon=True).start()
+    return(server)
@@ -0,0 +1,187 @@
+"""
+Background writer for the log files of the server.
+
+Connections must not open, write and close a log file for every packet:
+they only push records to a bounded queue, and a single writer thread
+keeps the log files open, writes records by batches and flushes them when
+enough are buffered or after a short interval. Lines of different
+connections can therefore not interleave.
+
+Log files are rotated when they exceed a size, or when the day changes:
+the current file is renamed with the date and time of the rotation, and
+a new one is started.
+
+When the queue is full (disk too slow, or far too many packets), records
+are dropped rather than blocking connections, and the number of dropped
+records is reported. Records that can not be written (disk full, directory
+removed) are lost as well, the error is reported once per file until it
+can be written again, and the writer keeps running.
+"""
+
+from datetime import datetime
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+import atexit
+import clock
+import os
+import serverlog
+import time
+
+
+# Dropped records are reported at most once per this interval, in seconds
+DROP_REPORT_INTERVAL = 10
+
+
+class LogWriter():
+    """
+    Writes log records to files of a directory, from a single thread.
+
+        - max_queue: records waiting to be written, beyond which they are dropped,
+        - batch_size: buffered records that trigger a flush,
+        - flush_interval: maximum time a record stays buffered, in seconds,
+        - max_bytes: size that triggers the rotation of a file (0 to disable),
+        - rotate_daily: rotate files when the day changes.
+    """
+
+    def __init__(self, directory='./logs/', max_queue=10000, batch_size=256, flush_interval=1.0, max_bytes=50 * 1024 * 1024, rotate_daily=True):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._reported = 0
+        self._reported_at = 0
+        self._lock = Lock()
+        self._queue = Queue(maxsize=max_queue)
+        # Open files by name: file object, size and day it was opened
+        self._files = {}
+        # Files whose last write failed, for the error to be reported once
+        self._failing = set()
+
+        os.makedirs(directory, exist_ok=True)
+        self._thread = Thread(target=self._run, name='logwriter', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, filename, line):
+        """
+        Queues a line (without its timestamp, nor its end of line) to be
+        written to a file. Never blocks: the line is dropped if the queue is full.
+        """
+        try:
+            self._queue.put_nowait((filename, time.time(), line))
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+    def stats(self):
+        """
+        Returns counters of the writer.
+        """
+        with self._lock:
+            return({'queued': self._queue.qsize(), 'written': self.written, 'dropped': self.dropped, 'failed': self.failed})
+
+    def close(self):
+        """
+        Writes all queued records and stops the writer thread.
+        """
+        if (self._thread.is_alive()):
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        buffers = {}
+        buffered = 0
+        deadline = None
+        running = True
+        while (running):
+            try:
+                record = self._queue.get(timeout=(None if deadline is None else max(deadline - time.monotonic(), 0)))
+            except Empty:
+                record = False
+
+            if (record is None):
+                running = False
+            elif (record):
+                filename, timestamp, line = record
+                # Timestamps are formatted once per second (see clock.py)
+                buffers.setdefault(filename, []).append(clock.log_timestamp(timestamp) + '\t' + line + '\n')
+                buffered += 1
+                if (deadline is None):
+                    deadline = time.monotonic() + self.flush_interval
+
+            if (buffered and (not running or buffered >= self.batch_size or time.monotonic() >= deadline)):
+                failed = 0
+                for filename, lines in buffers.items():
+                    try:
+                        self._write_lines(filename, lines)
+                    except OSError as e:
+                        failed += len(lines)
+                        self._write_failed(filename, e)
+                    else:
+                        self._failing.discard(filename)
+                with self._lock:
+                    self.written += buffered - failed
+                    self.failed += failed
+                    dropped = self.dropped - self._reported
+                if (dropped and (not running or time.monotonic() - self._reported_at >= DROP_REPORT_INTERVAL)):
+                    serverlog.warning(None, 'Log queue full, %d records dropped.', dropped)
+                    self._reported += dropped
+                    self._reported_at = time.monotonic()
+                buffers = {}
+                buffered = 0
+                deadline = None
+
+        for entry in self._files.values():
+            try:
+                entry[0].close()
+            except OSError:
+                pass
+        self._files = {}
+
+    def _write_failed(self, filename, error):
+        # The file is opened again on the next write, in case it was removed
+        entry = self._files.pop(filename, None)
+        if (entry is not None):
+            try:
+                entry[0].close()
+            except OSError:
+                pass
+        if (filename not in self._failing):
+            self._failing.add(filename)
+            serverlog.warning(None, 'Could not write log file %s (%s), records lost until it can be written again.', filename, error)
+
+    def _write_lines(self, filename, lines):
+        path = os.path.join(self.directory, filename)
+        entry = self._files.get(filename)
+        day = datetime.now().date()
+        if (entry is not None and ((self.max_bytes and entry[1] >= self.max_bytes) or (self.rotate_daily and entry[2] != day))):
+            entry[0].close()
+            self._rotate(path)
+            entry = None
+        if (entry is None):
+            f = open(path, 'a+')
+            entry = self._files[filename] = [f, f.tell(), day]
+            if (self.rotate_daily and entry[1] and datetime.fromtimestamp(os.path.getmtime(path)).date() != day):
+                # Left over by a previous run, on another day
+                f.close()
+                self._rotate(path)
+                f = open(path, 'a+')
+                entry = self._files[filename] = [f, 0, day]
+
+        data = ''.join(lines)
+        entry[0].write(data)
+        entry[0].flush()
+        entry[1] += len(data)
+
+    @staticmethod
+    def _rotate(path):
+        rotated = path + '.' + datetime.now().strftime('%Y%m%d-%H%M%S')
+        n = 1
+        while (os.path.exists(rotated)):
+            rotated = path + '.' + datetime.now().strftime('%Y%m%d-%H%M%S') + '.' + str(n)
+            n += 1
+        os.rename(path, rotated)
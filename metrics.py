@@ -0,0 +1,257 @@
+"""
+In-process metrics of the server, exposed in the Prometheus text format.
+
+Counters, gauges and histograms are updated on every packet, from many
+threads (one per connection in 'threads' mode, plus the geolocation
+workers): they must cost next to nothing. Each thread therefore updates
+its own cell of a metric, without any lock, and cells are only summed
+when the metrics are scraped. Cells of threads that ended are folded
+into the metric at that time, and whenever their number doubled, so that
+closed connections do not leave cells behind (even when the metrics are
+never scraped).
+
+The metrics are served on a local HTTP endpoint:
+    curl http://127.0.0.1:9105/metrics
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, current_thread, local
+import bisect
+import math
+
+
+# Default buckets of histograms, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Cells():
+    """
+    Per-thread cells of a metric: lists of size numbers, only ever written
+    by their own thread.
+    """
+
+    __slots__ = ('size', 'local', 'cells', 'folded', 'limit', 'lock')
+
+    def __init__(self, size):
+        self.size = size
+        self.local = local()
+        # (thread, cell) pairs, and values of the threads that ended
+        self.cells = []
+        self.folded = [0] * size
+        # Number of cells beyond which those of the threads that ended are folded
+        self.limit = 64
+        self.lock = Lock()
+
+    def cell(self):
+        try:
+            return(self.local.cell)
+        except AttributeError:
+            cell = self.local.cell = [0] * self.size
+            with self.lock:
+                self.cells.append((current_thread(), cell))
+                if (len(self.cells) >= self.limit):
+                    self.fold()
+            return(cell)
+
+    def values(self):
+        """
+        Returns the sum of all the cells, and folds the cells of the threads
+        that ended.
+        """
+        with self.lock:
+            self.fold()
+            total = list(self.folded)
+            for thread, cell in self.cells:
+                total = [ a + b for a, b in zip(total, cell) ]
+        return(total)
+
+    def fold(self):
+        # Folds the cells of the threads that ended (lock held)
+        alive = []
+        for thread, cell in self.cells:
+            if (thread.is_alive()):
+                alive.append((thread, cell))
+            else:
+                self.folded = [ a + b for a, b in zip(self.folded, cell) ]
+        self.cells = alive
+        self.limit = max(64, 2 * len(alive))
+
+
+class Metric():
+    """
+    Base class of metrics: a name, a help text and optional labels. With
+    labels, values are held by children, one per combination of labels.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = Lock()
+        self._function = None
+        if (not self.label_names):
+            self._init_values()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def labels(self, *values):
+        """
+        Returns the child metric of a combination of label values.
+        """
+        child = self._children.get(values)
+        if (child is None):
+            with self._lock:
+                child = self._children.get(values)
+                if (child is None):
+                    # Same settings as the metric (buckets of histograms), without labels
+                    child = object.__new__(type(self))
+                    child.__dict__.update(self.__dict__)
+                    child.label_names = ()
+                    child._children = {}
+                    child._function = None
+                    child._init_values()
+                    self._children[values] = child
+        return(child)
+
+    def set_function(self, function):
+        """
+        Reads the value of the metric from a function when scraped, for
+        values that are already counted elsewhere.
+        """
+        self._function = function
+
+    def samples(self):
+        """
+        Returns the (suffix, labels dictionary, value) samples of the metric.
+        """
+        if (not self.label_names):
+            return(self._samples({}))
+        samples = []
+        for values, child in sorted(self._children.items()):
+            samples.extend(child._samples(dict(zip(self.label_names, values))))
+        return(samples)
+
+
+class Counter(Metric):
+    """
+    Monotonic counter.
+    """
+
+    type = 'counter'
+
+    def _init_values(self):
+        self._cells = Cells(1)
+
+    def inc(self, amount=1):
+        self._cells.cell()[0] += amount
+
+    def _samples(self, labels):
+        value = self._function() if (self._function is not None) else self._cells.values()[0]
+        return([ ('', labels, value) ])
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down (the sum of all increments and decrements).
+    """
+
+    type = 'gauge'
+
+    def dec(self, amount=1):
+        self._cells.cell()[0] -= amount
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, in cumulative buckets.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels, registry)
+
+    def _init_values(self):
+        # Counts of each bucket, of values above the last bucket, then sum of the values
+        self._cells = Cells(len(self.buckets) + 2)
+
+    def observe(self, value):
+        cell = self._cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def _samples(self, labels):
+        values = self._cells.values()
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), values):
+            cumulative += count
+            samples.append(('_bucket', dict(labels, le=('+Inf' if bound == math.inf else repr(float(bound)))), cumulative))
+        samples.append(('_sum', labels, values[-1]))
+        samples.append(('_count', labels, cumulative))
+        return(samples)
+
+
+class Registry():
+    """
+    Set of metrics, rendered together.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """
+        Returns all the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                if (labels):
+                    labels = '{%s}' % ','.join([ '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items() ])
+                else:
+                    labels = ''
+                lines.append('%s%s%s %s' % (metric.name, suffix, labels, repr(float(value))))
+        return('\n'.join(lines) + '\n')
+
+
+REGISTRY = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics of the registry of the server on /metrics.
+    """
+
+    def do_GET(self):
+        if (self.path.split('?')[0] not in ('/', '/metrics')):
+            self.send_error(404)
+            return
+        data = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host='127.0.0.1', registry=REGISTRY):
+    """
+    Serves the metrics from a background thread, and returns the server.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return(server)
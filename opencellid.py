@@ -0,0 +1,157 @@
+"""
+Offline geolocation of GSM cells, from the OpenCellID database.
+
+OpenCellID (https://opencellid.org/) publishes the position of tens of
+millions of cell towers as a CSV file, with the following columns:
+    radio, mcc, net, area, cell, unit, lon, lat, range, samples,
+    changeable, created, updated, averageSignal
+
+The importer below streams that file (plain or gzipped) into a SQLite
+table keyed on (MCC, MNC, LAC, Cell ID), without rowid, so that the key
+is the clustered index and a lookup is a single B-tree search.
+The resolver then locates a WiFi/LBS scan from its GSM cells alone, as
+the centroid of the known cells weighted by their signal strength.
+
+Usage:
+    python opencellid.py import cell_towers.csv.gz ./data/opencellid.sqlite [--mcc 208 --mcc 209]
+    python opencellid.py lookup ./data/opencellid.sqlite MCC MNC LAC CELLID
+"""
+
+import argparse
+import csv
+import gzip
+import math
+import os
+from threading import Lock
+import sqlite3
+import time
+
+
+# Radius of the earth, in meters
+EARTH_RADIUS = 6371000
+
+# Cells without a range are assumed to cover this radius, in meters
+DEFAULT_RANGE = 1000
+
+
+def import_csv(csv_path, db_path, mccs=None, radios=('GSM',), batch_size=100000):
+    """
+    Streams the OpenCellID CSV file into the SQLite database, keeping only
+    the given radio types (2G trackers only see GSM cells) and, if given,
+    the given MCCs. Returns the number of imported cells.
+    """
+
+    directory = os.path.dirname(db_path)
+    if (directory):
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(db_path)
+    # Nothing to protect during a bulk import: the file can be imported again
+    db.execute('PRAGMA journal_mode=OFF')
+    db.execute('PRAGMA synchronous=OFF')
+    db.execute('''CREATE TABLE IF NOT EXISTS cells (
+        mcc INTEGER NOT NULL, mnc INTEGER NOT NULL, lac INTEGER NOT NULL, cid INTEGER NOT NULL,
+        lat REAL NOT NULL, lon REAL NOT NULL, range INTEGER NOT NULL, samples INTEGER NOT NULL,
+        PRIMARY KEY (mcc, mnc, lac, cid)) WITHOUT ROWID''')
+
+    mccs = set(str(m) for m in mccs) if mccs else None
+    radios = set(radios)
+    opener = gzip.open if csv_path.endswith('.gz') else open
+    count = 0
+    with opener(csv_path, 'rt', newline='') as f:
+        rows = []
+        for row in csv.reader(f):
+            # Header and unwanted rows
+            if (row[0] not in radios or (mccs is not None and row[1] not in mccs)):
+                continue
+            rows.append((int(row[1]), int(row[2]), int(row[3]), int(row[4]), float(row[7]), float(row[6]), int(row[8] or 0), int(row[9] or 0)))
+            if (len(rows) >= batch_size):
+                db.executemany('INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                count += len(rows)
+                rows = []
+        db.executemany('INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        count += len(rows)
+    db.commit()
+    db.close()
+    return(count)
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance between two points, in meters (haversine formula).
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return(2 * EARTH_RADIUS * math.asin(math.sqrt(a)))
+
+
+class CellDatabase():
+    """
+    Read-only access to an imported OpenCellID database. Thread-safe: it is
+    shared by the connections and the geolocation workers.
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect('file:%s?mode=ro' % path, uri=True, check_same_thread=False)
+        self._query = 'SELECT lat, lon, range FROM cells WHERE mcc = ? AND mnc = ? AND lac = ? AND cid = ?'
+        self._lock = Lock()
+
+    def lookup(self, mcc, mnc, lac, cid):
+        """
+        Returns (latitude, longitude, range in meters) of a cell, or None.
+        """
+        with self._lock:
+            return(self._db.execute(self._query, (mcc, mnc, lac, cid)).fetchone())
+
+    def locate(self, mcc, mnc, cells):
+        """
+        Locates a scan from its GSM cells, given as dictionaries with
+        'locationAreaCode', 'cellId' and 'signalStrength' (dBm) keys, like in
+        the position dictionary of a client.
+
+        The position is the centroid of the known cells, each weighted by its
+        received power in amplitude (10^(dBm/20)), so that the strongest cell
+        counts the most. Accuracy is the weighted mean of the distance of each
+        cell to the centroid plus its range.
+
+        Returns a dictionary like the Google Maps Geolocation API does, or None
+        if none of the cells is known.
+        """
+
+        known = []
+        for cell in cells:
+            found = self.lookup(mcc, mnc, cell['locationAreaCode'], cell['cellId'])
+            if (found is not None):
+                known.append((found, 10 ** (cell['signalStrength'] / 20)))
+        if (not known):
+            return(None)
+
+        total = sum([ weight for cell, weight in known ])
+        latitude = sum([ cell[0] * weight for cell, weight in known ]) / total
+        longitude = sum([ cell[1] * weight for cell, weight in known ]) / total
+        accuracy = sum([ (distance(latitude, longitude, cell[0], cell[1]) + (cell[2] or DEFAULT_RANGE)) * weight for cell, weight in known ]) / total
+        return({'location': {'lat': latitude, 'lng': longitude}, 'accuracy': accuracy, 'cells': len(known)})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import and query an OpenCellID database.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_import = subparsers.add_parser('import', help='import an OpenCellID CSV file')
+    parser_import.add_argument('csv_path')
+    parser_import.add_argument('db_path')
+    parser_import.add_argument('--mcc', action='append', help='only import cells of this MCC (repeatable)')
+    parser_import.add_argument('--radio', action='append', default=None, help='radio types to import (default: GSM)')
+    parser_lookup = subparsers.add_parser('lookup', help='look up a cell')
+    parser_lookup.add_argument('db_path')
+    parser_lookup.add_argument('mcc', type=int)
+    parser_lookup.add_argument('mnc', type=int)
+    parser_lookup.add_argument('lac', type=int)
+    parser_lookup.add_argument('cid', type=int)
+    args = parser.parse_args()
+
+    if (args.command == 'import'):
+        start = time.monotonic()
+        count = import_csv(args.csv_path, args.db_path, mccs=args.mcc, radios=args.radio or ('GSM',))
+        print('Imported', count, 'cells in %.1f s' % (time.monotonic() - start), '; database size = %.1f MB' % (os.path.getsize(args.db_path) / 1e6))
+    else:
+        print(CellDatabase(args.db_path).lookup(args.mcc, args.mnc, args.lac, args.cid))
@@ -0,0 +1,387 @@
+"""
+Binary store of the positions of the devices.
+
+location_log.txt is meant to be read by humans: finding the positions of
+one device over a period of time means parsing the whole text file.
+Positions are also appended here as fixed-width binary records:
+
+    timestamp (float64, UTC epoch), IMEI (uint64), method (uint8),
+    validity (uint8), latitude and longitude (float64),
+    accuracy, speed and heading (float32; NaN when unknown)
+
+Each device has its own directory, with one segment file per month
+(YYYYMM.bin), so that the records of a device are contiguous on disk.
+Segments are cut into blocks of block_records records, and the bounds of
+every complete block (smallest and largest timestamp, latitude and
+longitude) are appended to a sparse index (YYYYMM.idx). A range query only
+opens the segments of the months it covers, and only reads (through a
+memory map) the blocks whose bounds intersect the range and bounding box:
+a few pages, even over years of data. Timestamps do not need to be in
+order (offline packets come late).
+
+Segments may be read by other processes (see http_api.py) while the
+server appends to them: records appended since a segment was last read
+are picked up from the size of its file. Several processes (the worker
+processes of the server) may append to the same segment: appends hold a
+lock on the segment file (flock), under which the records appended by
+the others are accounted for first, so that the index is written once
+and in order. Whole segments may be dropped (see track_simplifier.py).
+"""
+
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from threading import Lock
+import fcntl
+import math
+import mmap
+import os
+import struct
+
+
+# Fixed-width record (48 bytes)
+RECORD = struct.Struct('<dQBB2xddfff')
+
+# Sparse index entry: bounds of a block, as smallest and largest timestamp, latitude and longitude
+INDEX_ENTRY = struct.Struct('<6d')
+EMPTY_BOUNDS = (math.inf, -math.inf, math.inf, -math.inf, math.inf, -math.inf)
+
+# Methods, stored as their position in this tuple
+METHODS = ('GPS', 'LBS', 'LBS-GSM', 'LBS-GSM-WIFI')
+
+Position = namedtuple('Position', ['timestamp', 'imei', 'method', 'valid', 'latitude', 'longitude', 'accuracy', 'speed', 'heading'])
+
+
+def segment_name(timestamp):
+    """
+    Name of the segment (YYYYMM, UTC) holding a timestamp.
+    """
+    return(datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y%m'))
+
+
+def extend_bounds(bounds, timestamp, latitude, longitude):
+    """
+    Returns bounds (as in the index) extended to a record. Unknown (NaN)
+    latitudes and longitudes leave the spatial bounds as they are.
+    """
+    if (latitude != latitude or longitude != longitude):
+        return((min(bounds[0], timestamp), max(bounds[1], timestamp)) + bounds[2:])
+    return((min(bounds[0], timestamp), max(bounds[1], timestamp), min(bounds[2], latitude), max(bounds[3], latitude), min(bounds[4], longitude), max(bounds[5], longitude)))
+
+
+def intersects(bounds, start, end, bbox):
+    """
+    Returns True if bounds (as in the index) may hold records between start
+    and end, and within bbox (min latitude, min longitude, max latitude,
+    max longitude) if it is not None.
+    """
+    if (bounds[0] > end or bounds[1] < start):
+        return(False)
+    return(bbox is None or not (bounds[2] > bbox[2] or bounds[3] < bbox[0] or bounds[4] > bbox[3] or bounds[5] < bbox[1]))
+
+
+@contextmanager
+def locked(f):
+    """
+    Holds an exclusive lock on an open file, shared with the other processes.
+    """
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+        yield f
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def to_float(value):
+    """
+    Converts a field of a position dictionary to a float, NaN if it is empty.
+    """
+    return(float('nan') if value in ('', None) else float(value))
+
+
+class Segment():
+    """
+    State of a segment file: number of records, sparse index of its complete
+    blocks, and bounds of its last (incomplete) block.
+    """
+
+    __slots__ = ('path', 'count', 'index', 'tail')
+
+    def __init__(self, path, block_records, writable=True):
+        self.path = path
+        self.count = 0
+        self.index = []
+        self.tail = EMPTY_BOUNDS
+        # Files are only repaired under the lock of the segment, as other processes may append to them
+        if (writable and os.path.exists(path + '.bin')):
+            with open(path + '.bin', 'ab') as f, locked(f):
+                self.load(block_records, writable)
+        else:
+            self.load(block_records, writable)
+
+    def load(self, block_records, writable):
+        path = self.path
+        size = os.path.getsize(path + '.bin') if os.path.exists(path + '.bin') else 0
+        if (writable and size % RECORD.size):
+            # A record cut by a crash is dropped
+            os.truncate(path + '.bin', size - size % RECORD.size)
+
+        if (os.path.exists(path + '.idx')):
+            with open(path + '.idx', 'rb') as f:
+                data = f.read()
+            self.index = [ INDEX_ENTRY.unpack_from(data, offset) for offset in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size) ]
+        # The index may lack its last entries (crash), and never holds the last incomplete block
+        complete = size // RECORD.size // block_records
+        if (len(self.index) > complete):
+            self.index = self.index[:complete]
+            if (writable):
+                with open(path + '.idx', 'r+b') as f:
+                    f.truncate(complete * INDEX_ENTRY.size)
+        self.count = len(self.index) * block_records
+        missing = len(self.index)
+        self.refresh(block_records)
+        if (writable and len(self.index) > missing):
+            with open(path + '.idx', 'ab') as f:
+                f.write(b''.join([ INDEX_ENTRY.pack(*entry) for entry in self.index[missing:] ]))
+
+    def add(self, timestamp, latitude, longitude, block_records):
+        """
+        Accounts for a record appended to the segment. Returns the bounds of
+        the block it completes, if any.
+        """
+        self.count += 1
+        self.tail = extend_bounds(self.tail, timestamp, latitude, longitude)
+        if (self.count % block_records):
+            return(None)
+        entry = self.tail
+        self.index.append(entry)
+        self.tail = EMPTY_BOUNDS
+        return(entry)
+
+    def refresh(self, block_records, size=None):
+        """
+        Accounts for the records appended to the file since it was last read
+        (by another process, or before the segment was loaded). size is that
+        of the file, if known.
+        """
+        if (size is None):
+            size = os.path.getsize(self.path + '.bin') if os.path.exists(self.path + '.bin') else 0
+        count = size // RECORD.size
+        if (count <= self.count):
+            return
+        with open(self.path + '.bin', 'rb') as f:
+            with mmap.mmap(f.fileno(), count * RECORD.size, access=mmap.ACCESS_READ) as data:
+                for record in RECORD.iter_unpack(data[self.count * RECORD.size:]):
+                    self.add(record[0], record[4], record[5], block_records)
+
+
+class PositionStore():
+    """
+    Append-only store of positions, by IMEI and month. Thread-safe.
+    With writable=False, files are never modified (for readers of the files
+    of another process).
+    """
+
+    def __init__(self, directory='./data/positions/', block_records=256, max_open_files=256, writable=True):
+        self.directory = directory
+        self.block_records = block_records
+        self.max_open_files = max_open_files
+        self.writable = writable
+        self._segments = {}
+        # Segment files open for appending, least recently used first
+        self._files = OrderedDict()
+        # Latest position by IMEI, with the number of records of its segment when it was found
+        self._latest = {}
+        self._lock = Lock()
+        if (writable):
+            os.makedirs(directory, exist_ok=True)
+
+    def append(self, imei, timestamp, method, valid, latitude, longitude, accuracy, speed, heading):
+        """
+        Appends a position. imei may be given as a string, method as a name
+        of METHODS, and unknown values as NaN.
+        """
+        imei = int(imei)
+        record = RECORD.pack(timestamp, imei, METHODS.index(method), valid, latitude, longitude, accuracy, speed, heading)
+        name = segment_name(timestamp)
+        with self._lock:
+            while (True):
+                segment = self._segment(imei, name, create=True)
+                f = self._files.pop(segment.path, None)
+                if (f is None):
+                    f = open(segment.path + '.bin', 'ab')
+                    if (len(self._files) >= self.max_open_files):
+                        self._files.popitem(last=False)[1].close()
+                self._files[segment.path] = f
+                fcntl.flock(f, fcntl.LOCK_EX)
+                stat = os.fstat(f.fileno())
+                if (stat.st_nlink):
+                    break
+                # Dropped by another process (see drop()): appended to a new file
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+                del self._files[segment.path]
+                self._segments.pop((imei, name), None)
+                self._latest.pop(imei, None)
+
+            try:
+                # Other processes may have appended to the segment since (or crashed while appending)
+                if (stat.st_size % RECORD.size):
+                    os.truncate(f.fileno(), stat.st_size - stat.st_size % RECORD.size)
+                segment.refresh(self.block_records, stat.st_size - stat.st_size % RECORD.size)
+                f.write(record)
+                f.flush()
+                entry = segment.add(timestamp, latitude, longitude, self.block_records)
+                if (entry is not None):
+                    with open(segment.path + '.idx', 'ab') as idx:
+                        idx.write(INDEX_ENTRY.pack(*entry))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def query(self, imei, start, end, bbox=None, limit=None):
+        """
+        Returns the positions of a device between two timestamps (inclusive),
+        and within bbox (min latitude, min longitude, max latitude, max
+        longitude) if given, sorted by timestamp: only the first limit ones
+        if given. Blocks that only hold positions later than the first
+        limit ones found are not read.
+        """
+        imei = int(imei)
+        positions = []
+        # Timestamp of the last of the first limit positions, once there are limit
+        cutoff = math.inf
+        for name in self.segments(imei):
+            # Segments are named after months: skip those out of the range, and those after the first limit positions
+            if ((math.isfinite(start) and name < segment_name(start)) or (math.isfinite(end) and name > segment_name(end))):
+                continue
+            if (limit is not None and len(positions) >= limit):
+                break
+            with self._lock:
+                segment = self._segment(imei, name)
+                segment.refresh(self.block_records)
+                count = segment.count
+                ranges = [ (b * self.block_records, (b + 1) * self.block_records, bounds[0]) for b, bounds in enumerate(segment.index) if intersects(bounds, start, end, bbox) ]
+                if (len(segment.index) * self.block_records < count and intersects(segment.tail, start, end, bbox)):
+                    ranges.append((len(segment.index) * self.block_records, count, segment.tail[0]))
+            if (not ranges):
+                continue
+
+            try:
+                f = open(segment.path + '.bin', 'rb')
+            except FileNotFoundError:
+                # Dropped since it was listed (see drop())
+                continue
+            with f:
+                with mmap.mmap(f.fileno(), count * RECORD.size, access=mmap.ACCESS_READ) as data:
+                    for first, last, earliest in ranges:
+                        # Blocks are mostly in order of time (offline positions come late)
+                        if (earliest > cutoff):
+                            continue
+                        for record in RECORD.iter_unpack(data[first * RECORD.size:last * RECORD.size]):
+                            if (start <= record[0] <= end and (bbox is None or (bbox[0] <= record[4] <= bbox[2] and bbox[1] <= record[5] <= bbox[3]))):
+                                positions.append(Position(record[0], record[1], METHODS[record[2]], *record[3:]))
+                        if (limit is not None and len(positions) >= limit):
+                            positions.sort(key=lambda p: p.timestamp)
+                            del positions[limit:]
+                            cutoff = positions[-1].timestamp
+        positions.sort(key=lambda p: p.timestamp)
+        return(positions)
+
+    def latest(self, imei):
+        """
+        Returns the most recent position of a device, or None.
+        """
+        imei = int(imei)
+        segments = self.segments(imei)
+        if (not segments):
+            return(None)
+        with self._lock:
+            segment = self._segment(imei, segments[-1])
+            segment.refresh(self.block_records)
+            count = segment.count
+            latest = self._latest.get(imei)
+            if (latest is not None and latest[0] == (segments[-1], count)):
+                return(latest[1])
+            newest = max([ bounds[1] for bounds in segment.index + [segment.tail] ])
+        positions = self.query(imei, newest, newest)
+        if (not positions):
+            return(None)
+        with self._lock:
+            self._latest[imei] = ((segments[-1], count), positions[-1])
+        return(positions[-1])
+
+    def version(self, imei):
+        """
+        Returns a value that changes whenever positions of a device are
+        appended: the names and sizes of its segments.
+        """
+        directory = os.path.join(self.directory, '%d' % int(imei))
+        return(tuple([ (name, os.path.getsize(os.path.join(directory, name + '.bin'))) for name in self.segments(imei) ]))
+
+    def imeis(self):
+        """
+        Returns the IMEIs of the devices that have positions.
+        """
+        if (not os.path.isdir(self.directory)):
+            return([])
+        return(sorted([ int(name) for name in os.listdir(self.directory) if name.isdigit() ]))
+
+    def segments(self, imei):
+        """
+        Returns the names of the segments of a device, oldest first.
+        """
+        directory = os.path.join(self.directory, '%d' % int(imei))
+        if (not os.path.isdir(directory)):
+            return([])
+        return(sorted([ name[:-4] for name in os.listdir(directory) if name.endswith('.bin') ]))
+
+    def drop(self, imei, name):
+        """
+        Removes a segment of a device (see track_simplifier.py: raw positions
+        are dropped once they are simplified).
+        """
+        imei = int(imei)
+        path = os.path.join(self.directory, '%d' % imei, name)
+        with self._lock:
+            f = self._files.pop(path, None)
+            if (f is not None):
+                f.close()
+            self._segments.pop((imei, name), None)
+            self._latest.pop(imei, None)
+            for extension in ('.bin', '.idx'):
+                try:
+                    os.remove(path + extension)
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+
+    def _segment(self, imei, name, create=False):
+        # Must be called with the lock held
+        key = (imei, name)
+        segment = self._segments.get(key)
+        if (segment is None):
+            directory = os.path.join(self.directory, '%d' % imei)
+            if (create):
+                os.makedirs(directory, exist_ok=True)
+            segment = self._segments[key] = Segment(os.path.join(directory, name), self.block_records, writable=self.writable)
+        return(segment)
+
+
+if __name__ == '__main__':
+    # Prints the positions of a device over the last hours, as TSV
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description='Query the positions of a device.')
+    parser.add_argument('imei')
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--directory', default='./data/positions/')
+    args = parser.parse_args()
+
+    now = time.time()
+    for position in PositionStore(args.directory, writable=False).query(args.imei, now - args.hours * 3600, now):
+        print(datetime.fromtimestamp(position.timestamp).strftime('%Y/%m/%d %H:%M:%S'), *position[1:], sep='\t')
@@ -0,0 +1,253 @@
+"""
+Console log of the server: leveled, structured, rate-limited and non-blocking.
+
+The server used to print several lines per packet (hex dumps, decoded
+positions, geolocation results) to stdout. Under load, writing them blocks
+on the terminal or on the pipe to journald, and holds back every thread.
+
+Events are now logged with a level (DEBUG for the packet by packet lines,
+INFO for connections and logins, WARNING and ERROR), along with the IP and
+IMEI of the device as separate fields:
+    - events below the configured level cost a comparison, and nothing else:
+      messages are only formatted, from their arguments, once they are written,
+    - events are queued and written by a background thread, and dropped
+      (and counted) rather than blocking when the queue is full,
+    - events of each device are rate-limited per message, below ERROR: a
+      chatty or misbehaving device can not flood the log. Suppressed events
+      are counted, and reported with the next event that is written.
+
+Lines are written as text (time, level, fields and message) or as JSON
+objects, one per line.
+
+Events are plain tuples rather than records of the logging module, whose
+records (caller lookup, handlers, filters) cost more than the prints they
+would replace.
+"""
+
+from collections import deque
+from threading import Event, Lock, Thread
+import atexit
+import json
+import sys
+import time
+import clock
+
+
+# Levels, as in the logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+# Events are not written below this level
+level = INFO
+
+# Events that could not be queued, as the queue was full
+dropped = 0
+
+_events = deque()
+_max_queue = 10000
+_wake = Event()
+_writer = None
+_format = None
+_limiter = None
+
+
+class RateLimiter():
+    """
+    Token bucket per device and message: events of a device with the same
+    message pass at most rate times per second, after a burst of burst
+    events.
+    """
+
+    def __init__(self, rate=5.0, burst=20, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.suppressed = 0
+        self._lock = Lock()
+        # Tokens, time of the last event and events suppressed since the last one passed, by (device, message)
+        self._buckets = {}
+
+    def allow(self, device, message):
+        """
+        Returns the number of events suppressed since the last one passed if
+        this event passes, None if it is suppressed.
+        """
+        key = (device, message)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if (bucket is None):
+                if (len(self._buckets) >= self.max_keys):
+                    self._buckets = {}
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if (tokens < 1):
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.suppressed += 1
+                return(None)
+            bucket[0] = tokens - 1
+            suppressed = bucket[2]
+            bucket[2] = 0
+        return(suppressed)
+
+
+def render(message, args):
+    """
+    Formats the message of an event, with bytes arguments as hex.
+    """
+    if (not args):
+        return(message)
+    return(message % tuple((arg.hex() if isinstance(arg, bytes) else arg) for arg in args))
+
+
+def format_text(event):
+    """
+    Time, level, IP and IMEI of the device when known, message.
+    """
+    event_level, timestamp, ip, imei, message, args, suppressed = event
+    line = clock.log_timestamp(timestamp) + ' ' + LEVEL_NAMES[event_level].ljust(7)
+    if (ip):
+        line += ' [ ' + ip + ' ]'
+    if (imei):
+        line += ' ' + imei
+    line += ' ' + render(message, args)
+    if (suppressed):
+        line += ' (%d similar events suppressed)' % suppressed
+    return(line)
+
+
+def format_json(event):
+    """
+    One JSON object per event.
+    """
+    event_level, timestamp, ip, imei, message, args, suppressed = event
+    fields = {'time': clock.log_timestamp(timestamp), 'level': LEVEL_NAMES[event_level], 'message': render(message, args)}
+    if (ip):
+        fields['ip'] = ip
+    if (imei):
+        fields['imei'] = imei
+    if (suppressed):
+        fields['suppressed'] = suppressed
+    return(json.dumps(fields))
+
+
+def configure(level='INFO', format='text', rate=5.0, burst=20, max_queue=10000):
+    """
+    Sets the level and the format ('text' or 'json') of the console log, the
+    rate limit of the events of each device (events per second and burst,
+    rate 0 to disable) and the number of events waiting to be written,
+    beyond which they are dropped. Starts the writer thread.
+    """
+    global _format, _limiter, _max_queue, _writer
+    stop()
+    globals()['level'] = (level if isinstance(level, int) else { name: value for value, name in LEVEL_NAMES.items() }[level.upper()])
+    _format = (format_json if format == 'json' else format_text)
+    _limiter = (RateLimiter(rate, burst) if rate else None)
+    _max_queue = max_queue
+    _writer = Thread(target=_write, name='serverlog', daemon=True)
+    _writer.start()
+
+
+def stop():
+    """
+    Writes the queued events and stops the writer thread.
+    """
+    global _writer
+    if (_writer is not None):
+        writer = _writer
+        _writer = None
+        _wake.set()
+        writer.join()
+
+
+def suppressed():
+    """
+    Returns the number of events suppressed by the rate limits.
+    """
+    return(0 if _limiter is None else _limiter.suppressed)
+
+
+def enabled(event_level):
+    """
+    Tells whether events of a level are written.
+    """
+    return(event_level >= level)
+
+
+def log(event_level, session, message, *args):
+    """
+    Logs an event of a device session (or None), with the arguments of its
+    message (%-style). The message is only formatted when the event is
+    written; bytes-like arguments are written as hex.
+    """
+    global dropped
+    if (event_level < level):
+        return
+    if (session is None):
+        ip = imei = ''
+    else:
+        ip = session.address[0]
+        imei = session.imei_text
+    suppressed = 0
+    if (_limiter is not None and event_level < ERROR and (imei or ip)):
+        suppressed = _limiter.allow(imei or ip, message)
+        if (suppressed is None):
+            return
+    if (len(_events) >= _max_queue):
+        dropped += 1
+        return
+    # Buffers (responses are views of reusable buffers) are copied, as they are formatted later
+    if (args):
+        args = tuple((bytes(arg) if isinstance(arg, (memoryview, bytearray)) else arg) for arg in args)
+    event = (event_level, time.time(), ip, imei, message, args, suppressed)
+    if (_writer is None):
+        # Not configured (command-line tools) or stopped (at exit): written right away
+        sys.stdout.write((_format or format_text)(event) + '\n')
+        return
+    _events.append(event)
+    if (not _wake.is_set()):
+        _wake.set()
+
+
+def debug(session, message, *args):
+    log(DEBUG, session, message, *args)
+
+
+def info(session, message, *args):
+    log(INFO, session, message, *args)
+
+
+def warning(session, message, *args):
+    log(WARNING, session, message, *args)
+
+
+def error(session, message, *args):
+    log(ERROR, session, message, *args)
+
+
+def _write():
+    # Writer thread: writes the queued events, and flushes once the queue is empty
+    thread = _writer
+    while (True):
+        _wake.wait()
+        _wake.clear()
+        while (_events):
+            event = _events.popleft()
+            try:
+                sys.stdout.write(_format(event) + '\n')
+            except Exception as e:
+                sys.stderr.write('ERROR: could not write a log event: %r %r\n' % (e, event))
+        try:
+            sys.stdout.flush()
+        except Exception:
+            pass
+        if (_writer is not thread):
+            return
+
+
+atexit.register(stop)
@@ -0,0 +1,175 @@
+"""
+Sessions of the devices connected to the server.
+
+A session holds what the server keeps about a device: its connection
+(client socket, or TrackerProtocol in 'asyncio' mode, with its frame
+decoder, response buffer and the bytes not written yet), its IMEI once it logged in, and its last
+position as typed values rather than dictionaries of strings.
+
+Sessions are indexed by IMEI in a SessionTable: when a device reconnects
+(2G connections are often dropped without the server noticing), the new
+session takes over the state of the previous one, whose connection is
+closed. Once their connection closed, sessions are kept for a while
+without their buffers, then forgotten: the table holds at most one session
+per device, whatever the number of connections.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import math
+import time
+
+
+class Session():
+    """
+    State of a device connection. __slots__ keep it compact: a fleet of
+    idle devices holds one session per device.
+    """
+
+    __slots__ = ('client', 'address', 'imei', 'software_version', 'decoder', 'builder', 'send_lock', 'outbox', 'received',
+                 'connected', 'timeout', 'deadline', 'fix_time', 'fix_method', 'fix_valid', 'latitude', 'longitude', 'accuracy', 'speed',
+                 'heading', 'satellites')
+
+    def __init__(self, client, address, decoder, builder):
+        self.client = client
+        # (IP, port) of the device
+        self.address = address
+        # IMEI as an integer, 0 until the device logged in
+        self.imei = 0
+        self.software_version = 0
+        self.decoder = decoder
+        self.builder = builder
+        self.send_lock = Lock()
+        # Bytes the socket did not accept yet (a bytearray), None when everything was written
+        self.outbox = None
+        # perf_counter() time at which the packet being handled was received
+        self.received = None
+        self.connected = time.time()
+        # Idle timeout of the connection in its current state, in seconds, and time.monotonic()
+        # time after which it is closed unless a packet is received (see timer_wheel.py)
+        self.timeout = math.inf
+        self.deadline = math.inf
+        # Last position: UTC timestamp, method (see position_store.METHODS), validity,
+        # and NaN for unknown values
+        self.fix_time = math.nan
+        self.fix_method = ''
+        self.fix_valid = 0
+        self.latitude = math.nan
+        self.longitude = math.nan
+        self.accuracy = math.nan
+        self.speed = math.nan
+        self.heading = math.nan
+        self.satellites = 0
+
+    @property
+    def imei_text(self):
+        """
+        IMEI as written to the logs: 15 digits, or empty before login.
+        """
+        return(format(self.imei, '015d') if self.imei else '')
+
+    def set_timeout(self, timeout):
+        """
+        Sets the idle timeout of the connection, counted from now.
+        """
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout
+
+    def set_fix(self, timestamp, method, valid, latitude, longitude, accuracy=math.nan, speed=math.nan, heading=math.nan, satellites=0):
+        """
+        Records the last position of the device.
+        """
+        self.fix_time = timestamp
+        self.fix_method = method
+        self.fix_valid = valid
+        self.latitude = latitude
+        self.longitude = longitude
+        self.accuracy = accuracy
+        self.speed = speed
+        self.heading = heading
+        self.satellites = satellites
+
+    def take_over(self, previous):
+        """
+        Takes over the last position of the previous session of the device.
+        """
+        if (math.isnan(self.fix_time) or previous.fix_time > self.fix_time):
+            self.set_fix(previous.fix_time, previous.fix_method, previous.fix_valid, previous.latitude, previous.longitude,
+                previous.accuracy, previous.speed, previous.heading, previous.satellites)
+
+    def detach(self):
+        """
+        Releases the connection and its buffers, once it closed.
+        """
+        self.client = None
+        self.decoder = None
+        self.builder = None
+        self.outbox = None
+
+
+class SessionTable():
+    """
+    Sessions by IMEI: those of the connected devices, and those of devices
+    that disconnected less than ttl seconds ago.
+    Thread-safe: it is shared by all the connections of the server.
+    """
+
+    def __init__(self, ttl=24 * 3600):
+        self.ttl = ttl
+        self._sessions = {}
+        # Time at which sessions were detached from their connection, oldest first, by IMEI
+        self._detached = OrderedDict()
+        self._lock = Lock()
+        self.takeovers = 0
+
+    def __len__(self):
+        with self._lock:
+            return(len(self._sessions))
+
+    def get(self, imei):
+        """
+        Returns the session of a device, or None.
+        """
+        with self._lock:
+            return(self._sessions.get(imei))
+
+    def login(self, session, imei):
+        """
+        Indexes a session by the IMEI its device logged in with; it takes
+        over the state of the previous session of that device. Returns that
+        previous session if its connection is still open (it is stale: the
+        device can only hold one connection), or None.
+        """
+        with self._lock:
+            self._expire()
+            session.imei = imei
+            previous = self._sessions.get(imei)
+            self._sessions[imei] = session
+            self._detached.pop(imei, None)
+            if (previous is None or previous is session):
+                return(None)
+            session.take_over(previous)
+            self.takeovers += 1
+            return(previous if previous.client is not None else None)
+
+    def close(self, session):
+        """
+        Detaches a session from its connection, when the connection closed.
+        The session stays indexed for ttl seconds, unless the device already
+        reconnected.
+        """
+        session.detach()
+        with self._lock:
+            if (session.imei and self._sessions.get(session.imei) is session):
+                self._detached[session.imei] = time.monotonic()
+            self._expire()
+
+    def _expire(self):
+        # Forgets the sessions detached for more than ttl seconds (lock held)
+        limit = time.monotonic() - self.ttl
+        while (self._detached):
+            imei, detached = next(iter(self._detached.items()))
+            if (detached > limit):
+                break
+            del self._detached[imei]
+            del self._sessions[imei]
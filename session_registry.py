@@ -0,0 +1,149 @@
+"""
+Registry of the devices connected to the server, by IMEI.
+
+In the multi-process mode of the server (see supervisor.py), a device may
+reconnect through any of the worker processes: the registry tells which
+worker holds the connection of a device, so that all workers agree on
+who serves an IMEI. Like the other state shared by the workers, it is a
+SQLite database (WAL mode). It is only written when devices log in or
+disconnect, never for the other packets.
+
+A device that logs in on a worker while another still holds its former
+connection (dropped by the device without being closed) takes it over:
+each worker checks the registry for devices it holds that logged in
+elsewhere since (see start()), and closes their stale connections.
+"""
+
+from collections import namedtuple
+from threading import Lock, Thread
+import os
+import serverlog
+import sqlite3
+import time
+
+
+# A device connection: worker number and PID of the process holding it,
+# connection number within that process, client address and login timestamp
+Session = namedtuple('Session', ['imei', 'worker', 'pid', 'connection', 'address', 'since'])
+
+
+class SessionRegistry():
+    """
+    Sessions by IMEI, shared by the processes opening the same file.
+    Thread-safe: it is shared by all the connections of a process.
+    """
+
+    def __init__(self, path=None, worker=0):
+        self.worker = worker
+        self.pid = os.getpid()
+        self._lock = Lock()
+        # Connections of this process, by IMEI, and state of the last check for those taken over
+        self._claimed = {}
+        self._version = None
+        self._checked = time.time()
+
+        directory = os.path.dirname(path) if path else ''
+        if (directory):
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False, timeout=10)
+        if (path):
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS sessions (
+            imei TEXT PRIMARY KEY, worker INTEGER NOT NULL, pid INTEGER NOT NULL,
+            connection INTEGER NOT NULL, address TEXT NOT NULL, since REAL NOT NULL)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS sessions_since ON sessions (since)')
+        self._db.commit()
+
+    def claim(self, imei, connection, address):
+        """
+        Records that a device logged in on a connection of this process, and
+        returns its previous session if it was held by another connection
+        (possibly of another worker), or None.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT * FROM sessions WHERE imei = ?', (imei,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)',
+                (imei, self.worker, self.pid, connection, address, time.time()))
+            self._db.commit()
+            self._claimed[imei] = connection
+        if (row is None or (row[2], row[3]) == (self.pid, connection)):
+            return(None)
+        return(Session(*row))
+
+    def release(self, imei, connection):
+        """
+        Removes the session of a device when its connection closes, unless the
+        device logged in again on another connection in the meantime.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM sessions WHERE imei = ? AND pid = ? AND connection = ?', (imei, self.pid, connection))
+            self._db.commit()
+            if (self._claimed.get(imei) == connection):
+                del self._claimed[imei]
+
+    def taken_over(self):
+        """
+        Returns the sessions of the devices whose connection this process
+        holds, but that logged in on another process since the last call, as
+        (IMEI, connection) pairs: these connections are stale. The sessions
+        are only read when another process changed the registry.
+        """
+        with self._lock:
+            version = self._db.execute('PRAGMA data_version').fetchone()[0]
+            if (version == self._version):
+                return([])
+            self._version = version
+            # Logins committed a little after their timestamp are not missed
+            checked, self._checked = self._checked, time.time()
+            rows = self._db.execute('SELECT imei FROM sessions WHERE since >= ? AND pid != ?', (checked - 60, self.pid)).fetchall()
+            taken = [ (imei, self._claimed.pop(imei)) for (imei,) in rows if imei in self._claimed ]
+        return(taken)
+
+    def start(self, on_taken_over, interval=1.0):
+        """
+        Starts a background thread that calls on_taken_over(imei, connection)
+        for each session of this process taken over by another one (see
+        taken_over()), every interval seconds.
+        """
+        Thread(target=self._run, args=(on_taken_over, interval), name='session-registry', daemon=True).start()
+
+    def owner(self, imei):
+        """
+        Returns the session of a device, or None if it is not connected.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT * FROM sessions WHERE imei = ?', (imei,)).fetchone()
+        return(None if row is None else Session(*row))
+
+    def sessions(self, worker=None):
+        """
+        Returns all the sessions, or those of a worker.
+        """
+        with self._lock:
+            if (worker is None):
+                rows = self._db.execute('SELECT * FROM sessions ORDER BY imei').fetchall()
+            else:
+                rows = self._db.execute('SELECT * FROM sessions WHERE worker = ? ORDER BY imei', (worker,)).fetchall()
+        return([ Session(*row) for row in rows ])
+
+    def clear(self, worker=None):
+        """
+        Removes all the sessions, or those of a worker, left over by a server
+        or a worker that stopped.
+        """
+        with self._lock:
+            if (worker is None):
+                self._db.execute('DELETE FROM sessions')
+            else:
+                self._db.execute('DELETE FROM sessions WHERE worker = ?', (worker,))
+            self._db.commit()
+
+    def _run(self, on_taken_over, interval):
+        while (True):
+            time.sleep(interval)
+            try:
+                for imei, connection in self.taken_over():
+                    on_taken_over(imei, connection)
+            except Exception as e:
+                serverlog.warning(None, 'Could not check the session registry: %s', e)
@@ -0,0 +1,95 @@
+"""
+Supervisor of the multi-process mode of gps_tcp_server.py.
+
+With SERVER_WORKERS set above 1, the server starts this supervisor, which
+runs SERVER_WORKERS worker processes. Each worker is a complete server,
+with its own listening socket bound to the same port with SO_REUSEPORT:
+the kernel spreads incoming connections over the workers, and each worker
+serves its connections from its own event loop (or threads), on its own
+core, instead of a single process being held by the GIL.
+
+Workers are started as new interpreters rather than forked from the
+supervisor: the supervisor already holds threads (log writer, geolocation
+workers) and SQLite connections, which a forked child must not inherit.
+
+State seen by all the workers goes through files:
+    - the geolocation cache and the learned hotspots are SQLite databases,
+    - the fingerprint index is an append-only file, followed by every worker,
+    - positions are appended to the files of the position store,
+    - the devices connected to each worker are listed by IMEI in the
+      session registry (see session_registry.py), a SQLite database.
+Each worker writes its own log files (./logs/worker-<n>/) and serves its
+own metrics (on METRICS_PORT + n) and live feed (on LIVE_FEED_PORT + n).
+
+A worker that exits is restarted, after a delay that grows while workers
+keep on exiting right after they started.
+"""
+
+import os
+import serverlog
+import signal
+import subprocess
+import sys
+import time
+
+
+# Delays before restarting a worker, in seconds
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 30
+
+# A worker that ran for longer than this (in seconds) was healthy: its restart delay is reset
+HEALTHY_UPTIME = 60
+
+
+def start_worker(script, worker):
+    """
+    Starts a worker process, which finds its number in SERVER_WORKER.
+    """
+    return(subprocess.Popen([sys.executable, script], env=dict(os.environ, SERVER_WORKER=str(worker))))
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def supervise(script, workers):
+    """
+    Runs workers of a server script and restarts those that exit, until the
+    supervisor is interrupted (Ctrl+C or SIGTERM); workers are then stopped.
+    """
+
+    signal.signal(signal.SIGTERM, stop)
+    # Process, start time, restart delay and time of the next restart, by worker number
+    entries = { worker: {'process': None, 'started': 0, 'delay': RESTART_DELAY / 2, 'restart': 0} for worker in range(workers) }
+    try:
+        while (True):
+            now = time.monotonic()
+            for worker, entry in entries.items():
+                process = entry['process']
+                if (process is None and now >= entry['restart']):
+                    entry['process'] = start_worker(script, worker)
+                    entry['started'] = now
+                    serverlog.info(None, 'Worker %d started (PID %d).', worker, entry['process'].pid)
+                elif (process is not None and process.poll() is not None):
+                    if (now - entry['started'] >= HEALTHY_UPTIME):
+                        entry['delay'] = RESTART_DELAY
+                    else:
+                        entry['delay'] = min(MAX_RESTART_DELAY, 2 * entry['delay'])
+                    entry['process'] = None
+                    entry['restart'] = now + entry['delay']
+                    serverlog.warning(None, 'Worker %d (PID %d) exited with status %d, restarting in %g s.', worker, process.pid, process.returncode, entry['delay'])
+            time.sleep(0.5)
+
+    except KeyboardInterrupt:
+        serverlog.info(None, 'Stopping the workers...')
+    finally:
+        processes = [ entry['process'] for entry in entries.values() if entry['process'] is not None ]
+        for process in processes:
+            if (process.poll() is None):
+                process.send_signal(signal.SIGTERM)
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
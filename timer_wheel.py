@@ -0,0 +1,184 @@
+"""
+Hierarchical timer wheel, and the reaper of idle connections built on it.
+
+2G devices often lose coverage without closing their connection: nothing
+is ever received again on it, and it stays open forever (holding a thread
+in 'threads' mode). Every connection therefore has a deadline, pushed back
+by each packet it receives, and is closed once its deadline passed.
+
+Deadlines of tens of thousands of connections are kept in a timer wheel
+rather than a heap or a sorted list: timers are put in the slot of the
+tick at which they expire, so scheduling, cancelling and running a tick
+cost O(1), whatever the number of timers. The wheel is hierarchical: the
+first level has one slot per tick, each of the next levels one slot per
+lap of the previous level. Timers of the upper levels are moved down
+(cascaded) as the wheel turns, once they get close to their expiration.
+
+Packets do not touch the wheel: they only push back the deadline of their
+connection. When a timer expires, the reaper checks the deadline of its
+connection, and schedules the timer again if the deadline was pushed back.
+A connection therefore costs at most one timer operation per timeout,
+however many packets it receives.
+"""
+
+from threading import Lock, Thread
+import math
+import serverlog
+import time
+
+
+class TimerWheel():
+    """
+    Timers keyed by any hashable object, with a resolution (duration of a
+    tick) in seconds. Each of the levels has 2**bits slots: the default 4
+    levels of 64 slots span 64**4 ticks, about 190 days with 1 s ticks.
+    Later timers are kept at the end of that span (and expire early).
+    Not thread-safe.
+    """
+
+    def __init__(self, resolution=1.0, bits=6, levels=4, now=0.0):
+        self.resolution = resolution
+        self._bits = bits
+        self._mask = (1 << bits) - 1
+        self._span = 1 << (bits * levels)
+        # Slots of each level: expiration tick of their timers, by key
+        self._levels = [ [ {} for index in range(1 << bits) ] for level in range(levels) ]
+        # Slot of each timer, to cancel it
+        self._slots = {}
+        # Next tick to run
+        self._tick = int(now / resolution)
+
+    def __len__(self):
+        return(len(self._slots))
+
+    def __contains__(self, key):
+        return(key in self._slots)
+
+    def schedule(self, key, deadline):
+        """
+        Sets the timer of a key to expire at deadline (same clock as the
+        times given to advance()), replacing its previous timer.
+        """
+        self.cancel(key)
+        if (deadline > (self._tick + self._span - 1) * self.resolution):
+            tick = self._tick + self._span - 1
+        else:
+            tick = math.ceil(deadline / self.resolution)
+        self._insert(key, tick)
+
+    def cancel(self, key):
+        """
+        Removes the timer of a key, if it has one.
+        """
+        slot = self._slots.pop(key, None)
+        if (slot is not None):
+            del slot[key]
+
+    def advance(self, now):
+        """
+        Runs the ticks up to the time now, and returns the keys of the timers
+        that expired (they are removed from the wheel).
+        """
+        target = int(now / self.resolution)
+        expired = []
+        while (self._tick <= target):
+            index = self._tick & self._mask
+            if (index == 0):
+                self._cascade(1)
+            slot = self._levels[0][index]
+            if (slot):
+                expired.extend(slot)
+                for key in slot:
+                    del self._slots[key]
+                slot.clear()
+            self._tick += 1
+        return(expired)
+
+    def _insert(self, key, tick):
+        # Timers are put on the lowest level whose lap covers their expiration
+        delta = tick - self._tick
+        if (delta < 0):
+            tick = self._tick
+            delta = 0
+        level = 0
+        while (delta >> (self._bits * (level + 1))):
+            level += 1
+        slot = self._levels[level][(tick >> (self._bits * level)) & self._mask]
+        slot[key] = tick
+        self._slots[key] = slot
+
+    def _cascade(self, level):
+        # The lower level starts a new lap: the timers of the current slot of
+        # this level expire during that lap, they are moved down
+        if (level >= len(self._levels)):
+            return
+        index = (self._tick >> (self._bits * level)) & self._mask
+        if (index == 0):
+            self._cascade(level + 1)
+        slot = self._levels[level][index]
+        timers = list(slot.items())
+        slot.clear()
+        for key, tick in timers:
+            self._insert(key, tick)
+
+
+class IdleReaper():
+    """
+    Calls on_expire(item) from a background thread for the watched items
+    whose deadline passed. Items have a deadline attribute (time.monotonic()
+    time), which can be pushed back at any time without calling the reaper.
+    Thread-safe.
+    """
+
+    def __init__(self, on_expire, resolution=1.0):
+        self.on_expire = on_expire
+        self.resolution = resolution
+        self.reaped = 0
+        self._lock = Lock()
+        self._wheel = TimerWheel(resolution, now=time.monotonic())
+        self._thread = Thread(target=self._run, name='idle-reaper', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._lock:
+            return(len(self._wheel))
+
+    def watch(self, item):
+        """
+        Starts watching an item, or takes into account a deadline that was
+        brought forward.
+        """
+        with self._lock:
+            self._wheel.schedule(item, item.deadline)
+
+    def forget(self, item):
+        """
+        Stops watching an item.
+        """
+        with self._lock:
+            self._wheel.cancel(item)
+
+    def reap(self, now):
+        """
+        Calls on_expire() for the items whose deadline passed at the time
+        now, and returns them.
+        """
+        due = []
+        with self._lock:
+            for item in self._wheel.advance(now):
+                if (item.deadline > now):
+                    self._wheel.schedule(item, item.deadline)
+                else:
+                    due.append(item)
+        for item in due:
+            try:
+                self.on_expire(item)
+            except Exception as e:
+                serverlog.warning(None, 'Could not close an idle connection: %s', e)
+        self.reaped += len(due)
+        return(due)
+
+    def _run(self):
+        while (True):
+            time.sleep(self.resolution)
+            self.reap(time.monotonic())
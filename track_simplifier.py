@@ -0,0 +1,335 @@
+"""
+Simplification of the tracks of the devices, and storage of the positions
+in two tiers.
+
+A tracker left at home reports the same position every few minutes: the
+position store fills up with thousands of near-identical records a day,
+which are all read again to draw its track. Positions are now stored in
+two tiers, both position stores (see position_store.py):
+    - the raw tier holds every position, as received, for raw_retention
+      seconds (0 to keep them forever),
+    - the simplified tier holds the track of each device simplified on
+      ingest, by a streaming simplifier per device, forever.
+Once raw positions are past the retention, their months are dropped from
+the raw tier (the store is split into monthly segments: raw positions are
+kept between raw_retention and raw_retention plus a month). Raw positions
+that were stored before the simplified tier existed are simplified then.
+
+The simplifier is an opening window on the synchronized distance: a
+position is dropped when it lies within the tolerance of the position
+interpolated at its time between the positions kept before and after it.
+The error of a simplified track is thus bounded in space and in time (where
+was the device at 10:42?), and a device that does not move keeps one
+position per max_interval seconds: stays collapse into a few positions,
+whatever the GPS jitter under the tolerance. WiFi/LBS positions are only
+kept when they move by more than their own accuracy.
+
+Queries choose the tier ('raw', 'simplified', or 'auto': raw positions
+where the raw tier still has them, simplified ones before), and may
+simplify the result further with a larger tolerance, to draw long tracks.
+"""
+
+from threading import Lock, Thread
+import calendar
+import math
+import serverlog
+import time
+from position_store import Position, PositionStore, segment_name
+
+
+# Meters per degree of latitude (spherical Earth)
+METERS_PER_DEGREE = math.pi * 6371000.0 / 180
+
+
+def month_start(name):
+    """
+    UTC epoch of the first second of the month of a segment name (YYYYMM).
+    """
+    return(calendar.timegm((int(name[:4]), int(name[4:]), 1, 0, 0, 0)))
+
+
+def month_end(name):
+    """
+    UTC epoch of the first second of the month following a segment name (YYYYMM).
+    """
+    year, month = int(name[:4]), int(name[4:])
+    return(calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0)))
+
+
+class TrackSimplifier():
+    """
+    Streaming simplifier of the track of one device. Positions are added in
+    the order they are received, and the positions to keep come out with a
+    delay of one position: the last position added is pending until the
+    next one shows whether it is needed, or until flush().
+    """
+
+    __slots__ = ('tolerance', 'max_interval', 'max_points', 'anchor', 'scale', 'window', 'updated')
+
+    def __init__(self, tolerance=25.0, max_interval=3600.0, max_points=64):
+        self.tolerance = tolerance
+        self.max_interval = max_interval
+        self.max_points = max_points
+        # Last position kept, and meters per degree of longitude at its latitude
+        self.anchor = None
+        self.scale = 0.0
+        # Positions added since the anchor, with their time and coordinates (meters) from it, and squared tolerance
+        self.window = []
+        # time.monotonic() of the last position added
+        self.updated = 0.0
+
+    def add(self, position):
+        """
+        Adds the next position of the device (a Position). Returns the
+        positions to keep: usually none, or the previous one. Positions
+        without coordinates are dropped, and positions older than the
+        previous one (sent offline) are kept as they are.
+        """
+        self.updated = time.monotonic()
+        if (position.latitude != position.latitude or position.longitude != position.longitude):
+            return([])
+        if (self.anchor is None):
+            self._set_anchor(position)
+            return([position])
+        window = self.window
+        if (position.timestamp < (window[-1][0] if window else self.anchor).timestamp):
+            return([position])
+        point = self._point(position)
+        if (window and not self._fits(point)):
+            # The previous position is needed: it becomes the anchor of a new window
+            kept = window[-1][0]
+            self._set_anchor(kept)
+            self.window = [self._point(position)]
+            return([kept])
+        window.append(point)
+        return([])
+
+    def flush(self):
+        """
+        Returns the pending position, if any, as kept: it becomes the anchor
+        of the next positions.
+        """
+        if (not self.window):
+            return([])
+        kept = self.window[-1][0]
+        self._set_anchor(kept)
+        self.window = []
+        return([kept])
+
+    def _set_anchor(self, position):
+        self.anchor = position
+        self.scale = METERS_PER_DEGREE * math.cos(math.radians(position.latitude))
+
+    def _point(self, position):
+        # Entry of the window: equirectangular projection around the anchor, in meters.
+        # Positions are never expected closer than their own accuracy (NaN: unknown)
+        anchor = self.anchor
+        tolerance = (position.accuracy if position.accuracy > self.tolerance else self.tolerance)
+        return((position, position.timestamp - anchor.timestamp,
+            ((position.longitude - anchor.longitude + 180.0) % 360.0 - 180.0) * self.scale,
+            (position.latitude - anchor.latitude) * METERS_PER_DEGREE, tolerance * tolerance))
+
+    def _fits(self, point):
+        # Tells whether the positions of the window are within their tolerance
+        # of the track from the anchor to a new point, at their time
+        span, x, y = point[1:4]
+        if (span > self.max_interval or len(self.window) >= self.max_points):
+            return(False)
+        if (span <= 0):
+            span = math.inf
+        for position, dt, px, py, tolerance in self.window:
+            f = dt / span
+            dx = px - f * x
+            dy = py - f * y
+            if (dx * dx + dy * dy > tolerance):
+                return(False)
+        return(True)
+
+
+def simplify(positions, tolerance, max_interval=math.inf):
+    """
+    Simplifies a track (positions sorted by timestamp) with a tolerance in
+    meters. Positions without coordinates are left out.
+    """
+    simplifier = TrackSimplifier(tolerance, max_interval)
+    kept = []
+    for position in positions:
+        kept += simplifier.add(position)
+    return(kept + simplifier.flush())
+
+
+class TieredStore():
+    """
+    Position store in two tiers, raw and simplified, with the interface of
+    PositionStore. Thread-safe. With writable=False, files are never
+    modified (for readers of the files of another process).
+    """
+
+    def __init__(self, directory='./data/positions/', simplified_directory='./data/positions-simplified/',
+            raw_retention=30 * 86400, tolerance=25.0, max_interval=3600.0, writable=True):
+        self.raw = PositionStore(directory=directory, writable=writable)
+        self.simplified = PositionStore(directory=simplified_directory, writable=writable)
+        self.raw_retention = raw_retention
+        self.tolerance = tolerance
+        self.max_interval = max_interval
+        # Positions written to the raw tier, and to the simplified tier
+        self.appended = 0
+        self.kept = 0
+        # Simplifiers of the devices, by IMEI (devices that stop sending are forgotten, see flush())
+        self._simplifiers = {}
+        self._lock = Lock()
+        self._thread = None
+
+    def append(self, imei, timestamp, method, valid, latitude, longitude, accuracy, speed, heading):
+        """
+        Appends a position to the raw tier, and to the simplified tier if
+        it is needed to draw the track of the device.
+        """
+        position = Position(timestamp, int(imei), method, valid, latitude, longitude, accuracy, speed, heading)
+        now = time.time()
+        if (self.raw_retention and timestamp < now - self.raw_retention and self.expired(segment_name(timestamp), now)):
+            # Late position of a month that was already compacted
+            kept = ([] if latitude != latitude else [position])
+            with self._lock:
+                self.kept += len(kept)
+        else:
+            self.raw.append(position.imei, timestamp, method, valid, latitude, longitude, accuracy, speed, heading)
+            with self._lock:
+                simplifier = self._simplifiers.get(position.imei)
+                if (simplifier is None):
+                    simplifier = self._simplifiers[position.imei] = TrackSimplifier(self.tolerance, self.max_interval)
+                kept = simplifier.add(position)
+                self.appended += 1
+                self.kept += len(kept)
+        self._keep(kept)
+
+    def flush(self, idle=0.0):
+        """
+        Writes the pending position of the devices that sent nothing for
+        idle seconds (all of them by default) to the simplified tier, and
+        forgets their simplifier.
+        """
+        now = time.monotonic()
+        kept = []
+        with self._lock:
+            for imei, simplifier in list(self._simplifiers.items()):
+                if (now - simplifier.updated >= idle):
+                    kept += simplifier.flush()
+                    del self._simplifiers[imei]
+            self.kept += len(kept)
+        self._keep(kept)
+
+    def expired(self, name, now):
+        """
+        Tells whether the raw positions of a month (segment name) are past
+        the retention at the time now.
+        """
+        if (not self.raw_retention):
+            return(False)
+        return(month_end(name) <= now - self.raw_retention)
+
+    def compact(self, now=None):
+        """
+        Drops the months of raw positions past the retention, after
+        simplifying the positions that are not in the simplified tier (those
+        stored before it existed). Returns the number of months dropped.
+        """
+        now = (time.time() if now is None else now)
+        dropped = 0
+        for imei in self.raw.imeis():
+            for name in self.raw.segments(imei):
+                if (not self.expired(name, now)):
+                    break
+                start, end = month_start(name), month_end(name)
+                simplified = self.simplified.query(imei, start, end)
+                first = (simplified[0].timestamp if simplified else end)
+                missing = [ p for p in self.raw.query(imei, start, end) if p.timestamp < first ]
+                self._keep(simplify(missing, self.tolerance, self.max_interval))
+                self.raw.drop(imei, name)
+                dropped += 1
+        return(dropped)
+
+    def start(self, interval=60.0, compact_interval=3600.0, compact=True):
+        """
+        Starts a background thread that flushes the devices idle for more
+        than max_interval every interval seconds and, if compact is True
+        (only one process should), compacts the raw tier every
+        compact_interval seconds.
+        """
+        self._thread = Thread(target=self._run, args=(interval, compact_interval, compact), name='track-tiers', daemon=True)
+        self._thread.start()
+
+    def query(self, imei, start, end, bbox=None, resolution='auto', tolerance=0.0, limit=None):
+        """
+        Returns the positions of a device between two timestamps (inclusive),
+        and within bbox if given, sorted by timestamp, from a tier ('raw',
+        'simplified', or 'auto' for the raw tier where it still has the
+        positions, and the simplified one before): only the first limit
+        ones if given. With a tolerance (meters), the positions are
+        simplified further (after the limit).
+        """
+        if (resolution == 'raw'):
+            positions = self.raw.query(imei, start, end, bbox, limit)
+        elif (resolution == 'simplified'):
+            positions = self.simplified.query(imei, start, end, bbox, limit)
+        elif (resolution == 'auto'):
+            segments = self.raw.segments(imei)
+            boundary = (month_start(segments[0]) if segments else math.inf)
+            positions = []
+            if (start < boundary):
+                positions = [ p for p in self.simplified.query(imei, start, min(end, boundary), bbox, limit) if p.timestamp < boundary ]
+            if (end >= boundary and (limit is None or len(positions) < limit)):
+                positions += self.raw.query(imei, max(start, boundary), end, bbox, (None if limit is None else limit - len(positions)))
+        else:
+            raise ValueError('unknown resolution: %r' % (resolution,))
+        if (tolerance):
+            positions = simplify(positions, tolerance)
+        return(positions)
+
+    def latest(self, imei):
+        """
+        Returns the most recent position of a device, or None.
+        """
+        position = self.raw.latest(imei)
+        return(self.simplified.latest(imei) if position is None else position)
+
+    def version(self, imei):
+        """
+        Returns a value that changes whenever positions of a device are appended or compacted.
+        """
+        return((self.raw.version(imei), self.simplified.version(imei)))
+
+    def imeis(self):
+        """
+        Returns the IMEIs of the devices that have positions.
+        """
+        return(sorted(set(self.raw.imeis()) | set(self.simplified.imeis())))
+
+    def stats(self):
+        """
+        Returns the number of positions written to the raw tier (appended)
+        and to the simplified tier (kept), and of devices being simplified.
+        """
+        with self._lock:
+            return({'appended': self.appended, 'kept': self.kept, 'devices': len(self._simplifiers)})
+
+    def close(self):
+        self.flush()
+        self.raw.close()
+        self.simplified.close()
+
+    def _keep(self, positions):
+        for p in positions:
+            self.simplified.append(p.imei, p.timestamp, p.method, p.valid, p.latitude, p.longitude, p.accuracy, p.speed, p.heading)
+
+    def _run(self, interval, compact_interval, compact):
+        next_compaction = time.monotonic()
+        while (True):
+            time.sleep(interval)
+            try:
+                self.flush(idle=self.max_interval)
+                if (compact and time.monotonic() >= next_compaction):
+                    next_compaction = time.monotonic() + compact_interval
+                    self.compact()
+            except Exception as e:
+                serverlog.warning(None, 'Could not flush or compact the position store: %s', e)